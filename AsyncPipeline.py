@@ -0,0 +1,255 @@
+import asyncio
+import io
+import logging
+import os
+import threading
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from ExifToolPool import ExifToolPool
+from IncrementalIndex import IncrementalIndex
+from Journal import Journal
+from MemoryBudget import MemoryBudget, estimate_mux_memory
+from Muxer import Muxer
+from MuxPool import PREFETCH_BATCH_SIZE
+from Profiler import Profiler
+from utils import prefetch_metadata
+
+
+class PipelineJob:
+    def __init__(self, seq: int, header: str, kwargs: dict = None):
+        self.seq = seq
+        self.header = header
+        self.kwargs = kwargs
+        self.output = io.StringIO()
+        self.muxer = None
+        self.segments = None
+        self.memory = 0
+
+
+class AsyncPipeline:
+
+    # Drop-in alternative to MuxPool (--pipeline async). Jobs go through three asyncio stages
+    # connected by bounded queues, each stage with its own concurrency limit:
+    #   metadata - batched ExifTool prefetch (pipelined over the ExifTool pool)
+    #   compose  - keyframe, XMP and image building (Muxer.compose)
+    #   write    - output write, copystat and deletes (Muxer.write)
+    # so one file is being written while the next ones are composed and their metadata read.
+    # The event loop runs in a background thread, submit() blocks while the first queue is full
+    # (or, with a memory budget, until the job's estimated memory fits).
+    # Output is printed in submission order, same as MuxPool.
+
+    def __init__(
+        self,
+        exiftool: ExifToolPool,
+        jobs: int = 1,
+        verbose: bool = False,
+        index: IncrementalIndex = None,
+        profiler: Profiler = None,
+        journal: Journal = None,
+        budget: MemoryBudget = None,
+        metadata_workers: int = 1,
+        compose_workers: int = None,
+        write_workers: int = None,
+        queue_size: int = None,
+    ):
+        workers = jobs if jobs > 0 else (os.cpu_count() or 1)
+        self.exiftool = exiftool
+        self.verbose = verbose
+        self.index = index
+        self.journal = journal
+        self.budget = budget
+        self.profiler = profiler if profiler is not None else Profiler()
+        self.workers = {
+            "metadata": metadata_workers,
+            "compose": compose_workers or workers,
+            "write": write_workers or workers,
+        }
+        self.queue_size = queue_size or 2 * max(self.workers.values())
+        self.muxed = 0
+        self.failed = 0
+        self.seq = 0
+        self.next_output = 0
+        self.results = {}
+
+        self.executor = ThreadPoolExecutor(max_workers=sum(self.workers.values()))
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.start(), self.loop).result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    async def start(self):
+        self.queues = {stage: asyncio.Queue(maxsize=self.queue_size) for stage in self.workers}
+        self.tasks = {
+            "metadata": [asyncio.ensure_future(self.metadata_stage()) for _ in range(self.workers["metadata"])],
+            "compose": [asyncio.ensure_future(self.compose_stage()) for _ in range(self.workers["compose"])],
+            "write": [asyncio.ensure_future(self.write_stage()) for _ in range(self.workers["write"])],
+        }
+
+    async def drain(self):
+        # Stops the stages one after another, once everything before them has been processed.
+        # Metadata workers take several jobs at once, so they share a single sentinel (see metadata_stage).
+        for stage in ("metadata", "compose", "write"):
+            for _ in (self.tasks[stage] if stage != "metadata" else [None]):
+                await self.queues[stage].put(None)
+            await asyncio.gather(*self.tasks[stage])
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def metadata_stage(self):
+        stop = False
+        while not stop:
+            job = await self.queues["metadata"].get()
+            if job is None:
+                # Put the sentinel back for the other workers (the slot was just freed, nothing awaits in between)
+                self.queues["metadata"].put_nowait(None)
+                break
+            batch = [job]
+            while len(batch) < PREFETCH_BATCH_SIZE and not self.queues["metadata"].empty():
+                job = self.queues["metadata"].get_nowait()
+                if job is None:
+                    self.queues["metadata"].put_nowait(None)
+                    stop = True
+                    break
+                batch.append(job)
+
+            missing = [
+                job for job in batch
+                if job.kwargs.get("image_metadata") is None or job.kwargs.get("video_metadata") is None
+            ]
+            fpaths = []
+            for job in missing:
+                fpaths += [job.kwargs["image_fpath"], job.kwargs["video_fpath"]]
+            try:
+                metadata = []
+                if fpaths:
+                    with self.profiler.span("prefetch"):
+                        metadata = await self.run(prefetch_metadata, self.exiftool, fpaths)
+            except Exception:
+                metadata = []  # let every Muxer read (and report) its own metadata
+            if len(metadata) == len(fpaths):
+                for i, job in enumerate(missing):
+                    job.kwargs["image_metadata"], job.kwargs["video_metadata"] = metadata[2 * i], metadata[2 * i + 1]
+
+            for job in batch:
+                await self.queues["compose"].put(job)
+
+    def job_logger(self, job: PipelineJob) -> logging.Logger:
+        # Private logger (not registered, not propagating to root) so every job's log can be
+        # replayed in order, while looking the same as the regular Muxer log
+        logger = logging.Logger(Path(job.kwargs["image_fpath"]).stem)
+        handler = logging.StreamHandler(job.output)
+        root_handlers = logging.getLogger().handlers
+        if root_handlers:
+            handler.setFormatter(root_handlers[0].formatter)
+        logger.addHandler(handler)
+        return logger
+
+    async def compose_stage(self):
+        while True:
+            job = await self.queues["compose"].get()
+            if job is None:
+                break
+            try:
+                job.muxer = await self.run(
+                    lambda: Muxer(exiftool=self.exiftool, logger=self.job_logger(job), profiler=self.profiler, **job.kwargs)
+                )
+                job.segments = await self.run(job.muxer.compose)
+            except SystemExit:
+                self.finish(job, False)
+                continue
+            except Exception:
+                job.output.write(traceback.format_exc())
+                self.finish(job, False)
+                continue
+            await self.queues["write"].put(job)
+
+    async def write_stage(self):
+        while True:
+            job = await self.queues["write"].get()
+            if job is None:
+                break
+            try:
+                output_fpath = await self.run(job.muxer.write, job.segments)
+            except SystemExit:
+                self.finish(job, False)
+                continue
+            except Exception:
+                job.output.write(traceback.format_exc())
+                self.finish(job, False)
+                continue
+            job.segments = None
+            self.finish(job, True, output_fpath)
+
+    def finish(self, job: PipelineJob, ok: bool, output_fpath: str = None):
+        # Runs in the event loop thread only
+        if self.budget is not None and job.memory:
+            self.budget.release(job.memory)
+            job.memory = 0
+        if self.journal is not None and ok is not None:
+            # Journaled right away, printing waits for the jobs submitted before this one
+            if ok:
+                self.journal.done(job.kwargs["image_fpath"], job.kwargs["video_fpath"], output_fpath)
+            else:
+                self.journal.failed(job.kwargs["image_fpath"], job.kwargs["video_fpath"])
+        self.results[job.seq] = (job, ok, output_fpath)
+        while self.next_output in self.results:
+            job, ok, output_fpath = self.results.pop(self.next_output)
+            self.next_output += 1
+            if job.header is not None:
+                print(job.header)
+            print(job.output.getvalue(), end="")
+            if ok is True:
+                self.muxed += 1
+                if self.index is not None:
+                    self.index.record(
+                        job.kwargs["image_fpath"],
+                        job.kwargs["video_fpath"],
+                        output_fpath,
+                        (job.kwargs.get("image_metadata") or {}).get("MakerNotes:ContentIdentifier"),
+                    )
+            elif ok is False:
+                self.failed += 1
+
+    def echo(self, message: str):
+        job = PipelineJob(self.seq, None)
+        self.seq += 1
+        job.output.write(message + "\n")
+        self.loop.call_soon_threadsafe(self.finish, job, None)
+
+    def skip(self, file: str, reason: str, message: str):
+        # The reason only matters to a plan (see PlanWriter)
+        self.echo(message)
+
+    def submit(self, header: str, **kwargs):
+        if self.journal is not None:
+            self.journal.planned(kwargs["image_fpath"], kwargs["video_fpath"], kwargs.get("output_directory"))
+        job = PipelineJob(self.seq, header, kwargs)
+        self.seq += 1
+        if self.budget is not None:
+            # Blocks until jobs in flight finished and freed enough of the budget
+            job.memory = estimate_mux_memory(kwargs["image_fpath"], kwargs["video_fpath"], kwargs.get("stream_threshold"))
+            self.budget.acquire(job.memory)
+        asyncio.run_coroutine_threadsafe(self.queues["metadata"].put(job), self.loop).result()
+
+    def close(self):
+        if self.thread is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.drain(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.thread = None
+        self.executor.shutdown()
+        self.loop.close()
+
+    def summary(self) -> str:
+        return f"Muxed {self.muxed} file(s), {self.failed} failed"
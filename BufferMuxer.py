@@ -0,0 +1,122 @@
+import io
+import logging
+
+from lxml import etree
+
+from utils import (
+    file_type_extension,
+    read_image_xmp,
+    read_still_image_time_from_file,
+    write_segments,
+    segment_size,
+)
+
+import constants as const
+from Muxer import Muxer
+from Profiler import Profiler
+
+
+def read_buffer(data, name: str):
+    # bytes-like objects are used as they are, file objects are read from the start
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return data
+    if hasattr(data, "read") and hasattr(data, "seek"):
+        data.seek(0)
+        return data.read()
+    raise TypeError(f"{name} must be bytes-like or a seekable file object, not {type(data).__name__}")
+
+
+class BufferMuxer(Muxer):
+
+    # Muxes an image and a video held in memory, for services that already have both as bytes.
+    # Nothing touches the file system and nothing calls ExifTool: the file types and the XMP are read
+    # natively unless passed in as metadata (same keys as prefetch_metadata). Errors are raised as
+    # ValueError/TypeError instead of exiting. The video is not copied, it becomes one of the output
+    # buffers (memoryview of the input).
+    #
+    #   segments = BufferMuxer(image_bytes, video_bytes).mux()         # list of buffers
+    #   size = BufferMuxer(image_file, video_file).mux(output_stream)  # written to any writable stream
+
+    def __init__(
+        self,
+        image,
+        video,
+        image_name: str = None,
+        video_name: str = None,
+        no_xmp: bool = False,
+        verbose: bool = False,
+        image_metadata: dict = None,
+        video_metadata: dict = None,
+        logger: logging.Logger = None,
+        profiler: Profiler = None,
+    ):
+        # Muxer.__init__ is not called, it validates and derives file paths
+        self.logger = logger if logger is not None else logging.getLogger("BufferMuxer")
+        self.verbose = verbose
+        if logger is None:
+            self.logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+
+        self.image = read_buffer(image, "Image")
+        self.video = memoryview(read_buffer(video, "Video")).cast("B")
+        if not self.image:
+            raise ValueError("Image is empty")
+        if not self.video:
+            raise ValueError("Video is empty")
+
+        image_type = file_type_extension(self.image[:16])
+        video_type = file_type_extension(self.video[:16])
+        # Names are only used for the file type (when there is no metadata) and logging
+        self.image_fpath = image_name or f"image.{image_type or 'jpg'}"
+        self.video_fpath = video_name or f"video.{video_type or 'mov'}"
+        self.output_fpath = self.image_fpath
+        self.image_type = image_type
+        self.video_type = video_type
+
+        self.no_xmp = no_xmp
+        self.exiftool = None
+        self.image_metadata = image_metadata
+        self.video_metadata = video_metadata
+        self.profiler = profiler if profiler is not None else Profiler()
+        self.stream_threshold = None  # everything is in memory already
+        self.xmp = etree.fromstring(const.XMP)
+
+    def read_image(self) -> bytes:
+        return bytes(self.image)
+
+    def video_range(self) -> memoryview:
+        return self.video
+
+    def still_image_time(self) -> tuple:
+        return read_still_image_time_from_file(io.BytesIO(self.video))
+
+    def read_metadata(self) -> tuple:
+        image_metadata = self.image_metadata
+        if image_metadata is None:
+            with self.span("metadata"):
+                image_metadata = {"XMP:XMP": None if self.no_xmp else read_image_xmp(io.BytesIO(self.image))}
+                if self.image_type is not None:
+                    image_metadata["File:FileTypeExtension"] = self.image_type
+        video_metadata = self.video_metadata
+        if video_metadata is None:
+            video_metadata = {}
+            if self.video_type is not None:
+                video_metadata["File:FileTypeExtension"] = self.video_type
+        return image_metadata, video_metadata
+
+    def fix_output_fpath(self, metadata: dict = None):
+        pass
+
+    def fallback_xmp(self, error: ValueError) -> list:
+        # There is no ExifTool to fall back to
+        self.logger.warning("Could not write XMP directly (%s), rejecting the upload", error)
+        raise ValueError(f"Could not write XMP to {self.image_fpath} natively: {error}")
+
+    def mux(self, stream=None):
+        # Returns the output as a list of buffers, or writes it to stream and returns its size
+        segments = self.compose()
+        if stream is None:
+            return segments
+        size = sum(segment_size(segment) for segment in segments)
+        with self.span("write", size):
+            write_segments(stream, segments)
+        return size
@@ -0,0 +1,90 @@
+import os
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from Profiler import Profiler
+from utils import copy_file, same_file_stat
+
+# Copying is I/O bound, a few threads keep the disk queue full even with --jobs 1
+COPY_JOBS = 4
+
+
+class CopyPool:
+
+    # Copies the files left over by muxing (unmatched images and videos, unsupported files)
+    # to the output directory, preserving the directory structure. Files are copied in a thread
+    # pool as soon as they are known to be unmuxed, so copying overlaps with muxing.
+    # Up-to-date copies are detected from stat (size and modification time) only.
+    # Output is printed in submission order by close().
+
+    def __init__(
+        self,
+        input_directory: str,
+        output_directory: str,
+        mode: str = "reflink",
+        jobs: int = COPY_JOBS,
+        verbose: bool = False,
+        profiler: Profiler = None,
+    ):
+        self.input_directory = Path(input_directory)
+        self.output_directory = Path(output_directory).resolve()
+        self.mode = mode
+        self.verbose = verbose
+        self.profiler = profiler if profiler is not None else Profiler()
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.pending = []
+        self.copied = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def submit(self, file: str):
+        self.pending.append((file, self.executor.submit(self.copy, file)))
+
+    def copy(self, file: str) -> tuple:
+        # Returns (status, method or error)
+        source = self.input_directory / file
+        output_subdirectory = self.output_directory / Path(file).parent
+        dst = output_subdirectory / Path(file).name
+        try:
+            with self.profiler.span("copy", str(source)) as span:
+                if same_file_stat(source, dst):
+                    return "skipped", None
+                output_subdirectory.mkdir(parents=True, exist_ok=True)
+                method = copy_file(source, dst, self.mode)
+                span["bytes"] = os.path.getsize(source)
+                return "copied", method
+        except OSError:
+            return "failed", traceback.format_exc()
+
+    def report(self, file: str, status: str, detail: str):
+        if status == "copied":
+            self.copied += 1
+            print(f"Copying {file} to {self.output_directory / Path(file).parent}" + (f" ({detail})" if self.verbose else ""))
+        elif status == "skipped":
+            self.skipped += 1
+            if self.verbose:
+                print(f"[DEBUG][WARNING] File {file} already exists in output directory, skipping...")
+        else:
+            self.failed += 1
+            print(f"[ERROR] Could not copy {file}")
+            print(detail, end="")
+
+    def close(self):
+        if self.executor is None:
+            return
+        for file, future in self.pending:
+            self.report(file, *future.result())
+        self.pending = []
+        self.executor.shutdown()
+        self.executor = None
+
+    def summary(self) -> str:
+        return f"Copied {self.copied} file(s), {self.skipped} up to date, {self.failed} failed"
@@ -0,0 +1,156 @@
+import logging
+import os
+import shutil
+
+from pathlib import Path
+from lxml import etree
+
+from utils import (
+    find_embedded_video,
+    image_xmp_range,
+    still_image_end,
+    write_segments,
+    FileRange,
+)
+
+import constants as const
+from Profiler import Profiler
+
+
+class Demuxer:
+
+    # Splits a motion photo back into the still image and the video.
+    # The video and the end of the still image are located natively (XMP Container/GCamera offsets,
+    # Samsung SEFH/SEFT trailer, HEIC mpvd box) and both files are written with ranged copies
+    # (copy_file_range/sendfile where possible), so nothing but the XMP passes through Python.
+    # The MotionPhoto XMP is removed in place and padded to its original size,
+    # so no offsets inside the image (MPF, iloc) change.
+
+    def __init__(
+        self,
+        image_fpath: str,
+        output_directory: str,
+        verbose: bool = False,
+        logger: logging.Logger = None,
+        profiler: Profiler = None,
+    ):
+        self.logger = logger if logger is not None else logging.getLogger(Path(image_fpath).stem)
+        self.logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+        self.image_fpath = f"{Path(image_fpath).resolve()}"
+        self.output_directory = f"{Path(output_directory).resolve()}"
+        self.profiler = profiler if profiler is not None else Profiler()
+
+        if os.path.isfile(self.image_fpath) is False:
+            raise ValueError(f"Image file {self.image_fpath} doesn't exist")
+
+    def strip_xmp(self, xmp: bytes) -> bytes:
+        # Returns the XMP without the motion photo properties and the MotionPhoto directory item,
+        # padded to the original length, or None when there is nothing to remove (or it doesn't fit)
+        try:
+            root = etree.fromstring(xmp.strip(b"\x00 \t\r\n"))
+        except etree.XMLSyntaxError:
+            self.logger.warning("Could not parse XMP, keeping it unchanged")
+            return None
+
+        changed = False
+        for description in root.iterfind(".//rdf:Description", const.NAMESPACES):
+            for name in const.MOTION_PHOTO_XMP_PROPERTIES:
+                if description.attrib.pop(name, None) is not None:
+                    changed = True
+                for child in description.findall(name):
+                    description.remove(child)
+                    changed = True
+            for directory in description.findall(const.CONTAINER_DIRECTORY):
+                seq = directory.find("rdf:Seq", const.NAMESPACES)
+                items = seq.findall("rdf:li", const.NAMESPACES) if seq is not None else []
+                for li in items:
+                    item = li.find("Container:Item", const.NAMESPACES)
+                    item = item if item is not None else li
+                    semantic = item.attrib.get(const.ITEM_SEMANTIC)
+                    if semantic is None and item.find(const.ITEM_SEMANTIC) is not None:
+                        semantic = item.find(const.ITEM_SEMANTIC).text
+                    if semantic == "MotionPhoto":
+                        seq.remove(li)
+                        changed = True
+                if changed and len(seq.findall("rdf:li", const.NAMESPACES)) <= 1:
+                    # Only the primary image is left, the directory has no purpose
+                    description.remove(directory)
+        if not changed:
+            return None
+
+        body = etree.tostring(root)
+        if xmp.lstrip().startswith(b"<?xpacket"):
+            stripped = const.XPACKET_BEGIN + body + b"\n" + const.XPACKET_END
+        else:
+            stripped = body
+        if len(stripped) > len(xmp):
+            self.logger.warning("Stripped XMP doesn't fit in place, keeping it unchanged")
+            return None
+        # XMP packets are padded with whitespace in front of the trailer, which is what leaves room for edits
+        padding = b" " * (len(xmp) - len(stripped))
+        if stripped.endswith(const.XPACKET_END):
+            return stripped[:-len(const.XPACKET_END)] + padding + const.XPACKET_END
+        return stripped + padding
+
+    def video_fpath(self, video: FileRange) -> str:
+        with open(self.image_fpath, "rb") as f:
+            f.seek(video.offset)
+            header = f.read(12)
+        extension = ".mov" if header[8:12] == b"qt  " else ".mp4"
+        image_path = Path(self.image_fpath)
+        if image_path.suffix.isupper():
+            extension = extension.upper()
+        return os.path.join(self.output_directory, image_path.stem + extension)
+
+    def demux(self) -> tuple:
+        # Returns paths of the written image and video
+        with self.profiler.span("locate", self.image_fpath):
+            video = find_embedded_video(self.image_fpath)
+            if video is None:
+                raise ValueError(f"{self.image_fpath} is not a motion photo")
+            with open(self.image_fpath, "rb") as f:
+                f.seek(0, os.SEEK_END)
+                image_end = still_image_end(f, f.tell(), video)
+                xmp_range = image_xmp_range(f)
+                xmp = None
+                if xmp_range is not None and xmp_range[0] + xmp_range[1] <= image_end:
+                    f.seek(xmp_range[0])
+                    xmp = self.strip_xmp(f.read(xmp_range[1]))
+
+        if xmp is not None:
+            image_segments = [
+                FileRange(self.image_fpath, 0, xmp_range[0]),
+                xmp,
+                FileRange(self.image_fpath, xmp_range[0] + xmp_range[1], image_end - xmp_range[0] - xmp_range[1]),
+            ]
+        else:
+            image_segments = [FileRange(self.image_fpath, 0, image_end)]
+
+        image_output = os.path.join(self.output_directory, os.path.basename(self.image_fpath))
+        video_output = self.video_fpath(video)
+        if image_output == self.image_fpath:
+            raise ValueError("Output directory cannot be the same as input directory")
+
+        os.makedirs(self.output_directory, exist_ok=True)
+        self.logger.debug("Writing still image: %s", image_output)
+        with self.profiler.span("write", self.image_fpath, image_end):
+            with open(image_output, "wb") as binary_file:
+                write_segments(binary_file, image_segments)
+            shutil.copystat(self.image_fpath, image_output)
+
+        self.logger.debug("Writing video: %s", video_output)
+        with self.profiler.span("write", self.image_fpath, video.length):
+            with open(video_output, "wb") as binary_file:
+                write_segments(binary_file, [video])
+            shutil.copystat(self.image_fpath, video_output)
+
+        return image_output, video_output
+
+
+def demux_file(kwargs: dict) -> tuple:
+    # Thread pool entry point, returns (ok, image output or error message, video output)
+    try:
+        image_output, video_output = Demuxer(**kwargs).demux()
+        return True, image_output, video_output
+    except (OSError, ValueError) as e:
+        return False, str(e), None
@@ -0,0 +1,321 @@
+import collections
+import itertools
+import json
+import logging
+import os
+import random
+import subprocess
+import threading
+import time
+
+from concurrent.futures import Future
+
+from exiftool.constants import DEFAULT_EXECUTABLE
+from exiftool.exceptions import ExifToolExecuteError
+
+# Seconds one command may run once it is first in its process' queue
+COMMAND_TIMEOUT = 30.0
+# Times a command is resent after its ExifTool hung or crashed on it
+COMMAND_RETRIES = 1
+# How often the watchdog checks for hung commands
+WATCHDOG_INTERVAL = 0.5
+# Seconds to wait for ExifTool to exit after -stay_open False
+TERMINATE_TIMEOUT = 5.0
+
+
+class ExifToolCommand:
+    def __init__(self, seq: int, params: list, raw_bytes: bool):
+        self.seq = seq
+        self.params = params
+        self.raw_bytes = raw_bytes
+        self.future = Future()
+        self.attempts = 0
+        self.stdout = None
+        self.stderr = None
+        self.status = None
+
+
+class ExifToolProcess:
+
+    # One exiftool -stay_open process. Commands are written as soon as they are submitted, without
+    # waiting for the previous replies (pipelining); replies are read by one thread per stream and
+    # matched to the commands in order by their sequence number, the same framing PyExifTool uses
+    # ({readyN} on stdout, -echo4 with the exit status on stderr).
+
+    def __init__(self, pool, executable: str, common_args: list):
+        self.pool = pool
+        self.process = subprocess.Popen(
+            [executable, "-stay_open", "True", "-@", "-", "-common_args", *common_args],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0),
+        )
+        self.lock = threading.Lock()
+        self.pending = collections.deque()  # sent, waiting for the reply
+        self.awaiting = {"stdout": collections.deque(), "stderr": collections.deque()}
+        self.head_since = time.monotonic()  # when the first pending command started running
+        self.timed_out = False
+        self.retired = False
+        self.readers = [
+            threading.Thread(target=self.read, args=(self.process.stdout, "stdout"), daemon=True),
+            threading.Thread(target=self.read, args=(self.process.stderr, "stderr"), daemon=True),
+        ]
+        for reader in self.readers:
+            reader.start()
+
+    def send(self, command: ExifToolCommand):
+        data = b"\n".join(command.params + [
+            b"-echo4",
+            b"=${status}=post%d" % command.seq,
+            b"-execute%d\n" % command.seq,
+        ])
+        with self.lock:
+            if not self.pending:
+                self.head_since = time.monotonic()
+            self.pending.append(command)
+            self.awaiting["stdout"].append(command)
+            self.awaiting["stderr"].append(command)
+        try:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+        except OSError:
+            pass  # the process died, the readers hit EOF and the pool resends the command
+
+    def read(self, stream, name: str):
+        buffer = bytearray()
+        searched = 0  # the marker isn't in buffer[:searched]
+        skip_newline = False  # every marker is followed by a line break
+        while True:
+            chunk = stream.read1(64 * 1024)
+            if not chunk:
+                break
+            buffer += chunk
+            while True:
+                if skip_newline:
+                    if buffer[:2] == b"\r\n":
+                        del buffer[:2]
+                    elif buffer[:1] == b"\n":
+                        del buffer[:1]
+                    elif buffer in (b"", b"\r"):
+                        break
+                    skip_newline = False
+                with self.lock:
+                    command = self.awaiting[name][0] if self.awaiting[name] else None
+                if command is None:
+                    break
+                marker = b"{ready%d}" % command.seq if name == "stdout" else b"=post%d" % command.seq
+                end = buffer.find(marker, searched)
+                if end == -1:
+                    searched = max(0, len(buffer) - len(marker))
+                    break
+                reply = bytes(buffer[:end])
+                del buffer[:end + len(marker)]
+                searched = 0
+                skip_newline = True
+                self.completed(command, name, reply)
+        self.pool.recover(self)
+
+    def completed(self, command: ExifToolCommand, name: str, reply: bytes):
+        with self.lock:
+            self.awaiting[name].popleft()
+            if name == "stdout":
+                command.stdout = reply
+            else:
+                reply, _, status = reply.rpartition(b"=")
+                command.stderr, command.status = reply, int(status) if status.strip().isdigit() else -1
+            if command.stdout is None or command.stderr is None or command not in self.pending:
+                return
+            self.pending.remove(command)
+            self.head_since = time.monotonic()
+        self.pool.resolve(command)
+
+    def hung(self, timeout: float) -> bool:
+        with self.lock:
+            return bool(self.pending) and time.monotonic() - self.head_since > timeout
+
+    def kill(self):
+        self.timed_out = True
+        self.process.kill()
+
+    def drain(self) -> list:
+        with self.lock:
+            commands = list(self.pending)
+            self.pending.clear()
+            self.awaiting["stdout"].clear()
+            self.awaiting["stderr"].clear()
+        return commands
+
+    def terminate(self):
+        try:
+            self.process.stdin.write(b"-stay_open\nFalse\n")
+            self.process.stdin.flush()
+            self.process.stdin.close()
+            self.process.wait(TERMINATE_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+
+
+class ExifToolPool:
+
+    # Runs `processes` exiftool -stay_open processes and spreads commands over them, pipelining
+    # several commands per process. A watchdog kills a process whose current command runs longer than
+    # `timeout`; a killed or crashed process is restarted and its unanswered commands are resent
+    # (the one it was working on up to `retries` times, then it fails with TimeoutError/OSError).
+    # Thread safe. Offers the part of ExifToolHelper's interface used here (execute, execute_json,
+    # get_tags, get_metadata), where get_tags sends one command per file, so a bad file only
+    # delays itself, and a file that can't be read is logged and returned as an empty dict instead
+    # of failing the whole batch. Processes are started by the first command, like
+    # ExifToolHelper(auto_start=True).
+
+    def __init__(
+        self,
+        processes: int = 1,
+        timeout: float = COMMAND_TIMEOUT,
+        retries: int = COMMAND_RETRIES,
+        executable: str = DEFAULT_EXECUTABLE,
+        common_args: list = None,
+        encoding: str = "utf-8",
+        logger: logging.Logger = None,
+    ):
+        self.size = max(1, processes)
+        self.timeout = timeout
+        self.retries = retries
+        self.executable = executable
+        self.common_args = ["-G", "-n"] if common_args is None else list(common_args)
+        self.encoding = encoding
+        self.logger = logger if logger is not None else logging.getLogger("ExifTool")
+        self.processes = []
+        self.lock = threading.Lock()
+        self.sequence = itertools.count(random.randint(100000, 999999))
+        self.stopped = threading.Event()
+        self.watchdog = None
+        self.restarts = 0
+
+    def __enter__(self):
+        self.run()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.terminate()
+
+    @property
+    def running(self) -> bool:
+        return bool(self.processes)
+
+    def run(self):
+        with self.lock:
+            if self.processes:
+                return
+            self.stopped.clear()
+            self.processes = [ExifToolProcess(self, self.executable, self.common_args) for _ in range(self.size)]
+            self.watchdog = threading.Thread(target=self.watch, daemon=True)
+            self.watchdog.start()
+
+    def terminate(self):
+        with self.lock:
+            processes, self.processes = self.processes, []
+            self.stopped.set()
+        for process in processes:
+            process.retired = True
+            process.terminate()
+        for process in processes:
+            for command in process.drain():
+                command.future.set_exception(OSError("ExifTool was terminated"))
+
+    def submit(self, *params, raw_bytes: bool = False) -> Future:
+        # Sends the command right away and returns a Future of its stdout (str, or bytes with raw_bytes)
+        command = ExifToolCommand(
+            next(self.sequence),
+            [p if isinstance(p, bytes) else str(p).encode(self.encoding) for p in params],
+            raw_bytes,
+        )
+        self.dispatch(command)
+        return command.future
+
+    def dispatch(self, command: ExifToolCommand):
+        if not self.processes:
+            self.run()
+        with self.lock:
+            if not self.processes:
+                command.future.set_exception(OSError("ExifTool is not running"))
+                return
+            process = min(self.processes, key=lambda p: len(p.pending))
+        process.send(command)
+
+    def resolve(self, command: ExifToolCommand):
+        if command.status != 0:
+            command.future.set_exception(ExifToolExecuteError(
+                command.status,
+                command.stdout.decode(self.encoding, "replace"),
+                command.stderr.decode(self.encoding, "replace"),
+                [p.decode(self.encoding, "replace") for p in command.params],
+            ))
+        elif command.raw_bytes:
+            command.future.set_result(command.stdout)
+        else:
+            command.future.set_result(command.stdout.decode(self.encoding))
+
+    def watch(self):
+        while not self.stopped.wait(WATCHDOG_INTERVAL):
+            with self.lock:
+                processes = list(self.processes)
+            for process in processes:
+                if process.hung(self.timeout):
+                    self.logger.warning("ExifTool did not answer in %gs, restarting it", self.timeout)
+                    process.kill()
+
+    def recover(self, process: ExifToolProcess):
+        # Called by a reader when its process exited: restart it and resend what it didn't answer
+        with self.lock:
+            if process.retired:
+                return
+            process.retired = True
+            commands = process.drain()
+            if process in self.processes and not self.stopped.is_set():
+                self.processes[self.processes.index(process)] = ExifToolProcess(self, self.executable, self.common_args)
+                self.restarts += 1
+        if not process.timed_out:
+            self.logger.warning("ExifTool exited unexpectedly, restarting it")
+        process.process.wait()
+        if not commands:
+            return
+        # The first unanswered command is the one the process was working on
+        commands[0].attempts += 1
+        for command in commands:
+            if command.attempts > self.retries:
+                params = " ".join(p.decode(self.encoding, "replace") for p in command.params)
+                if process.timed_out:
+                    command.future.set_exception(TimeoutError(f"ExifTool timed out on: {params}"))
+                else:
+                    command.future.set_exception(OSError(f"ExifTool crashed on: {params}"))
+            else:
+                command.stdout = command.stderr = command.status = None
+                self.dispatch(command)
+
+    def execute(self, *params, raw_bytes: bool = False):
+        return self.submit(*params, raw_bytes=raw_bytes).result()
+
+    def execute_json(self, *params) -> list:
+        return json.loads(self.execute("-j", *params) or "[]")
+
+    def get_tags(self, files, tags, params: list = None) -> list:
+        files = [files] if isinstance(files, (str, os.PathLike)) else list(files)
+        tags = [tags] if isinstance(tags, str) else list(tags or [])
+        futures = [
+            self.submit("-j", *(params or []), *["-" + tag for tag in tags], str(file))
+            for file in files
+        ]
+        result = []
+        for file, future in zip(files, futures):
+            try:
+                result += json.loads(future.result() or "[]")
+            except (OSError, ValueError, ExifToolExecuteError) as e:
+                # Hung, crashed or missing: only this file has no metadata
+                self.logger.error("Could not read metadata of %s: %s", file, e)
+                result.append({})
+        return result
+
+    def get_metadata(self, files, params: list = None) -> list:
+        return self.get_tags(files, None, params)
@@ -0,0 +1,64 @@
+import re
+
+from pathlib import PurePath
+
+import constants as const
+
+
+class FilenameMatcher:
+
+    # Matches images to videos by file name in O(1) per image.
+    # Videos are indexed once by (directory, case-folded stem) plus the stems produced by
+    # the enabled pairing rules. An exact stem match always wins over a rule match: when the
+    # images of the directory are given, a video matching one of them exactly is never taken by
+    # a rule match of another image, whichever of the two is matched first.
+
+    def __init__(self, videos: list, rules: list = None, images: list = None):
+        self.rules = [
+            (re.compile(const.FILENAME_PAIRING_RULES[rule][0], re.IGNORECASE), const.FILENAME_PAIRING_RULES[rule][1])
+            for rule in (rules or [])
+        ]
+        self.videos = videos
+        self.exact = {}
+        self.normalized = {}
+        self.used = set()
+        for video in videos:
+            key, normalized = self.keys(video)
+            self.exact.setdefault(key, []).append(video)
+            if normalized != key:
+                self.normalized.setdefault(normalized, []).append(video)
+        for table in (self.exact, self.normalized):
+            for candidates in table.values():
+                candidates.sort(key=self.extension_priority)
+        self.claimed = set()
+        for image in images or []:
+            self.claimed.update(self.exact.get(self.keys(image)[0], []))
+
+    @staticmethod
+    def extension_priority(fpath: str) -> int:
+        extension = PurePath(fpath).suffix.lower()
+        if extension in const.VIDEO_EXTENSIONS:
+            return const.VIDEO_EXTENSIONS.index(extension)
+        return len(const.VIDEO_EXTENSIONS)
+
+    def keys(self, fpath: str) -> tuple:
+        path = PurePath(fpath)
+        stem = path.stem
+        normalized = stem
+        for pattern, replacement in self.rules:
+            normalized = pattern.sub(replacement, normalized)
+        return (str(path.parent), stem.casefold()), (str(path.parent), normalized.casefold())
+
+    def match(self, image: str) -> str:
+        # Returns the matching video and marks it as used, or None
+        key, normalized = self.keys(image)
+        for table, lookup in ((self.exact, key), (self.exact, normalized), (self.normalized, key), (self.normalized, normalized)):
+            exact = table is self.exact and lookup == key
+            for video in table.get(lookup, []):
+                if video not in self.used and (exact or video not in self.claimed):
+                    self.used.add(video)
+                    return video
+        return None
+
+    def unmatched(self) -> list:
+        return [video for video in self.videos if video not in self.used]
@@ -0,0 +1,405 @@
+import struct
+
+XMP_CONTENT_TYPE = b"application/rdf+xml"
+
+
+def read_boxes(data: bytes, start: int, end: int) -> list:
+    # Returns (type, start, payload start, end) of every ISOBMFF box in data[start:end]
+    boxes = []
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack(">I4s", data[pos:pos + 8])
+        header_size = 8
+        if size == 1:
+            if pos + 16 > end:
+                raise ValueError(f"Truncated box header at offset {pos}")
+            (size,) = struct.unpack(">Q", data[pos + 8:pos + 16])
+            header_size = 16
+        elif size == 0:
+            size = end - pos
+        if size < header_size or pos + size > end:
+            raise ValueError(f"Invalid size of box {box_type} at offset {pos}")
+        boxes.append((box_type, pos, pos + header_size, pos + size))
+        pos += size
+    return boxes
+
+
+def box(box_type: bytes, payload: bytes) -> bytes:
+    if len(payload) + 8 > 0xFFFFFFFF:
+        return struct.pack(">I4sQ", 1, box_type, len(payload) + 16) + payload
+    return struct.pack(">I4s", len(payload) + 8, box_type) + payload
+
+
+def full_box(box_type: bytes, version: int, flags: int, payload: bytes) -> bytes:
+    return box(box_type, struct.pack(">I", (version << 24) | flags) + payload)
+
+
+def read_uint(data: bytes, pos: int, size: int) -> tuple:
+    if size == 0:
+        return 0, pos
+    return int.from_bytes(data[pos:pos + size], "big"), pos + size
+
+
+def write_uint(value: int, size: int) -> bytes:
+    if size == 0:
+        return b""
+    return value.to_bytes(size, "big")
+
+
+def uint_size(value: int, size: int) -> int:
+    # Smallest ISOBMFF field size (0, 4 or 8) that is at least size and can hold value
+    for candidate in (0, 4, 8):
+        if candidate >= size and value < (1 << (candidate * 8)) and (candidate > 0 or value == 0):
+            return candidate
+    raise ValueError(f"Value {value} doesn't fit into 64 bits")
+
+
+class HeifFile:
+
+    # Minimal ISOBMFF (HEIC/HEIF/AVIF) editor used to read and replace the XMP item
+    # without round-tripping the image through ExifTool.
+    # The XMP is the item describing the primary image (cdsc reference), XMP of other items (gain
+    # maps, thumbnails) is left alone. It is stored in idat of the meta box (replacing the previous
+    # one, or overwriting it in place when it is in mdat and the new one fits, else the old one is
+    # zeroed), all file offsets in iloc pointing behind the meta box are shifted by the change of its size.
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.boxes = read_boxes(data, 0, len(data))
+        if not self.boxes or self.boxes[0][0] != b"ftyp":
+            raise ValueError("Not an ISOBMFF file")
+        self.meta = self.find(self.boxes, b"meta")
+        if self.meta is None:
+            raise ValueError("No meta box found")
+        # version and flags of meta
+        self.children = read_boxes(data, self.meta[2] + 4, self.meta[3])
+
+        pitm = self.find(self.children, b"pitm")
+        if pitm is None:
+            raise ValueError("No primary item found")
+        version = data[pitm[2]]
+        self.primary_item = read_uint(data, pitm[2] + 4, 2 if version == 0 else 4)[0]
+
+        self.items = self.parse_iinf()
+        self.iloc_version, self.iloc_sizes, self.locations = self.parse_iloc()
+        self.references = self.parse_iref()
+        idat = self.find(self.children, b"idat")
+        self.idat = data[idat[2]:idat[3]] if idat is not None else b""
+        self.idat_start = idat[2] if idat is not None else None
+
+    @staticmethod
+    def find(boxes: list, box_type: bytes) -> tuple:
+        for item in boxes:
+            if item[0] == box_type:
+                return item
+        return None
+
+    def parse_iinf(self) -> dict:
+        # item_ID -> (item_type, content_type)
+        iinf = self.find(self.children, b"iinf")
+        if iinf is None:
+            raise ValueError("No iinf box found")
+        version = self.data[iinf[2]]
+        pos = iinf[2] + 4 + (2 if version == 0 else 4)
+        items = {}
+        for infe in read_boxes(self.data, pos, iinf[3]):
+            if infe[0] != b"infe":
+                continue
+            version = self.data[infe[2]]
+            if version < 2:
+                item_id = read_uint(self.data, infe[2] + 4, 2)[0]
+                items[item_id] = (None, None)
+                continue
+            pos = infe[2] + 4
+            item_id, pos = read_uint(self.data, pos, 2 if version == 2 else 4)
+            pos += 2  # item_protection_index
+            item_type = self.data[pos:pos + 4]
+            pos += 4
+            pos = self.data.index(b"\x00", pos, infe[3]) + 1  # item_name
+            content_type = None
+            if item_type == b"mime":
+                content_type = self.data[pos:self.data.index(b"\x00", pos, infe[3])]
+            items[item_id] = (item_type, content_type)
+        return items
+
+    def parse_iloc(self) -> tuple:
+        iloc = self.find(self.children, b"iloc")
+        if iloc is None:
+            raise ValueError("No iloc box found")
+        data = self.data
+        pos = iloc[2]
+        version = data[pos]
+        if version > 2:
+            raise ValueError(f"Unsupported iloc version {version}")
+        pos += 4
+        offset_size, length_size = data[pos] >> 4, data[pos] & 0x0F
+        base_offset_size = data[pos + 1] >> 4
+        index_size = data[pos + 1] & 0x0F if version in (1, 2) else 0
+        pos += 2
+        item_count, pos = read_uint(data, pos, 2 if version < 2 else 4)
+        locations = {}
+        for _ in range(item_count):
+            item_id, pos = read_uint(data, pos, 2 if version < 2 else 4)
+            construction_method = 0
+            if version in (1, 2):
+                construction_method, pos = read_uint(data, pos, 2)
+                construction_method &= 0x0F
+            data_reference_index, pos = read_uint(data, pos, 2)
+            base_offset, pos = read_uint(data, pos, base_offset_size)
+            extent_count, pos = read_uint(data, pos, 2)
+            extents = []
+            for _ in range(extent_count):
+                index, pos = read_uint(data, pos, index_size)
+                offset, pos = read_uint(data, pos, offset_size)
+                length, pos = read_uint(data, pos, length_size)
+                extents.append([index, offset, length])
+            locations[item_id] = {
+                "construction_method": construction_method,
+                "data_reference_index": data_reference_index,
+                "base_offset": base_offset,
+                "extents": extents,
+            }
+        return version, [offset_size, length_size, base_offset_size, index_size], locations
+
+    def parse_iref(self) -> list:
+        # (reference_type, from_item_ID, [to_item_IDs])
+        iref = self.find(self.children, b"iref")
+        if iref is None:
+            return []
+        version = self.data[iref[2]]
+        id_size = 2 if version == 0 else 4
+        references = []
+        for reference in read_boxes(self.data, iref[2] + 4, iref[3]):
+            pos = reference[2]
+            from_id, pos = read_uint(self.data, pos, id_size)
+            count, pos = read_uint(self.data, pos, 2)
+            to_ids = []
+            for _ in range(count):
+                to_id, pos = read_uint(self.data, pos, id_size)
+                to_ids.append(to_id)
+            references.append((reference[0], from_id, to_ids))
+        return references
+
+    def xmp_item(self) -> int:
+        # The XMP item describing the primary image, None when it has none
+        described = {
+            from_id
+            for reference_type, from_id, to_ids in self.references
+            if reference_type == b"cdsc" and self.primary_item in to_ids
+        }
+        for item_id, (item_type, content_type) in self.items.items():
+            if item_type == b"mime" and content_type == XMP_CONTENT_TYPE and item_id in described:
+                return item_id
+        return None
+
+    def read_item(self, item_id: int, f=None) -> bytes:
+        # File offsets are read from f when given, so data doesn't need to hold more than the meta box
+        location = self.locations.get(item_id)
+        if location is None or location["data_reference_index"] != 0:
+            return None
+        result = b""
+        for index, offset, length in location["extents"]:
+            start = location["base_offset"] + offset
+            if location["construction_method"] == 0 and f is not None:
+                f.seek(start)
+                result += f.read(length)
+            elif location["construction_method"] == 0:
+                result += self.data[start:start + length]
+            elif location["construction_method"] == 1:
+                result += self.idat[start:start + length]
+            else:
+                return None
+        return result
+
+    def item_range(self, item_id: int) -> tuple:
+        # (file offset, length) of an item stored in a single extent, None otherwise
+        location = self.locations.get(item_id)
+        if location is None or location["data_reference_index"] != 0 or len(location["extents"]) != 1:
+            return None
+        index, offset, length = location["extents"][0]
+        start = location["base_offset"] + offset
+        if location["construction_method"] == 0:
+            return start, length
+        if location["construction_method"] == 1 and self.idat_start is not None:
+            return self.idat_start + start, length
+        return None
+
+    def own_extent(self, item_id: int) -> tuple:
+        # (construction_method, start, length) of an item stored in a single extent (in the file or
+        # in idat) that no other item shares, None otherwise
+        location = self.locations.get(item_id)
+        if (
+            location is None
+            or location["data_reference_index"] != 0
+            or location["construction_method"] not in (0, 1)
+            or len(location["extents"]) != 1
+        ):
+            return None
+        construction_method = location["construction_method"]
+        start = location["base_offset"] + location["extents"][0][1]
+        end = start + location["extents"][0][2]
+        for other_id, other in self.locations.items():
+            if other_id == item_id or other["construction_method"] != construction_method:
+                continue
+            for index, offset, length in other["extents"]:
+                other_start = other["base_offset"] + offset
+                if other_start < end and start < other_start + length:
+                    return None
+        return construction_method, start, end - start
+
+    def read_xmp(self, f=None) -> bytes:
+        item_id = self.xmp_item()
+        return self.read_item(item_id, f) if item_id is not None else None
+
+    def build_iloc(self, locations: dict) -> bytes:
+        version = max(self.iloc_version, 1)
+        offset_size, length_size, base_offset_size, index_size = self.iloc_sizes
+        for location in locations.values():
+            base_offset_size = uint_size(location["base_offset"], base_offset_size)
+            for index, offset, length in location["extents"]:
+                index_size = uint_size(index, index_size)
+                offset_size = uint_size(offset, offset_size)
+                length_size = uint_size(length, length_size)
+        if version < 2 and max(locations) > 0xFFFF:
+            version = 2
+
+        id_size = 2 if version < 2 else 4
+        payload = bytes([(offset_size << 4) | length_size, (base_offset_size << 4) | index_size])
+        payload += write_uint(len(locations), id_size)
+        for item_id in sorted(locations):
+            location = locations[item_id]
+            payload += write_uint(item_id, id_size)
+            payload += struct.pack(">HH", location["construction_method"], location["data_reference_index"])
+            payload += write_uint(location["base_offset"], base_offset_size)
+            payload += struct.pack(">H", len(location["extents"]))
+            for index, offset, length in location["extents"]:
+                payload += write_uint(index, index_size)
+                payload += write_uint(offset, offset_size)
+                payload += write_uint(length, length_size)
+        return full_box(b"iloc", version, 0, payload)
+
+    def build_meta(self, xmp_item: int, idat: bytes, locations: dict, new_item: bool) -> bytes:
+        payload = b""
+        for child in self.children:
+            box_type = child[0]
+            raw = self.data[child[1]:child[3]]
+            if box_type == b"iinf" and new_item:
+                version = self.data[child[2]]
+                count_size = 2 if version == 0 else 4
+                count = read_uint(self.data, child[2] + 4, count_size)[0]
+                if count + 1 >= 1 << (count_size * 8):
+                    raise ValueError("Too many items in iinf")
+                infe = full_box(
+                    b"infe",
+                    2 if xmp_item <= 0xFFFF else 3,
+                    0,
+                    write_uint(xmp_item, 2 if xmp_item <= 0xFFFF else 4)
+                    + struct.pack(">H", 0)
+                    + b"mime"
+                    + b"XMP\x00"
+                    + XMP_CONTENT_TYPE + b"\x00",
+                )
+                raw = full_box(
+                    b"iinf",
+                    version,
+                    0,
+                    write_uint(count + 1, count_size)
+                    + self.data[child[2] + 4 + count_size:child[3]]
+                    + infe,
+                )
+            elif box_type == b"iref" and new_item:
+                version = self.data[child[2]]
+                if version == 0 and max(xmp_item, self.primary_item) > 0xFFFF:
+                    raise ValueError("Item ID too large for iref")
+                id_size = 2 if version == 0 else 4
+                cdsc = box(
+                    b"cdsc",
+                    write_uint(xmp_item, id_size) + struct.pack(">H", 1) + write_uint(self.primary_item, id_size)
+                )
+                raw = full_box(b"iref", version, 0, self.data[child[2] + 4:child[3]] + cdsc)
+            elif box_type == b"iloc":
+                raw = self.build_iloc(locations)
+            elif box_type == b"idat":
+                continue  # rewritten at the end of meta
+            payload += raw
+        if new_item and self.find(self.children, b"iref") is None:
+            version = 0 if max(xmp_item, self.primary_item) <= 0xFFFF else 1
+            id_size = 2 if version == 0 else 4
+            payload += full_box(
+                b"iref",
+                version,
+                0,
+                box(b"cdsc", write_uint(xmp_item, id_size) + struct.pack(">H", 1) + write_uint(self.primary_item, id_size)),
+            )
+        payload += box(b"idat", idat)
+        return box(b"meta", self.data[self.meta[2]:self.meta[2] + 4] + payload)
+
+    def with_xmp(self, xmp: bytes) -> bytes:
+        if self.find(self.boxes, b"moov") is not None:
+            raise ValueError("Image sequences with moov box are not supported")
+
+        xmp_item = self.xmp_item()
+        new_item = xmp_item is None
+        if new_item:
+            xmp_item = max(list(self.items) + list(self.locations) + [self.primary_item]) + 1
+
+        data = self.data
+        idat = self.idat
+        locations = {item_id: dict(location, extents=[list(e) for e in location["extents"]])
+                     for item_id, location in self.locations.items()}
+        reused = False
+        previous = self.own_extent(xmp_item) if not new_item else None
+        if previous is not None:
+            # The previous XMP is removed or overwritten, so muxing a file again doesn't grow it
+            construction_method, start, length = previous
+            if construction_method == 1:
+                idat = idat[:start] + idat[start + length:]
+                for item_id, location in locations.items():
+                    if item_id == xmp_item or location["construction_method"] != 1:
+                        continue
+                    if location["base_offset"] >= start + length:
+                        location["base_offset"] -= length
+                    else:
+                        for extent in location["extents"]:
+                            if location["base_offset"] + extent[1] >= start + length:
+                                extent[1] -= length
+            elif start >= self.meta[3] or start + length <= self.meta[1]:
+                # Stored in the file (mdat): overwritten in place, the rest of the old extent is zeroed.
+                # A bigger XMP goes to idat and the whole old one is zeroed, so no stale copy is left.
+                if len(xmp) <= length:
+                    data = data[:start] + xmp + bytes(length - len(xmp)) + data[start + length:]
+                    locations[xmp_item]["extents"][0][2] = len(xmp)
+                    reused = True
+                else:
+                    data = data[:start] + bytes(length) + data[start + length:]
+        if not reused:
+            locations[xmp_item] = {
+                "construction_method": 1,
+                "data_reference_index": 0,
+                "base_offset": 0,
+                "extents": [[0, len(idat), len(xmp)]],
+            }
+            idat = idat + xmp
+
+        meta_end = self.meta[3]
+        delta = 0
+        while True:
+            shifted = {}
+            for item_id, location in locations.items():
+                location = dict(location, extents=[list(e) for e in location["extents"]])
+                if location["construction_method"] == 0 and location["data_reference_index"] == 0:
+                    if location["base_offset"] >= meta_end:
+                        location["base_offset"] += delta
+                    else:
+                        for extent in location["extents"]:
+                            if location["base_offset"] + extent[1] >= meta_end:
+                                extent[1] += delta
+                shifted[item_id] = location
+            meta = self.build_meta(xmp_item, idat, shifted, new_item)
+            new_delta = len(meta) - (self.meta[3] - self.meta[1])
+            # Bigger offsets may need wider iloc fields, which changes the meta size again
+            if new_delta == delta:
+                break
+            delta = new_delta
+
+        return data[:self.meta[1]] + meta + data[self.meta[3]:]
@@ -0,0 +1,131 @@
+import os
+import sqlite3
+import threading
+
+from utils import sample_digest
+
+INDEX_FNAME = ".motionphoto2.sqlite"
+
+
+class IncrementalIndex:
+
+    # Persistent record of muxed pairs stored in the output directory, used by incremental mode.
+    # A pair is considered done when both inputs and the output still have the size, mtime and
+    # inode recorded when it was muxed, so no file content has to be read to skip it.
+    # An output with the recorded size and mtime but another inode was replaced (restored from a
+    # backup, synced with its mtime kept), it is only trusted if its sampled digest still matches.
+    # The index may be shared between the main thread and a pipeline thread, access is serialized.
+
+    def __init__(self, output_directory: str):
+        self.fpath = os.path.join(output_directory, INDEX_FNAME)
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(self.fpath, check_same_thread=False)
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS pairs (
+                image TEXT NOT NULL,
+                video TEXT NOT NULL,
+                image_size INTEGER,
+                image_mtime_ns INTEGER,
+                image_inode INTEGER,
+                video_size INTEGER,
+                video_mtime_ns INTEGER,
+                video_inode INTEGER,
+                content_id TEXT,
+                output TEXT,
+                output_size INTEGER,
+                output_mtime_ns INTEGER,
+                digest TEXT,
+                output_inode INTEGER,
+                PRIMARY KEY (image, video)
+            )"""
+        )
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(pairs)")]
+        if "output_inode" not in columns:
+            # Index written before outputs were checked by inode, its rows are verified by digest
+            self.db.execute("ALTER TABLE pairs ADD COLUMN output_inode INTEGER")
+        self.pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    @staticmethod
+    def stat(fpath: str) -> tuple:
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns, st.st_ino
+
+    def lookup(self, image: str, video: str) -> str:
+        # Returns the recorded output path when the pair is unchanged since it was muxed, None otherwise
+        with self.lock:
+            row = self.db.execute(
+                """SELECT image_size, image_mtime_ns, image_inode, video_size, video_mtime_ns, video_inode,
+                          output, output_size, output_mtime_ns, output_inode, digest
+                   FROM pairs WHERE image = ? AND video = ?""",
+                (str(image), str(video)),
+            ).fetchone()
+        if row is None:
+            return None
+        if self.stat(image) != tuple(row[0:3]) or self.stat(video) != tuple(row[3:6]):
+            return None
+        output_stat = self.stat(row[6])
+        if output_stat is None or output_stat[0:2] != tuple(row[7:9]):
+            return None
+        if output_stat[2] != row[9]:
+            try:
+                if sample_digest(row[6]) != row[10]:
+                    return None
+            except OSError:
+                return None
+            with self.lock:
+                self.db.execute(
+                    "UPDATE pairs SET output_inode = ? WHERE image = ? AND video = ?",
+                    (output_stat[2], str(image), str(video)),
+                )
+                self.count()
+        return row[6]
+
+    def record(self, image: str, video: str, output: str, content_id: str = None):
+        image_stat, video_stat, output_stat = self.stat(image), self.stat(video), self.stat(output)
+        if image_stat is None or video_stat is None or output_stat is None:
+            return
+        digest = sample_digest(output)
+        with self.lock:
+            self.db.execute(
+                """INSERT OR REPLACE INTO pairs (
+                    image, video,
+                    image_size, image_mtime_ns, image_inode,
+                    video_size, video_mtime_ns, video_inode,
+                    content_id, output, output_size, output_mtime_ns, digest, output_inode
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    str(image), str(video),
+                    *image_stat,
+                    *video_stat,
+                    content_id.strip() if content_id else None,
+                    str(output),
+                    *output_stat[0:2],
+                    digest,
+                    output_stat[2],
+                ),
+            )
+            self.count()
+
+    def count(self):
+        self.pending += 1
+        if self.pending >= 64:
+            self.commit()
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.db.close()
@@ -0,0 +1,109 @@
+import json
+import os
+import threading
+import time
+
+JOURNAL_FNAME = ".motionphoto2.journal"
+# Records written between two fsyncs of the journal
+JOURNAL_SYNC_INTERVAL = 64
+
+
+class Journal:
+
+    # Write-ahead journal of a directory run, one JSON record per line next to the outputs.
+    # With resume, the journal of an interrupted run is continued: the pairs it records as done are
+    # skipped without looking at their files again; otherwise a new journal is started.
+    # Every pair is recorded as planned when it is submitted and as done (or failed) once its
+    # output is on disk (fsynced and renamed into place, see Muxer.write). The journal itself is fsynced in groups: a record lost to a power failure only
+    # means the pair is muxed again. A torn last line left by a crash is ignored when loading.
+    # The journal is removed when a run finishes without failures.
+    # The journal may be shared between the main thread and a pipeline thread, access is serialized.
+
+    def __init__(self, directory: str, resume: bool = False, fname: str = JOURNAL_FNAME):
+        self.fpath = os.path.join(directory, fname)
+        self.lock = threading.RLock()
+        self.done_images = {}  # image -> output of the pairs done by a previous run
+        self.done_videos = set()
+        self.interrupted = 0  # pairs planned but not finished by a previous run
+        self.torn = False
+        self.resumed = resume and os.path.exists(self.fpath)
+        if self.resumed:
+            self.load()
+        self.file = open(self.fpath, "a" if self.resumed else "w", encoding="utf-8")
+        if self.torn:
+            self.file.write("\n")
+        self.pending = 0
+        self.write({"event": "start", "time": time.time()})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def load(self):
+        try:
+            with open(self.fpath, "r", encoding="utf-8") as f:
+                lines = f.read().split("\n")
+        except FileNotFoundError:
+            return
+        self.torn = lines[-1] != ""
+        planned = set()
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # empty, or torn by a crash while it was written
+            event = record.get("event")
+            if event == "planned":
+                planned.add(record["image"])
+            elif event == "done":
+                planned.discard(record["image"])
+                self.done_images[record["image"]] = record.get("output")
+                self.done_videos.add(record["video"])
+            elif event == "failed":
+                planned.discard(record["image"])
+        self.interrupted = len(planned)
+
+    def is_done(self, image: str) -> bool:
+        return str(image) in self.done_images
+
+    def is_video_done(self, video: str) -> bool:
+        return str(video) in self.done_videos
+
+    def write(self, record: dict):
+        # One write per line, so a crash can only tear the last one
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            self.pending += 1
+            if self.pending >= JOURNAL_SYNC_INTERVAL:
+                self.sync()
+
+    def sync(self):
+        with self.lock:
+            os.fsync(self.file.fileno())
+            self.pending = 0
+
+    def planned(self, image: str, video: str, output_directory: str = None):
+        self.write({"event": "planned", "image": str(image), "video": str(video), "output_directory": output_directory})
+
+    def done(self, image: str, video: str, output: str):
+        self.write({"event": "done", "image": str(image), "video": str(video), "output": str(output)})
+
+    def failed(self, image: str, video: str):
+        self.write({"event": "failed", "image": str(image), "video": str(video)})
+
+    def close(self, remove: bool = False):
+        # remove - the run is complete, nothing is left to resume
+        with self.lock:
+            if self.file.closed:
+                return
+            self.write({"event": "end", "time": time.time()})
+            self.sync()
+            self.file.close()
+            if remove:
+                os.remove(self.fpath)
+
+    def summary(self) -> str:
+        return f"Resuming: {len(self.done_images)} pair(s) done by the previous run, {self.interrupted} interrupted"
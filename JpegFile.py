@@ -0,0 +1,188 @@
+import hashlib
+import struct
+
+XMP_SIGNATURE = b"http://ns.adobe.com/xap/1.0/\x00"
+XMP_EXTENSION_SIGNATURE = b"http://ns.adobe.com/xmp/extension/\x00"
+MPF_SIGNATURE = b"MPF\x00"
+
+SEGMENT_MAX_SIZE = 0xFFFF - 2  # length field counts itself
+XMP_MAX_SIZE = SEGMENT_MAX_SIZE - len(XMP_SIGNATURE)
+XMP_EXTENSION_CHUNK_SIZE = SEGMENT_MAX_SIZE - len(XMP_EXTENSION_SIGNATURE) - 32 - 8
+
+MARKER_SOI = 0xD8
+MARKER_EOI = 0xD9
+MARKER_SOS = 0xDA
+MARKER_APP0 = 0xE0
+MARKER_APP1 = 0xE1
+MARKER_APP2 = 0xE2
+
+
+def find_xmp_in_file(f) -> tuple:
+    # Reads only the segment headers (seeking over the payloads) until the XMP segment is found.
+    # Returns (offset, length) of the XMP packet or None.
+    f.seek(0)
+    if f.read(2) != b"\xff" + bytes([MARKER_SOI]):
+        return None
+    while True:
+        header = f.read(4)
+        if len(header) < 4 or header[0] != 0xFF:
+            return None
+        marker = header[1]
+        if marker in (MARKER_SOS, MARKER_EOI):
+            return None
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            f.seek(-2, 1)
+            continue
+        (length,) = struct.unpack(">H", header[2:4])
+        if marker == MARKER_APP1 and length - 2 >= len(XMP_SIGNATURE):
+            start = f.tell()
+            if f.read(len(XMP_SIGNATURE)) == XMP_SIGNATURE:
+                return start + len(XMP_SIGNATURE), length - 2 - len(XMP_SIGNATURE)
+            f.seek(start + length - 2)
+        else:
+            f.seek(length - 2, 1)
+
+
+def find_sos_in_file(f) -> int:
+    # Reads only the segment headers (seeking over the payloads) until the start of scan.
+    # Returns the offset of the SOS marker or None.
+    f.seek(0)
+    if f.read(2) != b"\xff" + bytes([MARKER_SOI]):
+        return None
+    while True:
+        header = f.read(4)
+        if len(header) < 4 or header[0] != 0xFF:
+            return None
+        marker = header[1]
+        if marker == MARKER_SOS:
+            return f.tell() - 4
+        if marker == MARKER_EOI:
+            return None
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            f.seek(-2, 1)
+            continue
+        (length,) = struct.unpack(">H", header[2:4])
+        f.seek(length - 2, 1)
+
+
+def read_xmp_from_file(f) -> bytes:
+    xmp_range = find_xmp_in_file(f)
+    if xmp_range is None:
+        return None
+    f.seek(xmp_range[0])
+    return f.read(xmp_range[1])
+
+
+class JpegFile:
+
+    # Minimal JPEG segment parser used to read and replace the APP1 XMP segments
+    # without round-tripping the image through ExifTool.
+    # Only the header segments up to SOS are parsed, the entropy coded data and
+    # anything after it (trailers, MPF images) are kept verbatim.
+
+    def __init__(self, data: bytes):
+        if data[:2] != b"\xff" + bytes([MARKER_SOI]):
+            raise ValueError("Not a JPEG file")
+        self.data = data
+        self.segments = []  # (marker, start, end) of every header segment
+        pos = 2
+        while True:
+            if pos >= len(data) or data[pos] != 0xFF:
+                raise ValueError(f"Invalid JPEG marker at offset {pos}")
+            while pos + 1 < len(data) and data[pos + 1] == 0xFF:  # fill bytes
+                pos += 1
+            if pos + 1 >= len(data):
+                raise ValueError("Truncated JPEG file")
+            marker = data[pos + 1]
+            if marker in (MARKER_SOS, MARKER_EOI):
+                break
+            if marker == 0x01 or 0xD0 <= marker <= 0xD7:  # standalone markers
+                self.segments.append((marker, pos, pos + 2))
+                pos += 2
+                continue
+            if pos + 4 > len(data):
+                raise ValueError("Truncated JPEG file")
+            (length,) = struct.unpack(">H", data[pos + 2:pos + 4])
+            if length < 2 or pos + 2 + length > len(data):
+                raise ValueError(f"Invalid JPEG segment length at offset {pos}")
+            self.segments.append((marker, pos, pos + 2 + length))
+            pos += 2 + length
+        self.tail_start = pos
+
+    def payload(self, segment: tuple) -> bytes:
+        marker, start, end = segment
+        return self.data[start + 4:end]
+
+    def is_xmp(self, segment: tuple) -> bool:
+        return segment[0] == MARKER_APP1 and self.payload(segment).startswith(XMP_SIGNATURE)
+
+    def is_xmp_extension(self, segment: tuple) -> bool:
+        return segment[0] == MARKER_APP1 and self.payload(segment).startswith(XMP_EXTENSION_SIGNATURE)
+
+    def is_mpf(self, segment: tuple) -> bool:
+        return segment[0] == MARKER_APP2 and self.payload(segment).startswith(MPF_SIGNATURE)
+
+    def read_xmp(self) -> bytes:
+        for segment in self.segments:
+            if self.is_xmp(segment):
+                return self.payload(segment)[len(XMP_SIGNATURE):]
+        return None
+
+    @staticmethod
+    def app1(payload: bytes) -> bytes:
+        return b"\xff" + bytes([MARKER_APP1]) + struct.pack(">H", len(payload) + 2) + payload
+
+    @staticmethod
+    def extended_xmp_guid(extended_xmp: bytes) -> str:
+        return hashlib.md5(extended_xmp).hexdigest().upper()
+
+    @staticmethod
+    def xmp_segments(xmp: bytes, extended_xmp: bytes = None) -> bytes:
+        if len(xmp) > XMP_MAX_SIZE:
+            raise ValueError(f"XMP packet of {len(xmp)} bytes doesn't fit into one APP1 segment")
+        result = JpegFile.app1(XMP_SIGNATURE + xmp)
+        if extended_xmp is not None:
+            guid = JpegFile.extended_xmp_guid(extended_xmp).encode("ascii")
+            for offset in range(0, len(extended_xmp), XMP_EXTENSION_CHUNK_SIZE):
+                result += JpegFile.app1(
+                    XMP_EXTENSION_SIGNATURE
+                    + guid
+                    + struct.pack(">II", len(extended_xmp), offset)
+                    + extended_xmp[offset:offset + XMP_EXTENSION_CHUNK_SIZE]
+                )
+        return result
+
+    def with_xmp(self, xmp: bytes, extended_xmp: bytes = None) -> bytes:
+        # Replace the existing XMP (and ExtendedXMP) segments, or insert new ones after APP0/APP1 Exif.
+        # MPF offsets are relative to the APP2 segment, so resizing anything in front of it is safe,
+        # but resizing something behind it would move the secondary images out from under MPF.
+        xmp_bytes = self.xmp_segments(xmp, extended_xmp)
+
+        insert_at = None
+        for index, segment in enumerate(self.segments):
+            if self.is_xmp(segment):
+                insert_at = index
+                break
+        if insert_at is None:
+            insert_at = 0
+            while insert_at < len(self.segments) and self.segments[insert_at][0] in (MARKER_APP0, MARKER_APP1):
+                insert_at += 1
+
+        mpf_index = next((i for i, s in enumerate(self.segments) if self.is_mpf(s)), None)
+        if mpf_index is not None:
+            if insert_at > mpf_index or any(
+                self.is_xmp(s) or self.is_xmp_extension(s) for s in self.segments[mpf_index:]
+            ):
+                raise ValueError("XMP segment located after MPF segment")
+
+        result = [self.data[:2]]
+        for index, segment in enumerate(self.segments):
+            if index == insert_at:
+                result.append(xmp_bytes)
+            if self.is_xmp(segment) or self.is_xmp_extension(segment):
+                continue
+            result.append(self.data[segment[1]:segment[2]])
+        if insert_at == len(self.segments):
+            result.append(xmp_bytes)
+        result.append(self.data[self.tail_start:])
+        return b"".join(result)
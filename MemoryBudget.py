@@ -0,0 +1,123 @@
+import os
+import sys
+import threading
+
+from pathlib import Path
+
+from utils import COPY_CHUNK_SIZE
+
+# Memory of a mux besides the image: XMP trees, metadata, logging, copy buffers
+MUX_BASE_MEMORY = 4 * 1024 * 1024
+# An image read to memory is held about three times: the file, the rewritten image, joining them
+IMAGE_BUFFER_COPIES = 3
+# Header segments read of a streamed JPEG (APP segments are at most 64KB each)
+STREAMED_IMAGE_MEMORY = 1024 * 1024
+# Images streamed by default above this size, see Muxer.stream_threshold
+STREAM_THRESHOLD = 64 * 1024 * 1024
+
+
+def estimate_mux_memory(image_fpath: str, video_fpath: str, stream_threshold: int = None) -> int:
+    # Estimated peak memory of muxing the pair, in bytes, for the write path the Muxer will take:
+    # the video is always copied from its file (FileRange), the image is read to memory unless it is
+    # streamed (bigger than stream_threshold and not HEIC, whose meta box is rebuilt from the whole file)
+    try:
+        image_size = os.path.getsize(image_fpath)
+    except OSError:
+        image_size = 0  # the Muxer reports it
+    streamed = (
+        stream_threshold is not None
+        and image_size > stream_threshold
+        and Path(image_fpath).suffix.lower() not in (".heic", ".heif", ".avif")
+    )
+    image_memory = STREAMED_IMAGE_MEMORY if streamed else IMAGE_BUFFER_COPIES * image_size
+    return MUX_BASE_MEMORY + COPY_CHUNK_SIZE + image_memory
+
+
+def peak_rss() -> tuple:
+    # Peak resident set size in bytes of this process and of its biggest finished child process
+    # (worker processes, ExifTool), None where unknown
+    try:
+        import resource
+    except ImportError:
+        return windows_peak_rss(), None
+    # ru_maxrss is in kilobytes, except on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit or None,
+    )
+
+
+def windows_peak_rss() -> int:
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None
+        return counters.PeakWorkingSetSize
+    except (AttributeError, OSError):
+        return None
+
+
+def memory_summary(budget=None) -> str:
+    own, child = peak_rss()
+    mib = 1024 * 1024
+    parts = [f"Peak memory: {own / mib:.1f} MiB" if own is not None else "Peak memory: unknown"]
+    if child is not None:
+        parts.append(f"biggest child process {child / mib:.1f} MiB")
+    if budget is not None:
+        parts.append(
+            f"estimated muxing peak {budget.peak / mib:.1f} of {budget.max_bytes / mib:.1f} MiB allowed"
+            f" ({budget.waits} job(s) waited)"
+        )
+    return ", ".join(parts)
+
+
+class MemoryBudget:
+
+    # Admission control of muxing jobs by their estimated memory (see estimate_mux_memory).
+    # A job is admitted while the estimates of the jobs in flight stay within max_bytes; a job
+    # bigger than the whole budget is admitted once nothing else is in flight, so it still runs.
+    # Thread safe: acquire() blocks until the job fits, release() is called when it finished.
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.in_use = 0
+        self.peak = 0
+        self.waits = 0
+        self.condition = threading.Condition()
+
+    def fits(self, nbytes: int) -> bool:
+        with self.condition:
+            return self.in_use == 0 or self.in_use + nbytes <= self.max_bytes
+
+    def acquire(self, nbytes: int):
+        with self.condition:
+            if not self.fits(nbytes):
+                self.waits += 1
+                self.condition.wait_for(lambda: self.fits(nbytes))
+            self.in_use += nbytes
+            self.peak = max(self.peak, self.in_use)
+
+    def release(self, nbytes: int):
+        with self.condition:
+            self.in_use -= nbytes
+            self.condition.notify_all()
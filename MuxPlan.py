@@ -0,0 +1,201 @@
+import base64
+import collections
+import json
+import os
+import time
+
+from pathlib import Path
+
+import constants as const
+from SamsungTags import SamsungTags
+from utils import enrich_fname, partial_fname
+
+PLAN_VERSION = 2
+# The motion photo XMP added to the image; an XMP the image already has is merged into it,
+# so it is already counted in the image size
+XMP_PACKET_SIZE = len(const.XPACKET_BEGIN) + len(const.XMP.encode("utf-8")) + len(const.XPACKET_END)
+
+
+def expected_output_fpath(kwargs: dict) -> str:
+    # Output path the Muxer will use (before it fixes a wrong extension from the metadata)
+    image_fpath = f"{Path(kwargs['image_fpath']).resolve()}"
+    if kwargs.get("output_directory") is not None:
+        return os.path.join(f"{Path(kwargs['output_directory']).resolve()}", os.path.basename(image_fpath))
+    if kwargs.get("overwrite") is True:
+        return image_fpath
+    return enrich_fname(image_fpath, "LIVE")
+
+
+def expected_output_size(kwargs: dict, image_size: int, video_size: int) -> int:
+    # Estimated output size: the image with the motion photo XMP and the Samsung footer (video included)
+    image_type = "heic" if Path(kwargs["image_fpath"]).suffix.lower() in (".heic", ".heif", ".avif") else "jpg"
+    xmp_size = 0 if kwargs.get("no_xmp") else XMP_PACKET_SIZE
+    return image_size + xmp_size + SamsungTags(video_size, image_type).footer_size()
+
+
+def encode_metadata(metadata: dict) -> dict:
+    # Binary values (XMP:XMP) are stored the way ExifTool prints them, "base64:..."
+    if metadata is None:
+        return None
+    return {
+        tag: "base64:" + base64.b64encode(value).decode("ascii") if isinstance(value, bytes) else value
+        for tag, value in metadata.items()
+    }
+
+
+def decode_metadata(metadata: dict) -> dict:
+    if metadata is None:
+        return None
+    return {
+        tag: base64.b64decode(value[len("base64:"):]) if isinstance(value, str) and value.startswith("base64:") else value
+        for tag, value in metadata.items()
+    }
+
+
+def parse_shard(shard: str) -> tuple:
+    # "K/N" (1-based) -> (K - 1, N)
+    try:
+        k, n = (int(part) for part in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"Plan shard must be K/N, not {shard}")
+    if n < 1 or not 1 <= k <= n:
+        raise ValueError(f"Plan shard {shard} is out of range")
+    return k - 1, n
+
+
+def read_plan(fpath: str) -> tuple:
+    # Returns the plan header and the list of its records, in planned order.
+    # A plan without its end record (planning failed, or the file was cut) is rejected.
+    with open(fpath, "r", encoding="utf-8") as f:
+        lines = [line for line in f.read().split("\n") if line.strip()]
+    if not lines:
+        raise ValueError(f"Plan {fpath} is empty")
+    header = json.loads(lines[0])
+    if header.get("action") != "plan":
+        raise ValueError(f"{fpath} is not a mux plan")
+    if header.get("version") != PLAN_VERSION:
+        raise ValueError(f"Plan {fpath} has unsupported version {header.get('version')}")
+    try:
+        records = [json.loads(line) for line in lines[1:]]
+    except ValueError:
+        raise ValueError(f"Plan {fpath} is incomplete")
+    if not records or records[-1]["action"] != "end" or records[-1].get("records") != len(records) - 1:
+        raise ValueError(f"Plan {fpath} is incomplete")
+    records.pop()
+    for record in records:
+        if record["action"] == "mux":
+            options = record["options"]
+            for key in ("image_metadata", "video_metadata"):
+                if key in options:
+                    options[key] = decode_metadata(options[key])
+    return header, records
+
+
+class PlanWriter:
+
+    # Takes the place of the mux pool when planning a directory run (--plan-only): every decision
+    # (pairs to mux with their options and prefetched metadata, skips, copies, messages) is written
+    # to a JSON lines plan in order, instead of being carried out. Pairs carry their expected output
+    # path and size (see expected_output_size) and their prefetched metadata (see encode_metadata).
+    # The plan is written next to its path and renamed into place when complete, like the outputs,
+    # and ends with a record counting the others, which read_plan requires.
+    # The plan is carried out later by --execute, possibly split in shards (see parse_shard).
+
+    def __init__(self, fpath: str, input_directory: str, output_directory: str = None, incremental_mode: bool = False):
+        self.fpath = fpath
+        self.input_directory = Path(input_directory).resolve()
+        self.output_directory = f"{Path(output_directory).resolve()}" if output_directory is not None else None
+        self.counts = collections.Counter()
+        self.records = 0
+        self.expected_bytes = 0
+        self.partial_fpath = partial_fname(fpath)
+        self.file = open(self.partial_fpath, "w", encoding="utf-8")
+        self.write({
+            "action": "plan",
+            "version": PLAN_VERSION,
+            "created": time.time(),
+            "input_directory": str(self.input_directory),
+            "output_directory": self.output_directory,
+            "incremental_mode": incremental_mode,
+        })
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close(complete=exc_type is None)
+
+    def write(self, record: dict):
+        if record["action"] not in ("plan", "end"):
+            self.counts[record["action"]] += 1
+            self.records += 1
+        self.file.write(json.dumps(record) + "\n")
+
+    def echo(self, message: str):
+        self.write({"action": "echo", "message": message})
+
+    def skip(self, file: str, reason: str, message: str):
+        self.write({"action": "skip", "file": str(file), "reason": reason, "message": message})
+
+    def submit(self, header: str, **kwargs):
+        image_size = os.path.getsize(kwargs["image_fpath"])
+        video_size = os.path.getsize(kwargs["video_fpath"])
+        expected_size = expected_output_size(kwargs, image_size, video_size)
+        self.expected_bytes += expected_size
+        options = dict(kwargs)
+        for key in ("image_metadata", "video_metadata"):
+            if key in options:
+                options[key] = encode_metadata(options[key])
+        self.write({
+            "action": "mux",
+            "header": header,
+            "output_fpath": expected_output_fpath(kwargs),
+            "image_size": image_size,
+            "video_size": video_size,
+            "expected_size": expected_size,
+            "options": options,
+        })
+
+    def copy(self, file: str):
+        source = self.input_directory / file
+        self.write({
+            "action": "copy",
+            "file": str(file),
+            "destination": os.path.join(self.output_directory, file),
+            "size": os.path.getsize(source),
+        })
+
+    def close(self, complete: bool = True):
+        # complete - False drops the partial plan (planning failed)
+        if self.file.closed:
+            return
+        if complete:
+            self.write({"action": "end", "records": self.records})
+        self.file.close()
+        if complete:
+            os.replace(self.partial_fpath, self.fpath)
+        else:
+            os.remove(self.partial_fpath)
+
+    def summary(self) -> str:
+        return (
+            f"Planned {self.counts['mux']} file(s) to mux ({self.expected_bytes / 1024 ** 2:.1f} MiB), "
+            f"{self.counts['skip']} skipped, in {self.fpath}"
+        )
+
+
+class PlannedCopies:
+
+    # Takes the place of the CopyPool while planning, copies go to the plan
+
+    def __init__(self, plan: PlanWriter):
+        self.plan = plan
+
+    def submit(self, file: str):
+        self.plan.copy(file)
+
+    def close(self):
+        pass
+
+    def summary(self) -> str:
+        return f"Planned {self.plan.counts['copy']} copy(ies)"
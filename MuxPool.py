@@ -0,0 +1,234 @@
+import atexit
+import collections
+import contextlib
+import io
+import logging
+import os
+import sys
+import traceback
+
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from ExifToolPool import COMMAND_TIMEOUT, ExifToolPool
+from IncrementalIndex import IncrementalIndex
+from Journal import Journal
+from MemoryBudget import MemoryBudget, estimate_mux_memory
+from Muxer import Muxer
+from Profiler import Profiler
+from utils import prefetch_metadata
+
+# Number of jobs whose metadata is read by a single ExifTool request
+PREFETCH_BATCH_SIZE = 64
+
+# ExifTool instance owned by a worker process, started once by the pool initializer
+worker_exiftool = None
+
+
+def init_worker(verbose: bool, timeout: float = COMMAND_TIMEOUT):
+    global worker_exiftool
+    logger = logging.getLogger("ExifTool")
+    logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+    worker_exiftool = ExifToolPool(
+        timeout=timeout,
+        encoding="utf-8",
+        logger=logger
+    )
+    worker_exiftool.run()
+    atexit.register(worker_exiftool.terminate)
+
+
+def mux_worker(kwargs: dict, profile: bool = False) -> tuple:
+    # Capture everything the muxer prints or logs, so the parent can replay it in submission order.
+    # Profiling spans are returned too and merged into the parent's profiler.
+    output = io.StringIO()
+    profiler = Profiler(enabled=profile)
+    handlers = [h for h in logging.getLogger().handlers if isinstance(h, logging.StreamHandler)]
+    streams = [h.setStream(output) for h in handlers]
+    try:
+        with contextlib.redirect_stdout(output):
+            output_fpath = Muxer(exiftool=worker_exiftool, profiler=profiler, **kwargs).mux()
+        return True, output.getvalue(), output_fpath, profiler.spans
+    except SystemExit:
+        return False, output.getvalue(), None, profiler.spans
+    except Exception:
+        return False, output.getvalue() + traceback.format_exc(), None, profiler.spans
+    finally:
+        for handler, stream in zip(handlers, streams):
+            handler.setStream(stream)
+
+
+class MuxPool:
+
+    # Runs Muxer jobs either inline (jobs == 1) or in a pool of worker processes,
+    # each with its own warm ExifTool. Output is always printed in submission order.
+    # Jobs are collected in batches, so the metadata of the whole batch is prefetched
+    # at once (pipelined over the ExifTool pool) and muxing itself does no ExifTool reads.
+    # Successfully muxed pairs are recorded in the incremental index, if one is given, and every
+    # job is recorded in the journal (planned when submitted, done or failed when finished).
+    # With a memory budget, a job is sent to the workers only once its estimated memory fits.
+
+    def __init__(
+        self,
+        exiftool: ExifToolPool,
+        jobs: int = 1,
+        verbose: bool = False,
+        index: IncrementalIndex = None,
+        profiler: Profiler = None,
+        journal: Journal = None,
+        budget: MemoryBudget = None,
+    ):
+        self.exiftool = exiftool
+        self.index = index
+        self.journal = journal
+        self.budget = budget
+        self.profiler = profiler if profiler is not None else Profiler()
+        self.jobs = jobs if jobs > 0 else (os.cpu_count() or 1)
+        self.verbose = verbose
+        self.batch = []
+        self.pending = collections.deque()
+        self.muxed = 0
+        self.failed = 0
+        self.executor = None
+        if self.jobs > 1:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.jobs,
+                initializer=init_worker,
+                initargs=(verbose, exiftool.timeout),
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def echo(self, message: str):
+        if self.batch:
+            self.batch.append((message, None))
+        else:
+            self.output(message)
+
+    def skip(self, file: str, reason: str, message: str):
+        # The reason only matters to a plan (see PlanWriter)
+        self.echo(message)
+
+    def submit(self, header: str, **kwargs):
+        if self.journal is not None:
+            self.journal.planned(kwargs["image_fpath"], kwargs["video_fpath"], kwargs.get("output_directory"))
+        self.batch.append((header, kwargs))
+        if sum(1 for _, job in self.batch if job is not None) >= PREFETCH_BATCH_SIZE:
+            self.run_batch()
+
+    def output(self, message: str):
+        if self.executor is None:
+            print(message)
+            return
+        future = Future()
+        future.set_result((None, message + "\n", None, None))
+        self.pending.append((None, future, None, 0))
+        self.flush()
+
+    def prefetch(self, jobs: list):
+        missing = [job for job in jobs if job.get("image_metadata") is None or job.get("video_metadata") is None]
+        if not missing:
+            return
+        fpaths = []
+        for job in missing:
+            fpaths += [job["image_fpath"], job["video_fpath"]]
+        try:
+            with self.profiler.span("prefetch"):
+                metadata = prefetch_metadata(self.exiftool, fpaths)
+        except Exception:
+            # e.g. a file vanished - let every Muxer read (and report) its own metadata
+            return
+        if len(metadata) != len(fpaths):
+            return
+        for i, job in enumerate(missing):
+            job["image_metadata"], job["video_metadata"] = metadata[2 * i], metadata[2 * i + 1]
+
+    def run_batch(self):
+        batch, self.batch = self.batch, []
+        self.prefetch([job for _, job in batch if job is not None])
+        for header, job in batch:
+            if job is None:
+                self.output(header)
+            elif self.executor is None:
+                print(header)
+                memory = self.admit(job)
+                try:
+                    output_fpath = Muxer(exiftool=self.exiftool, profiler=self.profiler, **job).mux()
+                except SystemExit:
+                    # A bad pair fails on its own instead of ending the whole run
+                    self.fail(job)
+                    continue
+                except Exception:
+                    traceback.print_exc(file=sys.stdout)
+                    self.fail(job)
+                    continue
+                finally:
+                    if self.budget is not None:
+                        self.budget.release(memory)
+                self.done(job, output_fpath)
+            else:
+                memory = self.admit(job)
+                self.pending.append((header, self.executor.submit(mux_worker, job, self.profiler.enabled), job, memory))
+                self.flush()
+                # Keep a bounded number of jobs in flight so huge batches don't queue everything at once
+                while len(self.pending) > self.jobs * 4:
+                    self.pending[0][1].result()
+                    self.flush()
+
+    def admit(self, job: dict) -> int:
+        # Waits (flushing finished jobs, which frees their memory) until the job fits the budget
+        if self.budget is None:
+            return 0
+        memory = estimate_mux_memory(job["image_fpath"], job["video_fpath"], job.get("stream_threshold"))
+        if not self.budget.fits(memory):
+            self.budget.waits += 1
+            while not self.budget.fits(memory):
+                self.pending[0][1].result()
+                self.flush()
+        self.budget.acquire(memory)
+        return memory
+
+    def flush(self, wait: bool = False):
+        while self.pending and (wait or self.pending[0][1].done()):
+            header, future, job, memory = self.pending.popleft()
+            ok, output, output_fpath, spans = future.result()
+            if self.budget is not None and memory:
+                self.budget.release(memory)
+            self.profiler.add_spans(spans)
+            if header is not None:
+                print(header)
+            print(output, end="")
+            if ok is True:
+                self.done(job, output_fpath)
+            elif ok is False:
+                self.fail(job)
+
+    def done(self, job: dict, output_fpath: str):
+        self.muxed += 1
+        if self.index is not None:
+            self.index.record(
+                job["image_fpath"],
+                job["video_fpath"],
+                output_fpath,
+                (job.get("image_metadata") or {}).get("MakerNotes:ContentIdentifier"),
+            )
+        if self.journal is not None:
+            self.journal.done(job["image_fpath"], job["video_fpath"], output_fpath)
+
+    def fail(self, job: dict):
+        self.failed += 1
+        if self.journal is not None:
+            self.journal.failed(job["image_fpath"], job["video_fpath"])
+
+    def close(self):
+        self.run_batch()
+        if self.executor is not None:
+            self.flush(wait=True)
+            self.executor.shutdown()
+            self.executor = None
+
+    def summary(self) -> str:
+        return f"Muxed {self.muxed} file(s), {self.failed} failed"
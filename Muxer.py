@@ -1,5 +1,5 @@
+import copy
 import logging
-import exiftool
 import os
 import sys
 import shutil
@@ -8,13 +8,23 @@ from pathlib import Path
 from lxml import etree
 
 from utils import (
-    extract_track_number,
-    extract_track_duration,
+    read_still_image_time,
+    prefetch_metadata,
     read_file,
     enrich_fname,
+    partial_fname,
+    fsync_file,
+    fsync_directory,
+    write_segments,
+    segment_size,
+    FileRange,
 )
 
 import constants as const
+from ExifToolPool import ExifToolPool
+from HeifFile import HeifFile
+from JpegFile import JpegFile, XMP_MAX_SIZE, find_sos_in_file
+from Profiler import Profiler
 from SamsungTags import SamsungTags
 
 logging.basicConfig(
@@ -29,7 +39,7 @@ class Muxer:
         self,
         image_fpath: str,
         video_fpath: str,
-        exiftool: exiftool.ExifToolHelper,
+        exiftool: ExifToolPool,
         output_fpath: str = None,
         output_directory: str = None,
         delete_video: bool = False,
@@ -37,8 +47,13 @@ class Muxer:
         overwrite: bool = False,
         no_xmp: bool = False,
         verbose: bool = False,
+        image_metadata: dict = None,
+        video_metadata: dict = None,
+        logger: logging.Logger = None,
+        profiler: Profiler = None,
+        stream_threshold: int = None,
     ):
-        self.logger = logging.getLogger(Path(image_fpath).stem)
+        self.logger = logger if logger is not None else logging.getLogger(Path(image_fpath).stem)
         self.verbose = verbose
         self.logger.setLevel(logging.DEBUG if verbose else logging.INFO)
 
@@ -52,6 +67,12 @@ class Muxer:
         self.delete_video = delete_video
         self.no_xmp = no_xmp
         self.exiftool = exiftool
+        # Metadata prefetched in bulk by the caller (see prefetch_metadata), read here otherwise
+        self.image_metadata = image_metadata
+        self.video_metadata = video_metadata
+        self.profiler = profiler if profiler is not None else Profiler()
+        # Images bigger than this (in bytes) are copied from the file while writing instead of read to memory
+        self.stream_threshold = stream_threshold
 
         if os.path.isfile(self.image_fpath) is False:
             self.logger.error("Image file doesn't exist")
@@ -98,6 +119,7 @@ class Muxer:
         self.org_outfpath = self.output_fpath
 
         self.delete_temp = delete_temp
+        self.temp_files = []
         self.xmp = etree.fromstring(const.XMP)
 
     def change_xmpresource(self, value: str, attribute: str = const.ITEM_MIME, semantic: str = "Primary"):
@@ -188,12 +210,117 @@ class Muxer:
         except:
             self.logger.info("Could not copy (some of?) the XMP metadata tags from source.")
 
-    def mux(self):
+    def xmp_packet(self, xmp: etree._Element) -> bytes:
+        return const.XPACKET_BEGIN + etree.tostring(xmp, pretty_print=True) + const.XPACKET_END
+
+    def split_xmp(self) -> tuple:
+        # JPEG APP1 segment holds at most ~64KB of XMP. Anything bigger is split into ExtendedXMP:
+        # the MotionPhoto attributes and Container directory stay in the main packet,
+        # all the other (copied) properties move to the extended packet.
+        description = self.xmp.find(".//rdf:Description", const.NAMESPACES)
+        description.attrib.pop(const.XMPNOTE_HAS_EXTENDED_XMP, None)
+        xmp = self.xmp_packet(self.xmp)
+        if len(xmp) <= XMP_MAX_SIZE:
+            return xmp, None
+
+        self.logger.info("XMP metadata too large for one JPEG segment, writing ExtendedXMP")
+        standard = copy.deepcopy(self.xmp)
+        standard_description = standard.find(".//rdf:Description", const.NAMESPACES)
+        extended = etree.fromstring(const.XMP_EXTENDED)
+        extended_description = extended.find(".//rdf:Description", const.NAMESPACES)
+        for child in list(standard_description):
+            if child.tag != const.CONTAINER_DIRECTORY:
+                extended_description.append(child)
+        extended_xmp = etree.tostring(extended)
+        standard_description.set(const.XMPNOTE_HAS_EXTENDED_XMP, JpegFile.extended_xmp_guid(extended_xmp))
+        return self.xmp_packet(standard), extended_xmp
+
+    def stream_image(self) -> bool:
+        return self.stream_threshold is not None and os.path.getsize(self.image_fpath) > self.stream_threshold
+
+    def jpeg_with_xmp(self) -> list:
+        xmp, extended_xmp = self.split_xmp()
+        if not self.stream_image():
+            return [JpegFile(self.read_image()).with_xmp(xmp, extended_xmp)]
+        # Only the header segments are read and rewritten, the scan data is copied from the file
+        with open(self.image_fpath, "rb") as f:
+            sos = find_sos_in_file(f)
+            if sos is None:
+                raise ValueError("No start of scan found")
+            f.seek(0)
+            header = f.read(sos + 2)
+        return [
+            JpegFile(header).with_xmp(xmp, extended_xmp),
+            FileRange(self.image_fpath, sos + 2, os.path.getsize(self.image_fpath) - sos - 2),
+        ]
+
+    def heic_with_xmp(self) -> list:
+        # Always read to memory, the meta box is rebuilt from the whole file
+        return [HeifFile(self.read_image()).with_xmp(self.xmp_packet(self.xmp))]
+
+    def exiftool_with_xmp(self) -> list:
+        xmp_updated = self.output_fpath + ".XMP"
+        with open(xmp_updated, "wb") as f:
+            f.write(etree.tostring(self.xmp, pretty_print=True))
+        self.temp_files.append(xmp_updated)
+
+        xmp_image = enrich_fname(self.output_fpath, "XMP")
+        shutil.copyfile(self.image_fpath, xmp_image)
+        self.temp_files.append(xmp_image)
+        self.exiftool.execute(
+            *[
+                "-overwrite_original",
+                "-tagsfromfile",
+                xmp_updated,
+                "-xmp",
+                xmp_image,
+            ]
+        )
+        if self.stream_image():
+            # The temp file is deleted only after the output is written
+            return [FileRange(xmp_image, 0, os.path.getsize(xmp_image))]
+        return [read_file(xmp_image)]
+
+    def fallback_xmp(self, error: ValueError) -> list:
+        # The image couldn't be edited natively, ExifTool writes the XMP instead
+        self.logger.warning("Could not write XMP directly (%s), falling back to ExifTool", error)
+        with self.span("exiftool_xmp") as span:
+            image = self.exiftool_with_xmp()
+            span["bytes"] = sum(segment_size(segment) for segment in image)
+        return image
+
+    def span(self, stage: str, nbytes: int = 0):
+        return self.profiler.span(stage, self.image_fpath, nbytes)
+
+    def read_image(self) -> bytes:
+        return read_file(self.image_fpath)
+
+    def video_range(self) -> FileRange:
+        return FileRange(self.video_fpath, 0, os.path.getsize(self.video_fpath))
+
+    def still_image_time(self) -> tuple:
+        return read_still_image_time(self.video_fpath)
+
+    def read_metadata(self) -> tuple:
+        image_metadata, video_metadata = self.image_metadata, self.video_metadata
+        if image_metadata is None or video_metadata is None:
+            with self.span("metadata"):
+                image_metadata, video_metadata = prefetch_metadata(
+                    self.exiftool, [self.image_fpath, self.video_fpath]
+                )
+        if not image_metadata or not video_metadata:
+            self.logger.error("Could not read metadata of %s", self.image_fpath if not image_metadata else self.video_fpath)
+            sys.exit(1)
+        return image_metadata, video_metadata
+
+    def mux(self) -> str:
+        return self.write(self.compose())
+
+    def compose(self) -> list:
+        # Reads metadata and builds the output as a list of segments (see write_segments)
         self.logger.info("Processing %s", self.image_fpath)
 
-        image_metadata, video_metadata = self.exiftool.get_metadata(
-            [self.image_fpath, self.video_fpath]
-        )
+        image_metadata, video_metadata = self.read_metadata()
         
         for ns in const.NAMESPACES:
             etree.register_namespace(ns, const.NAMESPACES[ns])
@@ -203,22 +330,10 @@ class Muxer:
         self.validate_video(self.video_fpath, metadata=video_metadata)
 
         if self.no_xmp is False:
-            result = self.exiftool.execute(
-                *[
-                    "-X",
-                    "-ee",
-                    "-n",
-                    "-QuickTime:StillImageTime",
-                    "-QuickTime:TrackDuration",
-                    f"{self.video_fpath}",
-                ]
-            )
-            
             try:
-                track_number = extract_track_number(result)
+                with self.span("keyframe"):
+                    track_number, track_duration = self.still_image_time()
                 self.logger.info("Live Photo keyframe track number: %s", track_number)
-
-                track_duration = extract_track_duration(track_number, result)
                 self.logger.info("Live Photo keyframe: %sus", track_duration)
                 
                 self.xmp.find(".//rdf:Description", const.NAMESPACES).set(
@@ -229,11 +344,11 @@ class Muxer:
                 track_duration = -1
                 self.logger.info("Could not read Live Photo keyframe (source video is probably not from Live Photo). No keyframe will be set.")
 
-            video_data = read_file(self.video_fpath)
-            samsung_tail = SamsungTags(video_data, image_type)
+            video = self.video_range()
+            samsung_tail = SamsungTags(segment_size(video), image_type)
             
-            result = self.exiftool.execute(*["-XMP", "-b", f"{self.image_fpath}"])
-            if result == "":
+            result = image_metadata.get("XMP:XMP")
+            if not result:
                 self.logger.warning("XMP of original file is empty")
             else:
                 self.merge_xmp(result)
@@ -241,46 +356,59 @@ class Muxer:
             self.change_xmpresource(str(samsung_tail.get_video_size()), attribute=const.ITEM_LENGTH, semantic="MotionPhoto")
             self.change_xmpresource(str(samsung_tail.get_image_padding()), attribute=const.ITEM_PADDING, semantic="Primary")
 
-            xmp_updated = self.output_fpath + ".XMP"
-            with open(xmp_updated, "wb") as f:
-                f.write(etree.tostring(self.xmp, pretty_print=True))
-
-            xmp_image = enrich_fname(self.output_fpath, "XMP")
-            shutil.copyfile(self.image_fpath, xmp_image)
-            self.exiftool.execute(
-                *[
-                    "-overwrite_original",
-                    "-tagsfromfile",
-                    xmp_updated,
-                    "-xmp",
-                    xmp_image,
-                ]
-            )
-            
-            merged_bytes = read_file(xmp_image)
+            try:
+                with self.span("image") as span:
+                    if image_type == "heic":
+                        image = self.heic_with_xmp()
+                    else:
+                        image = self.jpeg_with_xmp()
+                    span["bytes"] = sum(segment_size(segment) for segment in image)
+            except ValueError as e:
+                image = self.fallback_xmp(e)
         else:
-            video_data = read_file(self.video_fpath)
-            samsung_tail = SamsungTags(video_data, image_type)
-            merged_bytes = read_file(self.image_fpath)
-        samsung_tail.set_image_size(len(merged_bytes))
-        video_footer = samsung_tail.video_footer()
-        merged_bytes += video_footer
-
+            video = self.video_range()
+            samsung_tail = SamsungTags(segment_size(video), image_type)
+            with self.span("image") as span:
+                if self.stream_image():
+                    image = [FileRange(self.image_fpath, 0, os.path.getsize(self.image_fpath))]
+                else:
+                    image = [self.read_image()]
+                span["bytes"] = sum(segment_size(segment) for segment in image)
+        samsung_tail.set_image_size(sum(segment_size(segment) for segment in image))
+        return image + samsung_tail.video_footer(video)
+
+    def write(self, segments: list) -> str:
         self.logger.info("Writing output file: %s", self.output_fpath)
-        with open(self.output_fpath, "wb") as binary_file:
-            binary_file.write(merged_bytes)
-        shutil.copystat(self.image_fpath, self.output_fpath)
-
-        if self.delete_temp is True:
-            os.remove(xmp_updated)
-            self.logger.debug("Delete: %s", xmp_updated)
-            os.remove(xmp_image)
-            self.logger.debug("Delete: %s", xmp_image)
-
-        if self.delete_video is True:
-            os.remove(self.video_fpath)
-            self.logger.debug("Delete: %s", self.video_fpath)
-            
-        if self.overwrite is True and self.output_fpath != self.org_outfpath:
-            os.remove(self.org_outfpath)
-            self.logger.debug("Delete: %s", self.org_outfpath)
+        # Written next to the output and renamed over it once it is on disk, so the output path never
+        # holds a partial file, even after a power failure
+        partial_fpath = partial_fname(self.output_fpath)
+        try:
+            with self.span("write", sum(segment_size(segment) for segment in segments)):
+                with open(partial_fpath, "wb") as binary_file:
+                    write_segments(binary_file, segments)
+            with self.span("copystat"):
+                shutil.copystat(self.image_fpath, partial_fpath)
+            with self.span("fsync"):
+                fsync_file(partial_fpath)
+                os.replace(partial_fpath, self.output_fpath)
+                fsync_directory(os.path.dirname(self.output_fpath))
+        except BaseException:
+            if os.path.exists(partial_fpath):
+                os.remove(partial_fpath)
+            raise
+
+        with self.span("delete"):
+            if self.delete_temp is True:
+                for temp_file in self.temp_files:
+                    os.remove(temp_file)
+                    self.logger.debug("Delete: %s", temp_file)
+
+            if self.delete_video is True:
+                os.remove(self.video_fpath)
+                self.logger.debug("Delete: %s", self.video_fpath)
+                
+            if self.overwrite is True and self.output_fpath != self.org_outfpath:
+                os.remove(self.org_outfpath)
+                self.logger.debug("Delete: %s", self.org_outfpath)
+
+        return self.output_fpath
@@ -0,0 +1,149 @@
+import contextlib
+import json
+import math
+import os
+import threading
+import time
+
+
+def percentile(values: list, p: float) -> float:
+    # Nearest-rank percentile of already sorted values
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class Profiler:
+
+    # Opt-in tracing (--profile report.json) of wall time and bytes moved per named stage.
+    # A disabled profiler (the default) records nothing, so callers never need to check.
+    # Spans recorded in worker processes are returned as plain tuples and merged with add_spans.
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.started = time.time()
+        self.spans = []  # (stage, file, start, seconds, bytes)
+        self.lock = threading.Lock()
+
+    def add(self, stage: str, fpath: str, start: float, seconds: float, nbytes: int = 0):
+        if self.enabled:
+            with self.lock:
+                self.spans.append((stage, fpath, start, seconds, nbytes))
+
+    def add_spans(self, spans: list):
+        if self.enabled and spans:
+            with self.lock:
+                self.spans.extend(spans)
+
+    @contextlib.contextmanager
+    def span(self, stage: str, fpath: str = None, nbytes: int = 0):
+        # Yields a dict, set its "bytes" when the amount is only known at the end of the stage
+        measured = {"bytes": nbytes}
+        if not self.enabled:
+            yield measured
+            return
+        start = time.time()
+        counter = time.perf_counter()
+        try:
+            yield measured
+        finally:
+            self.add(stage, fpath, start, time.perf_counter() - counter, measured["bytes"])
+
+    def iterate(self, stage: str, iterable):
+        # Times every step of a (lazy) iterable, e.g. the directory scan interleaved with matching
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            counter = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, None, start, time.perf_counter() - counter)
+                return
+            self.add(stage, None, start, time.perf_counter() - counter)
+            yield item
+
+    def report(self) -> dict:
+        with self.lock:
+            spans = list(self.spans)
+
+        stages = {}
+        files = {}
+        for stage, fpath, start, seconds, nbytes in spans:
+            stages.setdefault(stage, []).append((seconds, nbytes))
+            if fpath is not None:
+                entry = files.setdefault(fpath, {"seconds": 0.0, "bytes": 0, "spans": []})
+                entry["seconds"] += seconds
+                entry["bytes"] += nbytes
+                entry["spans"].append({
+                    "stage": stage,
+                    "start": round(start - self.started, 6),
+                    "seconds": round(seconds, 6),
+                    "bytes": nbytes,
+                })
+
+        aggregate = {}
+        for stage, values in stages.items():
+            durations = sorted(seconds for seconds, _ in values)
+            aggregate[stage] = {
+                "count": len(values),
+                "seconds": round(sum(durations), 6),
+                "bytes": sum(nbytes for _, nbytes in values),
+                "p50": round(percentile(durations, 50), 6),
+                "p95": round(percentile(durations, 95), 6),
+                "p99": round(percentile(durations, 99), 6),
+                "max": round(durations[-1], 6),
+            }
+        for entry in files.values():
+            entry["seconds"] = round(entry["seconds"], 6)
+
+        return {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "wall_seconds": round(time.time() - self.started, 6),
+            "stages": aggregate,
+            "files": files,
+        }
+
+    @staticmethod
+    def prometheus(report: dict) -> str:
+        lines = [
+            "# HELP motionphoto2_stage_seconds Wall time spent in a muxing stage.",
+            "# TYPE motionphoto2_stage_seconds summary",
+        ]
+        for stage, entry in report["stages"].items():
+            for quantile in ("p50", "p95", "p99"):
+                lines.append(
+                    f'motionphoto2_stage_seconds{{stage="{stage}",quantile="0.{quantile[1:]}"}} {entry[quantile]}'
+                )
+            lines.append(f'motionphoto2_stage_seconds_sum{{stage="{stage}"}} {entry["seconds"]}')
+            lines.append(f'motionphoto2_stage_seconds_count{{stage="{stage}"}} {entry["count"]}')
+        lines += [
+            "# HELP motionphoto2_stage_bytes_total Bytes moved in a muxing stage.",
+            "# TYPE motionphoto2_stage_bytes_total counter",
+        ]
+        for stage, entry in report["stages"].items():
+            lines.append(f'motionphoto2_stage_bytes_total{{stage="{stage}"}} {entry["bytes"]}')
+        lines += [
+            "# HELP motionphoto2_run_seconds Wall time of the whole run.",
+            "# TYPE motionphoto2_run_seconds gauge",
+            f"motionphoto2_run_seconds {report['wall_seconds']}",
+            "# HELP motionphoto2_files_total Files with at least one recorded stage.",
+            "# TYPE motionphoto2_files_total gauge",
+            f"motionphoto2_files_total {len(report['files'])}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def save(self, fpath: str) -> tuple:
+        # Writes report JSON to fpath and the Prometheus textfile next to it (.prom).
+        # Both are written to a temp file first, so a textfile collector never reads a partial file.
+        report = self.report()
+        prom_fpath = os.path.splitext(fpath)[0] + ".prom"
+        for target, content in ((fpath, json.dumps(report, indent=2)), (prom_fpath, self.prometheus(report))):
+            temp_fpath = target + ".tmp"
+            with open(temp_fpath, "w") as f:
+                f.write(content)
+            os.replace(temp_fpath, target)
+        return fpath, prom_fpath
@@ -5,22 +5,24 @@ import struct
 import constants as const
 
 class SamsungTags:
-    
+
     # This class is responsible for creating the video footer that is attached after image data
-    # It also creates offsets for the XMP image/video in the main image. 
-    
+    # It also creates offsets for the XMP image/video in the main image.
+    # The layout is computed from sizes only. The footer is returned as a list of segments,
+    # where the video payload is represented by whatever object the caller passes in
+    # (e.g. a FileRange), so the video itself is never touched here.
+
     def __init__(
         self,
-        video_bytes: bytes,
+        video_size: int,
         image_type: str = "heic"
     ):
-        self.video_bytes = video_bytes
-        self.video_size = len(video_bytes)
+        self.video_size = video_size
         self.image_type = image_type
         self.image_size = 0 # we don't know yet - image size may change after we fill in the XMP tags about video
         self.tags = {"MotionPhoto_Version": bytes("mpv3", "utf-8")}
         if self.image_type not in ["heic"]:
-            self.tags["MotionPhoto_Data"] = self.video_bytes
+            self.tags["MotionPhoto_Data"] = None # video goes here
         else:
             self.tags["MotionPhoto_Data"] = bytes("mpv2___.___.", "utf-8") # dummy data for length computation
 
@@ -32,41 +34,54 @@ class SamsungTags:
             mp_data += struct.pack(">i", video_offset)
             mp_data += struct.pack(">i", self.video_size)
             self.tags["MotionPhoto_Data"] = mp_data
-        
+
+    def tag_header(self, tag: str) -> bytes:
+        return const.SAMSUNG_TAG_IDS[tag] + struct.pack("<i", len(tag)) + bytes(tag, "utf-8")
+
+    def tag_data_size(self, tag: str) -> int:
+        data = self.tags[tag]
+        return self.video_size if data is None else len(data)
+
+    def layout(self) -> tuple:
+        # Returns {tag: (offset, length)} for SEFH, where offset is the distance from the start
+        # of the tag to the start of SEFH, and the total size of all tags
+        tags = [tag for tag in const.SAMSUNG_TAG_IDS if tag in self.tags]
+        lengths = [len(self.tag_header(tag)) + self.tag_data_size(tag) for tag in tags]
+        table = {}
+        offset = 0
+        for tag, length in zip(reversed(tags), reversed(lengths)):
+            offset += length
+            table[tag] = (offset, length)
+        return table, offset
+
+    def sefh_size(self) -> int:
+        return 12 + 12 * len(self.tags) + 8
+
     def get_image_padding(self) -> int:
         if self.image_type in ["heic"]:
             return const.MPVD_BOX_SIZE
-        size = 0
-        for tag in const.SAMSUNG_TAG_IDS:
-            if tag in self.tags:
-                size += len(const.SAMSUNG_TAG_IDS[tag])
-                size += 4 # place to put size of string on next line
-                size += len(tag)
-                if tag == "MotionPhoto_Data": return size
-                size += len(self.tags[tag])
-        return -1 # should never come here
-    
+        table, tags_size = self.layout()
+        return tags_size - table["MotionPhoto_Data"][0] + len(self.tag_header("MotionPhoto_Data"))
+
+    def footer_size(self) -> int:
+        # Size of the whole footer (see video_footer), video included
+        table, tags_size = self.layout()
+        footer_size = tags_size + self.sefh_size()
+        if self.image_type in ["heic"]:
+            footer_size += const.MPVD_BOX_SIZE + self.video_size + const.SEFD_BOX_SIZE
+        return footer_size
+
     def get_video_size(self) -> int:
-        return len(self.video_footer()) - self.get_image_padding()
+        return self.footer_size() - self.get_image_padding()
 
-    def video_footer(self) -> bytes:
-        tag_data = b''
-        tag_offsets = {}
-        tag_lengths = {}
+    def video_footer(self, video=None) -> list:
+        table, tags_size = self.layout()
+
+        tag_data = []
         for tag in const.SAMSUNG_TAG_IDS:
             if tag in self.tags:
-                tag_bytes =  const.SAMSUNG_TAG_IDS[tag]
-                tag_bytes += struct.pack("<i", len(tag))
-                tag_bytes += bytes(tag, "utf-8")
-                tag_bytes += self.tags[tag]
-                tag_data += tag_bytes
-                tag_length = len(tag_bytes)
-                tag_lengths[tag] = tag_length
-                for preceding_tag in const.SAMSUNG_TAG_IDS:
-                    if preceding_tag in self.tags:
-                        tag_offsets[preceding_tag] = tag_length + (tag_offsets[preceding_tag] if preceding_tag in tag_offsets else 0)
-                        if preceding_tag == tag:
-                            break
+                tag_data.append(self.tag_header(tag))
+                tag_data.append(video if self.tags[tag] is None else self.tags[tag])
 
         sefh = b''
         sefh += bytes("SEFH", "utf-8")
@@ -75,22 +90,19 @@ class SamsungTags:
         for tag in const.SAMSUNG_TAG_IDS:
             if tag in self.tags:
                 sefh += const.SAMSUNG_TAG_IDS[tag]
-                sefh += struct.pack("<i", tag_offsets[tag])
-                sefh += struct.pack("<i", tag_lengths[tag])
+                sefh += struct.pack("<i", table[tag][0])
+                sefh += struct.pack("<i", table[tag][1])
         sefh_len = len(sefh)
         sefh += struct.pack("<i", sefh_len)
         sefh += bytes("SEFT", "utf-8")
-        
-        result = b''
+
+        result = []
         if self.image_type in ["heic"]:
-            result += self.video_bytes
-            result += struct.pack(">i", len(tag_data) + len(sefh) + const.SEFD_BOX_SIZE)
-            result += const.SEFD_BOX_NAME
+            mpvd_size = const.MPVD_BOX_SIZE + self.video_size + const.SEFD_BOX_SIZE + tags_size + len(sefh)
+            result.append(struct.pack(">i", mpvd_size) + const.MPVD_BOX_NAME)
+            result.append(video)
+            result.append(struct.pack(">i", tags_size + len(sefh) + const.SEFD_BOX_SIZE) + const.SEFD_BOX_NAME)
         result += tag_data
-        result += sefh
-        if self.image_type in ["heic"]:
-            mpvd_header = struct.pack(">i", len(result) + const.MPVD_BOX_SIZE)
-            mpvd_header += const.MPVD_BOX_NAME
-            result = mpvd_header + result
-            
-        return result
\ No newline at end of file
+        result.append(sefh)
+
+        return result
@@ -0,0 +1,373 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+import traceback
+
+from pathlib import Path
+
+import constants as const
+from CopyPool import CopyPool
+from ExifToolPool import ExifToolPool
+from FilenameMatcher import FilenameMatcher
+from IncrementalIndex import IncrementalIndex
+from Muxer import Muxer
+from Profiler import Profiler
+from utils import is_motion_photo, input_output_binary_compare, prefetch_metadata, scan_directory
+
+# A file is handled once its size and mtime haven't changed for this long
+DEBOUNCE_SECONDS = 2.0
+# How long a settled image or video waits for the other half of its pair
+PAIR_TIMEOUT = 60.0
+# Directory listing interval when inotify is not available
+POLL_INTERVAL = 5.0
+# Longest wait for events, also the resolution of the debounce and pair timeout checks
+TICK_SECONDS = 0.5
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+
+class InotifyEvents:
+
+    # Change notifications from Linux inotify, called through libc (no extra dependency).
+    # Every directory of the tree is watched, new subdirectories are added as they appear
+    # and listed once, since files may land in them before the watch exists.
+
+    def __init__(self, root: str, recursive: bool = False):
+        libc_name = ctypes.util.find_library("c")
+        if not sys.platform.startswith("linux") or libc_name is None:
+            raise OSError("inotify is not available on this platform")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.root = root
+        self.recursive = recursive
+        self.directories = {}  # watch descriptor -> directory relative to root
+        self.initial = self.add_tree("")
+
+    def add_tree(self, rel_dir: str) -> list:
+        # Watches rel_dir (and its subdirectories when recursive), returns the files already in it
+        files = []
+        for images, videos, others in scan_directory(os.path.join(self.root, rel_dir), self.recursive):
+            files += [os.path.join(rel_dir, file) if rel_dir else file for file in images + videos + others]
+        directories = [rel_dir]
+        if self.recursive:
+            for directory, subdirectories, _ in os.walk(os.path.join(self.root, rel_dir)):
+                directories += [os.path.relpath(os.path.join(directory, d), self.root) for d in subdirectories]
+        for directory in directories:
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(os.path.join(self.root, directory)), WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"Could not watch {os.path.join(self.root, directory)}")
+            self.directories[wd] = directory
+        return files
+
+    def changes(self, timeout: float) -> list:
+        # Relative paths of the files created or written to, waits up to timeout for the first event
+        if self.initial is not None:
+            files, self.initial = self.initial, None
+            return files
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        files = []
+        pos = 0
+        while pos + INOTIFY_EVENT.size <= len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, pos)
+            name = os.fsdecode(data[pos + INOTIFY_EVENT.size:pos + INOTIFY_EVENT.size + length].rstrip(b"\0"))
+            pos += INOTIFY_EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped, list everything once (unchanged files are ignored by the watcher)
+                files += self.add_tree("")
+                continue
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+            rel_dir = self.directories.get(wd)
+            if rel_dir is None or not name:
+                continue
+            rel_path = os.path.join(rel_dir, name) if rel_dir else name
+            if mask & IN_ISDIR:
+                if self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                    files += self.add_tree(rel_path)
+                continue
+            files.append(rel_path)
+        return files
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingEvents:
+
+    # Fallback for platforms without inotify: the tree is listed every `interval` seconds
+    # and the files with a new size or mtime are reported.
+
+    def __init__(self, root: str, recursive: bool = False, interval: float = POLL_INTERVAL):
+        self.root = root
+        self.recursive = recursive
+        self.interval = interval
+        self.snapshot = {}
+        self.next_poll = time.monotonic()
+
+    def changes(self, timeout: float) -> list:
+        now = time.monotonic()
+        if now < self.next_poll:
+            time.sleep(min(timeout, self.next_poll - now))
+            return []
+        self.next_poll = now + self.interval
+        snapshot = {}
+        files = []
+        for images, videos, others in scan_directory(self.root, self.recursive):
+            for file in images + videos + others:
+                snapshot[file] = file_stat(os.path.join(self.root, file))
+                if snapshot[file] != self.snapshot.get(file):
+                    files.append(file)
+        self.snapshot = snapshot
+        return files
+
+    def close(self):
+        pass
+
+
+def file_stat(fpath: str) -> tuple:
+    try:
+        st = os.stat(fpath)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+class Watcher:
+
+    # Watch mode (--watch): muxes each pair as soon as both halves have landed in the input tree.
+    # Files already in the tree are picked up once at start, after that only reported changes are looked at.
+    # A file is handled when its size and mtime didn't change for `debounce` seconds, so partially
+    # written files are never read. Settled images and videos then wait up to `pair_timeout` seconds
+    # for their other half, matched by file name or by ContentIdentifier (exif_match).
+    # A file that can't be handled (unreadable, ExifTool hung on it) is counted as failed, watching goes on.
+    # Everything runs in one thread with one warm ExifTool.
+
+    def __init__(
+        self,
+        exiftool: ExifToolPool,
+        input_directory: str,
+        output_directory: str,
+        recursive: bool = False,
+        exif_match: bool = False,
+        pairing_rules: list = None,
+        index: IncrementalIndex = None,
+        copier: CopyPool = None,
+        pair_timeout: float = PAIR_TIMEOUT,
+        debounce: float = DEBOUNCE_SECONDS,
+        mux_options: dict = None,
+        verbose: bool = False,
+        profiler: Profiler = None,
+    ):
+        self.exiftool = exiftool
+        self.input_directory = Path(input_directory).resolve()
+        self.output_directory = Path(output_directory).resolve()
+        self.recursive = recursive
+        self.exif_match = exif_match
+        self.pairing_rules = pairing_rules
+        self.index = index
+        self.copier = copier
+        self.pair_timeout = pair_timeout
+        self.debounce = debounce
+        self.mux_options = mux_options or {}
+        self.verbose = verbose
+        self.profiler = profiler if profiler is not None else Profiler()
+
+        self.settling = {}  # file -> (stat, monotonic time of the last change)
+        self.handled = {}  # file -> stat when it was handled, later events without a change are ignored
+        self.images = {}  # file -> (monotonic arrival time, metadata, content id)
+        self.videos = {}
+        self.muxed = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def events(self):
+        try:
+            events = InotifyEvents(str(self.input_directory), self.recursive)
+            print(f"Watching {self.input_directory} for new files (inotify)")
+        except OSError as e:
+            if self.verbose:
+                print(f"[DEBUG] {e}")
+            events = PollingEvents(str(self.input_directory), self.recursive)
+            print(f"Watching {self.input_directory} for new files (polling every {POLL_INTERVAL:g}s)")
+        return events
+
+    def run(self, stop=None):
+        # Runs until interrupted (Ctrl+C), or until stop() returns True
+        events = self.events()
+        try:
+            while stop is None or not stop():
+                for file in events.changes(TICK_SECONDS):
+                    self.changed(file)
+                self.settle()
+                self.expire()
+        except KeyboardInterrupt:
+            print("Stopped watching")
+        finally:
+            events.close()
+
+    def changed(self, file: str):
+        fpath = self.input_directory / file
+        if self.output_directory == fpath.parent or self.output_directory in fpath.parents:
+            return  # our own output
+        stat = file_stat(fpath)
+        if stat is None:
+            self.settling.pop(file, None)
+        elif self.handled.get(file) != stat:
+            self.settling[file] = (stat, time.monotonic())
+
+    def settle(self):
+        now = time.monotonic()
+        for file, (stat, since) in list(self.settling.items()):
+            if now - since < self.debounce:
+                continue
+            current = file_stat(self.input_directory / file)
+            if current is None:
+                del self.settling[file]
+            elif current != stat:
+                self.settling[file] = (current, now)
+            else:
+                del self.settling[file]
+                self.handled[file] = stat
+                self.attempt(file, self.arrived)
+
+    def attempt(self, file: str, handle):
+        # One bad input must not end the watch
+        try:
+            handle(file)
+        except Exception as e:
+            self.failed += 1
+            print(f"[ERROR] Could not handle {file}: {e}")
+            if self.verbose:
+                print(traceback.format_exc(), end="")
+
+    def arrived(self, file: str):
+        extension = os.path.splitext(file)[1].lower()
+        if extension in const.IMAGE_EXTENSIONS:
+            with self.profiler.span("detect", str(self.input_directory / file)):
+                already_muxed = is_motion_photo(self.input_directory / file)
+            if already_muxed:
+                print(f"Input {file} is already a motion photo, skipping muxing...")
+                self.copy(file)
+                return
+            metadata, content_id = self.read_metadata(file, "MakerNotes:ContentIdentifier")
+            video = self.find_pair(file, content_id, self.videos)
+            if video is None:
+                self.images[file] = (time.monotonic(), metadata, content_id)
+            else:
+                self.mux(file, video, metadata, self.videos.pop(video)[1])
+        elif extension in const.VIDEO_EXTENSIONS:
+            metadata, content_id = self.read_metadata(file, "QuickTime:ContentIdentifier")
+            image = self.find_pair(file, content_id, self.images)
+            if image is None:
+                self.videos[file] = (time.monotonic(), metadata, content_id)
+            else:
+                self.mux(image, file, self.images.pop(image)[1], metadata)
+        else:
+            self.copy(file)
+
+    def read_metadata(self, file: str, content_id_tag: str) -> tuple:
+        # Metadata is only needed up front for matching by ContentIdentifier, Muxer reads it otherwise
+        if not self.exif_match:
+            return None, None
+        with self.profiler.span("prefetch", str(self.input_directory / file)):
+            metadata = prefetch_metadata(self.exiftool, [self.input_directory / file])[0]
+        if not metadata:
+            raise OSError("its metadata could not be read")
+        content_id = metadata.get(content_id_tag)
+        return metadata, content_id.strip() if content_id else None
+
+    def find_pair(self, file: str, content_id: str, waiting: dict) -> str:
+        # Returns the waiting file that pairs with file, or None
+        with self.profiler.span("match", str(self.input_directory / file)):
+            if self.exif_match:
+                if content_id is None:
+                    return None
+                return next((other for other, entry in waiting.items() if entry[2] == content_id), None)
+            if waiting is self.videos:
+                return FilenameMatcher(list(waiting), self.pairing_rules).match(file)
+            matcher = FilenameMatcher([file], self.pairing_rules)
+            return next((image for image in waiting if matcher.match(image) is not None), None)
+
+    def mux(self, image: str, video: str, image_metadata: dict = None, video_metadata: dict = None):
+        print("=" * 25)
+        input_image = self.input_directory / image
+        input_video = self.input_directory / video
+        output_subdirectory = (self.output_directory / Path(image).parent).resolve()
+        output_subdirectory.mkdir(parents=True, exist_ok=True)
+
+        if self.index is not None:
+            output_image_path = output_subdirectory / Path(image).name
+            with self.profiler.span("incremental", str(input_image)):
+                already_muxed = self.index.lookup(input_image, input_video) is not None
+                if not already_muxed and os.path.exists(output_image_path) and input_output_binary_compare(input_video, output_image_path):
+                    self.index.record(input_image, input_video, output_image_path)
+                    already_muxed = True
+            if already_muxed:
+                self.skipped += 1
+                print(f"Destination {image} is already a motion photo, skipping...")
+                return
+
+        try:
+            output_fpath = Muxer(
+                image_fpath=str(input_image),
+                video_fpath=str(input_video),
+                exiftool=self.exiftool,
+                output_directory=str(output_subdirectory),
+                image_metadata=image_metadata,
+                video_metadata=video_metadata,
+                verbose=self.verbose,
+                profiler=self.profiler,
+                **self.mux_options,
+            ).mux()
+        except SystemExit:
+            self.failed += 1
+            return
+        except Exception:
+            self.failed += 1
+            print(traceback.format_exc(), end="")
+            return
+        self.muxed += 1
+        if self.index is not None:
+            self.index.record(input_image, input_video, output_fpath, (image_metadata or {}).get("MakerNotes:ContentIdentifier"))
+            self.index.commit()
+
+    def expire(self):
+        now = time.monotonic()
+        for waiting in (self.images, self.videos):
+            for file, (arrived, _, _) in list(waiting.items()):
+                if now - arrived < self.pair_timeout:
+                    continue
+                del waiting[file]
+                if waiting is self.images:
+                    print(f"No matching video found for {file}")
+                elif self.verbose:
+                    print(f"[DEBUG] No matching image found for {file}")
+                self.attempt(file, self.copy)
+
+    def copy(self, file: str):
+        if self.copier is not None:
+            self.copier.report(file, *self.copier.copy(file))
+
+    def summary(self) -> str:
+        return f"Muxed {self.muxed} pair(s), {self.skipped} skipped, {self.failed} failed"
@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Offline benchmark of the muxing stages on a synthetic Live Photo corpus.
+#
+#   python benchmark.py --count 200 --output results.json
+#   python benchmark.py --count 200 --output new.json --compare results.json
+#
+# The corpus consists of minimal but structurally valid files:
+#   - JPEG: real baseline 8x8-block image data, Exif with Apple MakerNotes ContentIdentifier, XMP
+#   - HEIC: ftyp/meta/mdat with a primary hvc1 item (payload is random, not decodable HEVC),
+#     an Exif item with the ContentIdentifier, and XMP
+#   - MOV/MP4: a video track (random payload) and a Live Photo metadata track with
+#     StillImageTime, plus a Keys ContentIdentifier
+# The files are written with the same JpegFile/HeifFile code the muxer uses.
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from typing import NamedTuple
+
+import constants as const
+from FilenameMatcher import FilenameMatcher
+from HeifFile import HeifFile, box, full_box
+from JpegFile import JpegFile
+from Muxer import Muxer
+from SamsungTags import SamsungTags
+from utils import FileRange, is_motion_photo, prefetch_metadata, scan_directory, segment_size
+
+RESULTS_VERSION = 1
+
+MOVIE_TIMESCALE = 600
+MOVIE_DURATION = 1800  # 3s
+STILL_IMAGE_TIME = 931  # keyframe at ~1.55s, as in the iPhone samples
+
+SOURCE_XMP = (
+    '<x:xmpmeta xmlns:x="adobe:ns:meta/">'
+    '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+    '<rdf:Description rdf:about=""'
+    ' xmlns:xmp="http://ns.adobe.com/xap/1.0/"'
+    ' xmlns:photoshop="http://ns.adobe.com/photoshop/1.0/"'
+    ' xmp:CreatorTool="{creator}"'
+    ' xmp:CreateDate="2024-06-01T12:00:00"'
+    ' photoshop:DateCreated="2024-06-01T12:00:00"/>'
+    '</rdf:RDF>'
+    '</x:xmpmeta>'
+)
+
+IDENTITY_MATRIX = struct.pack(">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+
+class CorpusPair(NamedTuple):
+    image: str
+    video: str
+    image_type: str
+    image_size: int
+    video_size: int
+    image_metadata: dict
+    video_metadata: dict
+
+
+def random_bytes(rng: random.Random, size: int) -> bytes:
+    return rng.getrandbits(size * 8).to_bytes(size, "little") if size > 0 else b""
+
+
+def source_xmp(creator: str) -> bytes:
+    return const.XPACKET_BEGIN + SOURCE_XMP.format(creator=creator).encode("utf-8") + const.XPACKET_END
+
+
+def apple_exif(content_id: str) -> bytes:
+    # Big endian TIFF: IFD0 -> ExifIFD -> MakerNote (Apple iOS), whose tag 0x0011 is the ContentIdentifier.
+    # Apple maker note offsets are relative to the start of the maker note.
+    value = content_id.encode("ascii") + b"\x00"
+    maker_note = b"Apple iOS\x00" + b"\x00\x01" + b"MM"
+    maker_note += struct.pack(">HHHII", 1, 0x0011, 2, len(value), len(maker_note) + 18) + struct.pack(">I", 0)
+    maker_note += value
+
+    tiff = b"MM\x00\x2a" + struct.pack(">I", 8)
+    tiff += struct.pack(">HHHII", 1, 0x8769, 4, 1, 26) + struct.pack(">I", 0)  # IFD0, ExifIFD at 26
+    tiff += struct.pack(">HHHII", 1, 0x927C, 7, len(maker_note), 44) + struct.pack(">I", 0)  # ExifIFD
+    return tiff + maker_note
+
+
+def jpeg_segment(marker: int, payload: bytes) -> bytes:
+    return b"\xff" + bytes([marker]) + struct.pack(">H", len(payload) + 2) + payload
+
+
+def jpeg_scan_unit(rng: random.Random) -> bytes:
+    # 8 blocks of entropy coded data: DC difference 0 ("0"), then 63 AC coefficients of +-1
+    # ("0" for run 0/size 1, then the value bit) - 127 bits per block, 127 bytes per unit
+    bits = "".join(
+        "0" + "".join("0" + rng.choice("01") for _ in range(63))
+        for _ in range(8)
+    )
+    return int(bits, 2).to_bytes(127, "big")
+
+
+def jpeg_image(rng: random.Random, size: int, content_id: str, creator: str) -> bytes:
+    # Grayscale baseline JPEG, dimensions chosen so that the scan is roughly `size` bytes
+    units = max(1, round(size / 127))
+    width_units = min(units, 64)
+    units = -(-units // width_units) * width_units
+    width, height = width_units * 64, units // width_units * 8
+
+    scan_units = [jpeg_scan_unit(rng) for _ in range(16)]
+    scan = b"".join(rng.choice(scan_units) for _ in range(units)).replace(b"\xff", b"\xff\x00")
+
+    data = b"\xff\xd8"
+    data += jpeg_segment(0xE1, b"Exif\x00\x00" + apple_exif(content_id))
+    data += jpeg_segment(0xDB, b"\x00" + b"\x01" * 64)  # DQT, all ones
+    data += jpeg_segment(0xC0, struct.pack(">BHHB", 8, height, width, 1) + b"\x01\x11\x00")  # SOF0
+    data += jpeg_segment(0xC4, b"\x00" + bytes([1] + [0] * 15) + b"\x00")  # DC: "0" -> size 0
+    data += jpeg_segment(0xC4, b"\x10" + bytes([1, 1] + [0] * 14) + b"\x01\x00")  # AC: "0" -> 0/1, "10" -> EOB
+    data += jpeg_segment(0xDA, b"\x01\x01\x00\x00\x3f\x00")  # SOS
+    data += scan + b"\xff\xd9"
+    return JpegFile(data).with_xmp(source_xmp(creator))
+
+
+def heic_meta(image_offset: int, image_length: int, exif_offset: int, exif_length: int) -> bytes:
+    hdlr = full_box(b"hdlr", 0, 0, struct.pack(">I", 0) + b"pict" + bytes(12) + b"\x00")
+    pitm = full_box(b"pitm", 0, 0, struct.pack(">H", 1))
+    iinf = full_box(
+        b"iinf", 0, 0,
+        struct.pack(">H", 2)
+        + full_box(b"infe", 2, 0, struct.pack(">HH", 1, 0) + b"hvc1\x00")
+        + full_box(b"infe", 2, 0, struct.pack(">HH", 2, 0) + b"Exif\x00")
+    )
+    iloc = full_box(
+        b"iloc", 0, 0,
+        b"\x44\x00" + struct.pack(">H", 2)
+        + struct.pack(">HHHII", 1, 0, 1, image_offset, image_length)
+        + struct.pack(">HHHII", 2, 0, 1, exif_offset, exif_length)
+    )
+    iref = full_box(b"iref", 0, 0, box(b"cdsc", struct.pack(">HHH", 2, 1, 1)))
+    return full_box(b"meta", 0, 0, hdlr + pitm + iinf + iloc + iref)
+
+
+def heic_image(rng: random.Random, size: int, content_id: str, creator: str) -> bytes:
+    ftyp = box(b"ftyp", b"heic" + struct.pack(">I", 0) + b"mif1heic")
+    image = random_bytes(rng, size)
+    exif = struct.pack(">I", 0) + apple_exif(content_id)
+    mdat_start = len(ftyp) + len(heic_meta(0, 0, 0, 0))
+    meta = heic_meta(mdat_start + 8, len(image), mdat_start + 8 + len(image), len(exif))
+    data = ftyp + meta + box(b"mdat", image + exif)
+    return HeifFile(data).with_xmp(source_xmp(creator))
+
+
+def quicktime_hdlr(handler: bytes) -> bytes:
+    return full_box(b"hdlr", 0, 0, b"mhlr" + handler + bytes(12) + b"\x00")
+
+
+def quicktime_track(track_id: int, duration: int, handler: bytes, media_header: bytes, sample_entry: bytes,
+                    sample_offset: int, sample_size: int) -> bytes:
+    tkhd = full_box(
+        b"tkhd", 0, 7,
+        struct.pack(">IIIII", 0, 0, track_id, 0, duration) + bytes(8)
+        + struct.pack(">HHHH", 0, 0, 0, 0) + IDENTITY_MATRIX + struct.pack(">II", 0, 0)
+    )
+    mdhd = full_box(b"mdhd", 0, 0, struct.pack(">IIIIHH", 0, 0, MOVIE_TIMESCALE, duration, 0, 0))
+    dinf = box(b"dinf", full_box(b"dref", 0, 0, struct.pack(">I", 1) + full_box(b"url ", 0, 1, b"")))
+    stbl = box(
+        b"stbl",
+        full_box(b"stsd", 0, 0, struct.pack(">I", 1) + sample_entry)
+        + full_box(b"stts", 0, 0, struct.pack(">III", 1, 1, duration))
+        + full_box(b"stsc", 0, 0, struct.pack(">IIII", 1, 1, 1, 1))
+        + full_box(b"stsz", 0, 0, struct.pack(">III", 0, 1, sample_size))
+        + full_box(b"stco", 0, 0, struct.pack(">II", 1, sample_offset))
+    )
+    minf = box(b"minf", media_header + dinf + stbl)
+    return box(b"trak", tkhd + box(b"mdia", mdhd + quicktime_hdlr(handler) + minf))
+
+
+def quicktime_video(rng: random.Random, size: int, content_id: str, mp4: bool = False) -> bytes:
+    # The keyframe sample holds a single item: the still-image-time key (local id 1) with value -1
+    ftyp = box(b"ftyp", b"isom" + struct.pack(">I", 0x200) + b"isommp42") if mp4 else \
+        box(b"ftyp", b"qt  " + struct.pack(">I", 0x20050300) + b"qt  ")
+    video = random_bytes(rng, size)
+    still_sample = struct.pack(">I4sb", 9, struct.pack(">I", 1), -1)
+    video_offset = len(ftyp) + 8
+    still_offset = video_offset + len(video)
+    mdat = box(b"mdat", video + still_sample)
+
+    video_entry = box(
+        b"avc1",
+        bytes(6) + struct.pack(">H", 1) + bytes(16) + struct.pack(">HHII", 1920, 1080, 0x480000, 0x480000)
+        + bytes(4) + struct.pack(">H", 1) + bytes(32) + struct.pack(">Hh", 24, -1)
+    )
+    mebx_entry = box(
+        b"mebx",
+        bytes(6) + struct.pack(">H", 1)
+        + box(b"keys", box(struct.pack(">I", 1), box(b"keyd", b"mdta" + const.STILL_IMAGE_TIME_KEY)))
+    )
+    content_key = b"com.apple.quicktime.content.identifier"
+    moov = box(
+        b"moov",
+        full_box(
+            b"mvhd", 0, 0,
+            struct.pack(">IIIIIH", 0, 0, MOVIE_TIMESCALE, MOVIE_DURATION, 0x10000, 0x100) + bytes(10)
+            + IDENTITY_MATRIX + bytes(24) + struct.pack(">I", 3)
+        )
+        + quicktime_track(1, MOVIE_DURATION, b"vide", full_box(b"vmhd", 0, 1, bytes(8)),
+                          video_entry, video_offset, len(video))
+        + quicktime_track(2, STILL_IMAGE_TIME, b"meta", full_box(b"nmhd", 0, 0, b""),
+                          mebx_entry, still_offset, len(still_sample))
+        + box(
+            b"meta",
+            full_box(b"hdlr", 0, 0, struct.pack(">I", 0) + b"mdta" + bytes(12) + b"\x00")
+            + full_box(b"keys", 0, 0, struct.pack(">II", 1, 8 + len(content_key)) + b"mdta" + content_key)
+            + box(b"ilst", box(struct.pack(">I", 1), box(b"data", struct.pack(">II", 1, 0) + content_id.encode("ascii"))))
+        )
+    )
+    return ftyp + mdat + moov
+
+
+def generate_corpus(
+    directory: str,
+    count: int,
+    image_format: str = "mixed",
+    video_format: str = "mov",
+    image_size: int = 2 * 1024 * 1024,
+    video_size: int = 3 * 1024 * 1024,
+    seed: int = 0,
+) -> list:
+    # Writes `count` image/video pairs named like iPhone exports (IMG_0001.JPG + IMG_0001.MOV)
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    pairs = []
+    for i in range(count):
+        image_type = image_format if image_format != "mixed" else ("jpg", "heic")[i % 2]
+        content_id = str(uuid.UUID(int=rng.getrandbits(128))).upper()
+        stem = f"IMG_{i + 1:04d}"
+
+        if image_type == "heic":
+            image = heic_image(rng, image_size, content_id, stem)
+        else:
+            image = jpeg_image(rng, image_size, content_id, stem)
+        video = quicktime_video(rng, video_size, content_id, mp4=video_format == "mp4")
+
+        image_fpath = os.path.join(directory, f"{stem}.{image_type.upper()}")
+        video_fpath = os.path.join(directory, f"{stem}.{video_format.upper()}")
+        with open(image_fpath, "wb") as f:
+            f.write(image)
+        with open(video_fpath, "wb") as f:
+            f.write(video)
+
+        pairs.append(CorpusPair(
+            image_fpath,
+            video_fpath,
+            image_type,
+            len(image),
+            len(video),
+            {
+                "File:FileTypeExtension": image_type.upper(),
+                "MakerNotes:ContentIdentifier": content_id,
+                "XMP:XMP": source_xmp(stem),
+            },
+            {
+                "File:FileTypeExtension": video_format.upper(),
+                "QuickTime:ContentIdentifier": content_id,
+            },
+        ))
+    return pairs
+
+
+def peak_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024, 1)
+
+
+def bench_matching(corpus: list, directory: str, output_directory: str) -> tuple:
+    matched = 0
+    for images, videos, others in scan_directory(directory):
+        matcher = FilenameMatcher(videos)
+        for image in images:
+            if matcher.match(image) is not None:
+                matched += 1
+    if matched != len(corpus):
+        raise RuntimeError(f"Matched {matched} of {len(corpus)} pairs")
+    return matched, 0
+
+
+def bench_footer(corpus: list, directory: str, output_directory: str) -> tuple:
+    # Layout only, the video is a FileRange placeholder - no bytes are moved
+    for pair in corpus:
+        samsung_tail = SamsungTags(pair.video_size, pair.image_type)
+        samsung_tail.get_video_size()
+        samsung_tail.get_image_padding()
+        samsung_tail.set_image_size(pair.image_size)
+        footer = samsung_tail.video_footer(FileRange(pair.video, 0, pair.video_size))
+        if sum(segment_size(segment) for segment in footer) <= pair.video_size:
+            raise RuntimeError(f"Invalid footer for {pair.image}")
+    return len(corpus), 0
+
+
+def bench_mux(corpus: list, directory: str, output_directory: str) -> tuple:
+    # Metadata is passed in as if prefetched, so no ExifTool is needed (see the metadata stage)
+    total = 0
+    for pair in corpus:
+        output_fpath = Muxer(
+            pair.image,
+            pair.video,
+            exiftool=None,
+            output_directory=output_directory,
+            image_metadata=dict(pair.image_metadata),
+            video_metadata=dict(pair.video_metadata),
+        ).mux()
+        total += os.path.getsize(output_fpath)
+    return len(corpus), total
+
+
+def bench_detection(corpus: list, directory: str, output_directory: str) -> tuple:
+    total = 0
+    for entry in os.scandir(output_directory):
+        if not is_motion_photo(entry.path):
+            raise RuntimeError(f"{entry.path} not detected as motion photo")
+        total += entry.stat().st_size
+    return len(corpus), total
+
+
+def bench_metadata(corpus: list, directory: str, output_directory: str) -> tuple:
+    from ExifToolPool import ExifToolPool
+    fpaths = [fpath for pair in corpus for fpath in (pair.image, pair.video)]
+    with ExifToolPool(processes=os.cpu_count() or 1) as et:
+        prefetch_metadata(et, fpaths)
+    return len(fpaths), sum(pair.image_size + pair.video_size for pair in corpus)
+
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# Stand-in for the exiftool binary (tests/stub/exiftool), so a run measures MotionPhoto2 and not ExifTool
+EXIFTOOL_STUB_DIRECTORY = os.path.join(SCRIPT_DIRECTORY, "tests", "stub")
+STARTUP_RUNS = 5
+STARTUP_BUDGET = 0.5  # seconds per single file run, from a cold interpreter to the written output
+
+
+def single_file_run(pair: CorpusPair, output_fpath: str):
+    # Muxes the pair with the command line tool (--input-image/--input-video) in a fresh interpreter,
+    # the way a job runner calls it once per file, with the ExifTool stub first in PATH.
+    # The run saves its settings next to the script like any other, the user's are put back.
+    env = dict(os.environ, PATH=EXIFTOOL_STUB_DIRECTORY + os.pathsep + os.environ.get("PATH", ""))
+    settings_fpath = os.path.join(SCRIPT_DIRECTORY, "motionphoto2.json")
+    settings = None
+    if os.path.exists(settings_fpath):
+        with open(settings_fpath, "rb") as f:
+            settings = f.read()
+    try:
+        subprocess.run(
+            [
+                sys.executable, os.path.join(SCRIPT_DIRECTORY, "motionphoto2.py"),
+                "--input-image", pair.image, "--input-video", pair.video, "--output-file", output_fpath,
+            ],
+            env=env,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+    finally:
+        if settings is None:
+            if os.path.exists(settings_fpath):
+                os.remove(settings_fpath)
+        else:
+            with open(settings_fpath, "wb") as f:
+                f.write(settings)
+
+
+def bench_startup(corpus: list, directory: str, output_directory: str) -> tuple:
+    # Outputs go to their own directory, the detection stage checks every file of output_directory
+    with tempfile.TemporaryDirectory(prefix="motionphoto2-startup-") as startup_directory:
+        for i in range(STARTUP_RUNS):
+            output_fpath = os.path.join(startup_directory, f"{i}_{os.path.basename(corpus[0].image)}")
+            single_file_run(corpus[0], output_fpath)
+    return STARTUP_RUNS, 0
+
+
+STAGES = {
+    "startup": bench_startup,
+    "matching": bench_matching,
+    "footer": bench_footer,
+    "mux": bench_mux,
+    "detection": bench_detection,
+    "metadata": bench_metadata,
+}
+
+
+def run_stage(stage: str, corpus: list, directory: str, output_directory: str, repeat: int) -> dict:
+    # Best of `repeat` runs
+    seconds = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        files, total = STAGES[stage](corpus, directory, output_directory)
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    seconds = max(seconds, 1e-9)
+    return {
+        "files": files,
+        "bytes": total,
+        "seconds": round(seconds, 6),
+        "files_per_second": round(files / seconds, 2),
+        "mb_per_second": round(total / seconds / (1024 * 1024), 2) if total else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    # Returns the stages whose throughput dropped by more than `threshold`
+    regressions = []
+    print(f"{'stage':<12}{'baseline files/s':>18}{'current files/s':>18}{'change':>10}")
+    for stage, result in results["stages"].items():
+        previous = baseline.get("stages", {}).get(stage)
+        if previous is None or not previous.get("files_per_second"):
+            continue
+        change = result["files_per_second"] / previous["files_per_second"] - 1
+        flag = ""
+        if change < -threshold:
+            regressions.append(stage)
+            flag = "  REGRESSION"
+        print(f"{stage:<12}{previous['files_per_second']:>18}{result['files_per_second']:>18}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark MotionPhoto2 on a synthetic Live Photo corpus")
+    parser.add_argument("-n", "--count", type=int, default=100, help="Number of image/video pairs")
+    parser.add_argument("--image-format", choices=["jpg", "heic", "mixed"], default="mixed")
+    parser.add_argument("--video-format", choices=["mov", "mp4"], default="mov")
+    parser.add_argument("--image-size", type=float, default=2.0, help="Image size in MB")
+    parser.add_argument("--video-size", type=float, default=3.0, help="Video size in MB")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the corpus generator")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Runs per stage, the best one is reported")
+    parser.add_argument(
+        "-s", "--stages", nargs="+", choices=list(STAGES), default=["startup", "matching", "footer", "mux", "detection"],
+        help="Stages to run (metadata needs the exiftool binary)"
+    )
+    parser.add_argument("--corpus", help="Directory for the corpus (temporary directory by default)")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated corpus and outputs")
+    parser.add_argument("-o", "--output", help="Save results as JSON")
+    parser.add_argument("-c", "--compare", help="Compare with results JSON of a previous run")
+    parser.add_argument("-t", "--threshold", type=float, default=0.1, help="Allowed slowdown for --compare")
+    parser.add_argument(
+        "--startup-budget", type=float, default=STARTUP_BUDGET, help="Allowed seconds per single file run, cold start included"
+    )
+    args = parser.parse_args()
+
+    if args.count < 1 or args.repeat < 1:
+        print("[ERROR] Count and repeat must be positive")
+        sys.exit(1)
+    if "detection" in args.stages and "mux" not in args.stages:
+        print("[ERROR] Detection stage runs on the mux outputs, add the mux stage")
+        sys.exit(1)
+
+    logging.disable(logging.WARNING)  # the muxer logs every file
+
+    root = args.corpus or tempfile.mkdtemp(prefix="motionphoto2-bench-")
+    directory = os.path.join(root, "input")
+    output_directory = os.path.join(root, "output")
+    os.makedirs(output_directory, exist_ok=True)
+    try:
+        print(f"Generating {args.count} pairs in {directory}")
+        start = time.perf_counter()
+        corpus = generate_corpus(
+            directory,
+            args.count,
+            args.image_format,
+            args.video_format,
+            int(args.image_size * 1024 * 1024),
+            int(args.video_size * 1024 * 1024),
+            args.seed,
+        )
+        generate_seconds = time.perf_counter() - start
+
+        results = {
+            "version": RESULTS_VERSION,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "corpus": {
+                "count": args.count,
+                "image_format": args.image_format,
+                "video_format": args.video_format,
+                "image_size": args.image_size,
+                "video_size": args.video_size,
+                "seed": args.seed,
+                "bytes": sum(pair.image_size + pair.video_size for pair in corpus),
+                "generate_seconds": round(generate_seconds, 3),
+            },
+            "repeat": args.repeat,
+            "stages": {},
+        }
+        for stage in STAGES:
+            if stage not in args.stages:
+                continue
+            result = run_stage(stage, corpus, directory, output_directory, args.repeat)
+            results["stages"][stage] = result
+            print(
+                f"{stage:<12}{result['files_per_second']:>12} files/s"
+                + (f"{result['mb_per_second']:>12} MB/s" if result["mb_per_second"] is not None else " " * 17)
+                + f"{result['seconds']:>12.3f} s"
+            )
+        results["peak_rss_mb"] = peak_rss_mb()
+        print(f"Peak RSS: {results['peak_rss_mb']} MB")
+    finally:
+        if not args.keep:
+            shutil.rmtree(root if args.corpus is None else directory, ignore_errors=True)
+            if args.corpus is not None:
+                shutil.rmtree(output_directory, ignore_errors=True)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {args.output}")
+
+    failed = False
+    startup = results["stages"].get("startup")
+    if startup is not None and startup["seconds"] / startup["files"] > args.startup_budget:
+        print(f"[ERROR] Cold start takes {startup['seconds'] / startup['files']:.3f} s, over the {args.startup_budget} s budget")
+        failed = True
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
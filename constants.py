@@ -32,6 +32,17 @@ XMP = """
 </x:xmpmeta>
 """
 
+XMP_EXTENDED = """
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+  <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+    <rdf:Description rdf:about=""/>
+  </rdf:RDF>
+</x:xmpmeta>
+"""
+
+XPACKET_BEGIN = bytes("<?xpacket begin='\ufeff' id='W5M0MpCehiHzreSzNTczkc9d'?>\n", "utf-8")
+XPACKET_END = bytes("<?xpacket end='w'?>", "utf-8")
+
 NAMESPACES = {
     "x": "adobe:ns:meta/",
     "rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
@@ -55,6 +66,22 @@ ITEM_MIME = "{" + NAMESPACES["Item"] + "}Mime"
 ITEM_LENGTH = "{" + NAMESPACES["Item"] + "}Length"
 ITEM_PADDING = "{" + NAMESPACES["Item"] + "}Padding"
 GCAMER_TIMESTAMP_US = "{" + NAMESPACES["GCamera"] + "}MotionPhotoPresentationTimestampUs"
+GCAMERA_MICRO_VIDEO_OFFSET = "{" + NAMESPACES["GCamera"] + "}MicroVideoOffset"
+XMPNOTE_HAS_EXTENDED_XMP = "{" + NAMESPACES["xmpNote"] + "}HasExtendedXMP"
+
+# Properties removed from the XMP when a motion photo is split back into image and video
+MOTION_PHOTO_XMP_PROPERTIES = [
+    "{" + NAMESPACES["GCamera"] + "}" + name
+    for name in (
+        "MotionPhoto",
+        "MotionPhotoVersion",
+        "MotionPhotoPresentationTimestampUs",
+        "MicroVideo",
+        "MicroVideoVersion",
+        "MicroVideoOffset",
+        "MicroVideoPresentationTimestampUs",
+    )
+]
 
 MPVD_BOX_SIZE = 8
 MPVD_BOX_NAME = bytes("mpvd", "utf-8")
@@ -74,6 +101,19 @@ SAMSUNG_TAG_IDS = {
 
 SAMSUNG_SEFH_VERSION = 107
 
+STILL_IMAGE_TIME_KEY = bytes("com.apple.quicktime.still-image-time", "utf-8")
+
+IMAGE_EXTENSIONS = [".heic", ".heif", ".avif", ".jpg", ".jpeg"]
+VIDEO_EXTENSIONS = [".mp4", ".mov"]
+
+# Filename pairing rules for directory mode: name -> (pattern, replacement) applied to file stems.
+# Both image and video stems are normalized, so e.g. IMG_E1234.HEIC (an edit) pairs with IMG_1234.MOV
+# and IMG_1234.HEIC pairs with IMG_1234_HEVC.MOV.
+FILENAME_PAIRING_RULES = {
+    "apple-edit": (r"^(IMG_)E(\d+)$", r"\1\2"),
+    "hevc-suffix": (r"^(.*)_HEVC$", r"\1"),
+}
+
 VIDEO_SIGNATURE = {
     "VIDEO": [sig.encode('iso-8859-1') for sig in ["ftyp", "wide"]],
     "NOT_VIDEO": [sig.encode('iso-8859-1') for sig in ["ftypheic", "ftypM4A", "ftypavif"]]
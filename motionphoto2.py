@@ -3,19 +3,21 @@
 
 import argparse
 import codecs
-import exiftool
-import filecmp
-import itertools
 import logging
+import multiprocessing
 import os
-import shutil
 import sys
 
 from pathlib import Path
-from gooey import GooeyParser
 
-from Muxer import Muxer
-from utils import is_motion_photo, extract_video_from_image, input_output_binary_compare, load_defaults, save_defaults
+# Everything else (Gooey/wx, exiftool, lxml, the muxing modules) is imported only in the code path
+# that needs it, so a single file run from a script doesn't pay for the GUI or the directory machinery.
+import constants as const
+from Profiler import Profiler
+from utils import load_defaults, save_defaults
+
+# Set when Gooey runs the script, its output then drives the GUI progress bar
+GUI_RUN = False
 
 logging.basicConfig(
     handlers=[logging.StreamHandler(sys.stdout)],
@@ -36,11 +38,38 @@ class Unbuffered(object):
    def __getattr__(self, attr):
        return getattr(self.stream, attr)
 
+def cli_argument(add_argument):
+    # Drops the Gooey widget options, and the metavar (Gooey's label) of flags, which argparse rejects
+    def wrapper(*args, widget=None, gooey_options=None, **kwargs):
+        if kwargs.get("action") in ("store_true", "store_false"):
+            kwargs.pop("metavar", None)
+        return add_argument(*args, **kwargs)
+    return wrapper
+
+class CliParser(argparse.ArgumentParser):
+
+    # Plain argparse parser for command line runs. Accepts the Gooey specific options,
+    # so the GUI and the command line share one set of argument definitions.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.add_argument = cli_argument(self.add_argument)
+
+    def add_argument_group(self, *args, gooey_options=None, **kwargs):
+        group = super().add_argument_group(*args, **kwargs)
+        group.add_argument = cli_argument(group.add_argument)
+        return group
+
 def main():
     
     defaults = load_defaults()
     
-    parser = GooeyParser(
+    if len(sys.argv) == 1: # GUI mode, see __main__
+        from gooey import GooeyParser
+        parser_class = GooeyParser
+    else:
+        parser_class = CliParser
+    parser = parser_class(
         prog="MotionPhoto2",
         description="Mux HEIC and JPG Live Photos into Google/Samsung Motion Photos",
     )
@@ -77,6 +106,17 @@ def main():
         gooey_options={'initial_value':defaults['exif_match']}
     )
 
+    dir_group.add_argument(
+        "-pr",
+        "--pairing-rules",
+        metavar="Pairing Rules",
+        nargs="*",
+        choices=list(const.FILENAME_PAIRING_RULES),
+        help="Extra rules for matching by file name (apple-edit: IMG_E1234 edits, hevc-suffix: IMG_1234_HEVC videos)",
+        widget='Listbox',
+        gooey_options={'initial_value':defaults['pairing_rules']}
+    )
+
     dir_group.add_argument(
         "-im",
         "--incremental-mode",
@@ -85,6 +125,77 @@ def main():
         help="Skip photos already muxed in output",
         gooey_options={'initial_value':defaults['incremental_mode']}
     )
+
+    dir_group.add_argument(
+        "-rs",
+        "--resume",
+        metavar="Resume",
+        action="store_true",
+        help="Continue an interrupted run, skipping the pairs its journal records as done",
+        gooey_options={'initial_value':defaults['resume']}
+    )
+
+    dir_group.add_argument(
+        "-po",
+        "--plan-only",
+        metavar="Plan Only",
+        help="Only match and check the files, write what would be done to this JSON lines plan",
+        widget='FileSaver',
+        gooey_options={
+            'wildcard': "JSON lines file|*.jsonl|All files (*.*)|*.*",
+            'message': "Plan file",
+            'initial_value':defaults['plan_only']
+        }
+    )
+
+    dir_group.add_argument(
+        "-ex",
+        "--execute",
+        metavar="Execute Plan",
+        help="Carry out a plan written by --plan-only (instead of an input directory)",
+        widget='FileChooser',
+        gooey_options={
+            'wildcard': "JSON lines file|*.jsonl|All files (*.*)|*.*",
+            'message': "Plan file",
+            'initial_value':defaults['execute']
+        }
+    )
+
+    dir_group.add_argument(
+        "-ps",
+        "--plan-shard",
+        metavar="Plan Shard",
+        help="Execute only shard K of N of the plan (K/N, e.g. 2/4), to split it between machines or processes",
+        gooey_options={'initial_value':defaults['plan_shard']}
+    )
+
+    dir_group.add_argument(
+        "-w",
+        "--watch",
+        metavar="Watch",
+        action="store_true",
+        help="Keep running and mux new photos and videos as they land in input directory",
+        gooey_options={'initial_value':defaults['watch']}
+    )
+
+    dir_group.add_argument(
+        "-pt",
+        "--pair-timeout",
+        metavar="Pair Timeout",
+        type=float,
+        help="Watch mode: seconds a new photo or video waits for the other half of its pair",
+        widget='DecimalField',
+        gooey_options={'min':0, 'max':86400, 'initial_value':defaults['pair_timeout']}
+    )
+
+    dir_group.add_argument(
+        "-dm",
+        "--demux",
+        metavar="Demux",
+        action="store_true",
+        help="Split motion photos back into still image and video (written to output directory)",
+        gooey_options={'initial_value':defaults['demux']}
+    )
     
     dir_group.add_argument(
         "-cu",
@@ -95,6 +206,16 @@ def main():
         gooey_options={'initial_value':defaults['copy_unmuxed']}
     )
 
+    dir_group.add_argument(
+        "-cm",
+        "--copy-mode",
+        metavar="Copy Mode",
+        choices=["reflink", "hardlink", "copy"],
+        help="How other files are copied: reflink (clone where the file system supports it), hardlink or plain copy",
+        widget='Dropdown',
+        gooey_options={'initial_value':defaults['copy_mode']}
+    )
+
     dir_group.add_argument(
         "-od",
         "--output-directory",
@@ -136,6 +257,79 @@ def main():
         gooey_options={'initial_value':defaults['keep_temp']}
     )
     
+    settings_group.add_argument(
+        "-j",
+        "--jobs",
+        metavar="Parallel Jobs",
+        type=int,
+        help="Number of files to mux in parallel (0 = all CPU cores)",
+        widget='IntegerField',
+        gooey_options={'min':0, 'max':256, 'initial_value':defaults['jobs']}
+    )
+
+    settings_group.add_argument(
+        "-ep",
+        "--exiftool-processes",
+        metavar="ExifTool Processes",
+        type=int,
+        help="Number of ExifTool processes reading metadata in parallel",
+        widget='IntegerField',
+        gooey_options={'min':1, 'max':64, 'initial_value':defaults['exiftool_processes']}
+    )
+
+    settings_group.add_argument(
+        "-et",
+        "--exiftool-timeout",
+        metavar="ExifTool Timeout",
+        type=float,
+        help="Seconds before a hung ExifTool is restarted (the file is retried once)",
+        widget='DecimalField',
+        gooey_options={'min':1, 'max':3600, 'initial_value':defaults['exiftool_timeout']}
+    )
+
+    settings_group.add_argument(
+        "-mm",
+        "--max-memory",
+        metavar="Max Memory (MiB)",
+        type=float,
+        help="Start muxing a file only while the estimated memory of the files in progress stays under this",
+        widget='DecimalField',
+        gooey_options={'min':0, 'max':1048576, 'initial_value':defaults['max_memory']}
+    )
+
+    settings_group.add_argument(
+        "-st",
+        "--stream-threshold",
+        metavar="Stream Threshold (MiB)",
+        type=float,
+        help="Images bigger than this are copied from the file while writing instead of read to memory (JPEG, or any image with no XMP)",
+        widget='DecimalField',
+        gooey_options={'min':0, 'max':1048576, 'initial_value':defaults['stream_threshold']}
+    )
+
+    settings_group.add_argument(
+        "-pl",
+        "--pipeline",
+        metavar="Pipeline",
+        choices=["pool", "async"],
+        help="How jobs are run: a process pool, or staged asyncio pipeline overlapping metadata reads, muxing and writes",
+        widget='Dropdown',
+        gooey_options={'initial_value':defaults['pipeline']}
+    )
+
+    settings_group.add_argument(
+        "-pf",
+        "--profile",
+        metavar="Profile Report",
+        help="Save timing of every stage to this JSON report (and a Prometheus .prom textfile next to it)",
+        widget='FileSaver',
+        gooey_options={
+            'wildcard': "JSON file|*.json|All files (*.*)|*.*",
+            'message': "Profile report file",
+            'initial_value':defaults['profile']
+        }
+    )
+
     settings_group.add_argument(
         "-v", 
         "--verbose",
@@ -221,7 +415,17 @@ def main():
         print("[ERROR] Input directory cannot be use with input-image or input-video")
         sys.exit(1)
 
-    if args.input_directory is None:
+    if args.execute is not None and (
+        args.input_directory is not None or args.input_image is not None or args.input_video is not None
+    ):
+        print("[ERROR] Execute plan cannot be used with input directory, input-image or input-video")
+        sys.exit(1)
+
+    if args.execute is not None and args.output_directory is not None:
+        print("[ERROR] Execute plan takes the output directory from the plan")
+        sys.exit(1)
+
+    if args.input_directory is None and args.execute is None:
         if args.input_image is None or args.input_video is None:
             print("[ERROR] Please provide both input image/video or input directory")
             sys.exit(1)
@@ -234,6 +438,28 @@ def main():
         print("[ERROR] Incremental mode cannot be used without output directory")
         sys.exit(1)
 
+    if args.resume is True and (
+        (args.input_directory is None and args.execute is None) or args.demux is True or args.watch is True
+    ):
+        print("[ERROR] Resume can only be used to convert an input directory or execute a plan")
+        sys.exit(1)
+
+    if args.plan_only is not None and (args.input_directory is None or args.demux is True or args.watch is True or args.resume is True):
+        print("[ERROR] Plan only can only be used to convert an input directory, without resume")
+        sys.exit(1)
+
+    plan_shard = None
+    if args.plan_shard is not None:
+        if args.execute is None:
+            print("[ERROR] Plan shard requires execute plan")
+            sys.exit(1)
+        from MuxPlan import parse_shard
+        try:
+            plan_shard = parse_shard(args.plan_shard)
+        except ValueError as e:
+            print(f"[ERROR] {e}")
+            sys.exit(1)
+
     if args.output_directory is not None and args.overwrite is True:
         print("[ERROR] Output directory cannot be use overwrite option")
         sys.exit(1)
@@ -250,6 +476,63 @@ def main():
         print("[ERROR] Copy Unmuxed cannot be used with delete-video option")
         sys.exit(1)
 
+    if args.copy_unmuxed is True and args.output_directory is None:
+        print("[ERROR] Copy Unmuxed requires output directory")
+        sys.exit(1)
+
+    if args.copy_mode is None:
+        args.copy_mode = "reflink"
+
+    if args.demux is True and (args.input_directory is None or args.output_directory is None):
+        print("[ERROR] Demux requires input directory and output directory")
+        sys.exit(1)
+
+    if args.watch is True and (args.input_directory is None or args.output_directory is None):
+        print("[ERROR] Watch mode requires input directory and output directory")
+        sys.exit(1)
+
+    if args.watch is True and args.demux is True:
+        print("[ERROR] Watch mode cannot be used with demux option")
+        sys.exit(1)
+
+    if args.pair_timeout is None:
+        args.pair_timeout = 60.0
+    elif args.pair_timeout < 0:
+        print("[ERROR] Pair timeout cannot be negative")
+        sys.exit(1)
+
+    if args.jobs is None:
+        args.jobs = 1
+    elif args.jobs < 0:
+        print("[ERROR] Number of parallel jobs cannot be negative")
+        sys.exit(1)
+
+    if args.pipeline is None:
+        args.pipeline = "pool"
+
+    if args.exiftool_processes is None:
+        args.exiftool_processes = 2
+    elif args.exiftool_processes < 1:
+        print("[ERROR] Number of ExifTool processes must be at least 1")
+        sys.exit(1)
+
+    if args.exiftool_timeout is None:
+        args.exiftool_timeout = 30.0
+    elif args.exiftool_timeout <= 0:
+        print("[ERROR] ExifTool timeout must be positive")
+        sys.exit(1)
+
+    if args.max_memory is not None and args.max_memory <= 0:
+        print("[ERROR] Max memory must be positive")
+        sys.exit(1)
+
+    if args.stream_threshold is None:
+        args.stream_threshold = 64.0
+    elif args.stream_threshold < 0:
+        print("[ERROR] Stream threshold cannot be negative")
+        sys.exit(1)
+    stream_threshold = int(args.stream_threshold * 1024 * 1024)
+
     if args.output_directory is not None:
         output_directory = f"{Path(args.output_directory).resolve()}"
         if os.path.exists(output_directory) is False:
@@ -265,12 +548,28 @@ def main():
     defaults['input_directory']=args.input_directory
     defaults['recursive']=args.recursive
     defaults['exif_match']=args.exif_match
+    defaults['pairing_rules']=args.pairing_rules
     defaults['incremental_mode']=args.incremental_mode
+    defaults['resume']=args.resume
+    defaults['plan_only']=args.plan_only
+    defaults['execute']=args.execute
+    defaults['plan_shard']=args.plan_shard
+    defaults['watch']=args.watch
+    defaults['pair_timeout']=args.pair_timeout
+    defaults['demux']=args.demux
     defaults['copy_unmuxed']=args.copy_unmuxed
+    defaults['copy_mode']=args.copy_mode
     defaults['output_directory']=args.output_directory
     defaults['delete_video']=args.delete_video
     defaults['overwrite']=args.overwrite
     defaults['keep_temp']=args.keep_temp
+    defaults['jobs']=args.jobs
+    defaults['exiftool_processes']=args.exiftool_processes
+    defaults['exiftool_timeout']=args.exiftool_timeout
+    defaults['max_memory']=args.max_memory
+    defaults['stream_threshold']=args.stream_threshold
+    defaults['pipeline']=args.pipeline
+    defaults['profile']=args.profile
     defaults['verbose']=args.verbose
     defaults['input_image']=args.input_image
     defaults['input_video']=args.input_video
@@ -280,73 +579,232 @@ def main():
             
     logger = logging.getLogger("ExifTool")
     logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    profiler = Profiler(enabled=args.profile is not None)
+
+    budget = None
+    if args.max_memory is not None:
+        from MemoryBudget import MemoryBudget
+        budget = MemoryBudget(int(args.max_memory * 1024 * 1024))
     
-    with exiftool.ExifToolHelper(
+    from ExifToolPool import ExifToolPool
+    # ExifTool is started by the first command, not here: demuxing and runs where every
+    # file is skipped (or muxed in worker processes) never start the main processes at all
+    et = ExifToolPool(
+        processes=args.exiftool_processes,
+        timeout=args.exiftool_timeout,
         encoding="utf-8",
-        logger=logger if args.verbose is True else None
-    ) as et:
+        logger=logger
+    )
+    try:
 
-        if args.input_directory is not None:
-            print(f"Converting files in {args.input_directory}")
+        if args.demux is True:
+            from concurrent.futures import ThreadPoolExecutor
+            from Demuxer import demux_file
+            from utils import scan_directory
+
+            print(f"Splitting motion photos in {args.input_directory}")
             input_directory = Path(args.input_directory).resolve()
-            
-            # Get files based on recursive flag
-            files = []
-            if args.recursive:
-                # Recursive mode: walk through all subdirectories
-                for root, _, filenames in os.walk(input_directory):
-                    for filename in filenames:
-                        full_path = Path(root) / filename
-                        rel_path = full_path.relative_to(input_directory)
-                        files.append(str(rel_path))
-            else:
-                # Non-recursive mode: only process files in the specified directory
-                for filename in os.listdir(input_directory):
-                    if os.path.isfile(input_directory / filename):
-                        files.append(filename)
-            
-            # Filter videos and images while preserving relative paths
-            videos = [
-                f for f in files
-                if Path(f).suffix.lower() in [".mp4", ".mov"]
-            ]
-            
-            images = [
-                f for f in files
-                if Path(f).suffix.lower() in [".heic", ".heif", ".avif", ".jpg", ".jpeg"]
-            ]
-            
-            unsupported = [
-                f for f in files
-                if Path(f).suffix.lower() not in [".mp4", ".mov", ".heic", ".heif", ".avif", ".jpg", ".jpeg"]
+            jobs = [
+                {
+                    "image_fpath": str(input_directory / image),
+                    "output_directory": str(Path(args.output_directory) / Path(image).parent),
+                    "verbose": args.verbose,
+                    "profiler": profiler,
+                }
+                for images, videos, others in profiler.iterate("scan", scan_directory(input_directory, args.recursive))
+                for image in images
             ]
+            demuxed = 0
+            # Splitting is just ranged copies, so threads are enough to keep the disks busy
+            with ThreadPoolExecutor(max_workers=args.jobs if args.jobs > 0 else (os.cpu_count() or 1)) as executor:
+                for i, (ok, image_output, video_output) in enumerate(executor.map(demux_file, jobs), 1):
+                    print(f"=========================[{i}/{len(jobs)}]")
+                    if ok:
+                        demuxed += 1
+                        print(f"Split into {image_output} and {video_output}")
+                    else:
+                        print(f"{image_output}, skipping...")
+            print("=" * 25)
+            print(f"Demuxed {demuxed} file(s), {len(jobs) - demuxed} skipped")
+            print("=" * 25)
+        elif args.watch is True:
+            from CopyPool import CopyPool
+            from IncrementalIndex import IncrementalIndex
+            from Watcher import Watcher
+
+            index = IncrementalIndex(output_directory) if args.incremental_mode else None
+            copier = None
+            if args.copy_unmuxed:
+                copier = CopyPool(args.input_directory, args.output_directory, mode=args.copy_mode, verbose=args.verbose, profiler=profiler)
+            watcher = Watcher(
+                et,
+                args.input_directory,
+                args.output_directory,
+                recursive=args.recursive,
+                exif_match=args.exif_match,
+                pairing_rules=args.pairing_rules,
+                index=index,
+                copier=copier,
+                pair_timeout=args.pair_timeout,
+                mux_options={
+                    "delete_video": args.delete_video,
+                    "delete_temp": not args.keep_temp,
+                    "no_xmp": args.no_xmp,
+                    "stream_threshold": stream_threshold,
+                },
+                verbose=args.verbose,
+                profiler=profiler,
+            )
+            watcher.run()
+            if index is not None:
+                index.close()
+            if copier is not None:
+                copier.close()
+            print("=" * 25)
+            print(watcher.summary())
+            if copier is not None:
+                print(copier.summary())
+            print("=" * 25)
+        elif args.execute is not None:
+            from CopyPool import CopyPool
+            from IncrementalIndex import IncrementalIndex
+            from Journal import JOURNAL_FNAME, Journal
+            from MuxPlan import read_plan
+
+            try:
+                plan, records = read_plan(args.execute)
+            except (OSError, ValueError) as e:
+                print(f"[ERROR] Could not read plan {args.execute}: {e}")
+                sys.exit(1)
+            print(f"Executing plan {args.execute}" + (f" (shard {args.plan_shard})" if plan_shard is not None else ""))
+            output_directory = plan["output_directory"]
+            index = IncrementalIndex(output_directory) if plan["incremental_mode"] else None
+            # Shards run at the same time keep separate journals
+            journal_fname = JOURNAL_FNAME if plan_shard is None else f"{JOURNAL_FNAME}.{plan_shard[0] + 1}-of-{plan_shard[1]}"
+            journal = Journal(output_directory or plan["input_directory"], resume=args.resume, fname=journal_fname)
+            if journal.resumed:
+                print(journal.summary())
+            if args.pipeline == "async":
+                from AsyncPipeline import AsyncPipeline
+                pool = AsyncPipeline(et, jobs=args.jobs, verbose=args.verbose, index=index, profiler=profiler, journal=journal, budget=budget)
+            else:
+                from MuxPool import MuxPool
+                pool = MuxPool(et, jobs=args.jobs, verbose=args.verbose, index=index, profiler=profiler, journal=journal, budget=budget)
+            copier = None
+
+            for i, record in enumerate(records):
+                # Records are dealt round robin to the shards, messages go with the records around them
+                if plan_shard is not None and i % plan_shard[1] != plan_shard[0]:
+                    continue
+                action = record["action"]
+                if action == "mux":
+                    options = record["options"]
+                    if journal.is_done(options["image_fpath"]):
+                        pool.skip(options["image_fpath"], "resumed", f"Input {options['image_fpath']} was muxed by the resumed run, skipping...")
+                        continue
+                    # Memory settings are the executing machine's, not the planning one's
+                    pool.submit(record["header"], **dict(options, stream_threshold=stream_threshold))
+                elif action == "copy":
+                    if copier is None:
+                        copier = CopyPool(plan["input_directory"], output_directory, mode=args.copy_mode, verbose=args.verbose, profiler=profiler)
+                    copier.submit(record["file"])
+                elif action in ("skip", "echo"):
+                    pool.echo(record["message"])
+                else:
+                    print(f"[WARNING] Unknown plan action {action}, skipping...")
 
-            unmatched_images = []
+            pool.close()
+            # Nothing left to resume after a clean run
+            journal.close(remove=pool.failed == 0)
+            if index is not None:
+                index.close()
+            print("=" * 25)
+            print(pool.summary())
+            from MemoryBudget import memory_summary
+            print(memory_summary(budget))
+            if copier is not None:
+                print("=" * 25)
+                print("Copying unmuxed files...")
+                copier.close()
+                print(copier.summary())
+            print("=" * 25)
+        elif args.input_directory is not None:
+            import itertools
+            from CopyPool import CopyPool
+            from FilenameMatcher import FilenameMatcher
+            from IncrementalIndex import IncrementalIndex
+            from Journal import Journal
+            from utils import is_motion_photo, extract_video_from_image, input_output_binary_compare, lookahead, prefetch_metadata, scan_directory
+
+            print(f"Converting files in {args.input_directory}")
+            input_directory = Path(args.input_directory).resolve()
+            index = IncrementalIndex(output_directory) if args.incremental_mode else None
+            journal = None
+            if args.plan_only is not None:
+                # Same decisions as a real run, written to the plan instead of carried out
+                from MuxPlan import PlanWriter, PlannedCopies
+                pool = PlanWriter(args.plan_only, input_directory, args.output_directory, incremental_mode=args.incremental_mode)
+            else:
+                # Write-ahead journal of the run, next to the outputs, continued by --resume after an interruption
+                journal = Journal(output_directory if args.output_directory is not None else input_directory, resume=args.resume)
+                if journal.resumed:
+                    print(journal.summary())
+                if args.pipeline == "async":
+                    from AsyncPipeline import AsyncPipeline
+                    pool = AsyncPipeline(et, jobs=args.jobs, verbose=args.verbose, index=index, profiler=profiler, journal=journal, budget=budget)
+                else:
+                    from MuxPool import MuxPool
+                    pool = MuxPool(et, jobs=args.jobs, verbose=args.verbose, index=index, profiler=profiler, journal=journal, budget=budget)
+            # Unmuxed files are copied in the background as soon as they are known, while muxing goes on
+            copier = None
+            if args.copy_unmuxed:
+                if args.plan_only is not None:
+                    copier = PlannedCopies(pool)
+                else:
+                    copier = CopyPool(input_directory, args.output_directory, mode=args.copy_mode, verbose=args.verbose, profiler=profiler)
             
             if not args.exif_match: # match by file name
+                # Directories are matched as soon as they are listed, so muxing overlaps with the scan.
+                # The total is only shown once the scan is complete, so the progress never goes backwards.
+                # Gooey's progress bar needs [i/N] from the start, so the GUI lists the whole tree first.
                 i = 0
-                for image in images:
-                    i += 1
-                    image_path = Path(image)
-                    fname = str(image_path.with_suffix(''))
+                total = 0
+                directories = profiler.iterate("scan", scan_directory(input_directory, args.recursive))
+                if GUI_RUN:
+                    directories = list(directories)
+                    total = sum(len(images) for images, _, _ in directories)
+                for (images, videos, others), scanned in lookahead(directories):
+                    if not GUI_RUN:
+                        total += len(images)
+                    with profiler.span("match"):
+                        matcher = FilenameMatcher(videos, args.pairing_rules, images)
+                    for image in images:
+                        i += 1
+                        image_path = Path(image)
+                        header = f"=========================[{i}/{total}]" if scanned or GUI_RUN else f"=========================[{i}]"
 
-                    # Check if source image is already a motion photo
-                    if is_motion_photo(input_directory / image, et):
-                        print(f"Input {image} is already a motion photo, skipping muxing...")
-                        if args.copy_unmuxed:
-                            unmatched_images.append(image)
-                        continue
-                    
-                    for ext in [".mp4", ".mov", ".MP4", ".MOV"]:
-                        video_fname = fname + ext
-                        if video_fname in videos:
-                            print(f"=========================[{i}/{len(images)}]")
-                            video = videos.pop(videos.index(video_fname))
+                        if journal is not None and journal.is_done(input_directory / image):
+                            matcher.match(image) # its video is taken, not left for copying
+                            pool.skip(image, "resumed", f"Input {image} was muxed by the resumed run, skipping...")
+                            continue
 
+                        # Check if source image is already a motion photo
+                        with profiler.span("detect", str(input_directory / image)):
+                            already_muxed = is_motion_photo(input_directory / image)
+                        if already_muxed:
+                            pool.skip(image, "motion_photo", f"Input {image} is already a motion photo, skipping muxing...")
+                            if args.copy_unmuxed:
+                                copier.submit(image)
+                            continue
+                    
+                        with profiler.span("match", str(input_directory / image)):
+                            video = matcher.match(image)
+                        if video is not None:
                             # Construct full paths for input files
                             input_image = input_directory / image
                             input_video = input_directory / video
-                            
+                        
                             # Handle output directory structure
                             output_subdirectory = args.output_directory                   
                             if output_subdirectory is not None:
@@ -358,44 +816,71 @@ def main():
 
                             if args.incremental_mode:
                                 output_image_path = output_subdirectory / image_path.name
-                                if os.path.exists(output_image_path) and input_output_binary_compare(input_video,output_image_path):
-                                    print(f"Destination {image} is already a motion photo, skipping...")
-                                    break
-                            
-                            Muxer(
+                                with profiler.span("incremental", str(input_image)):
+                                    already_muxed = index.lookup(input_image, input_video) is not None
+                                    if not already_muxed and os.path.exists(output_image_path) and input_output_binary_compare(input_video,output_image_path):
+                                        index.record(input_image, input_video, output_image_path)
+                                        already_muxed = True
+                                if already_muxed:
+                                    pool.echo(header)
+                                    pool.skip(image, "up_to_date", f"Destination {image} is already a motion photo, skipping...")
+                                    continue
+                        
+                            pool.submit(
+                                header,
                                 image_fpath=str(input_image),
                                 video_fpath=str(input_video),
-                                exiftool=et,
                                 output_directory=str(output_subdirectory) if output_subdirectory else None,
                                 delete_video=args.delete_video,
                                 delete_temp=not args.keep_temp,
                                 overwrite=args.overwrite,
                                 no_xmp=args.no_xmp,
                                 verbose=args.verbose,
-                            ).mux()
-                            break
-                    else:
-                        print(f"No matching video found for {image}")
-                        if args.copy_unmuxed:
-                            unmatched_images.append(image)
+                                stream_threshold=stream_threshold,
+                            )
+                        else:
+                            pool.skip(image, "unmatched", f"No matching video found for {image}")
+                            if args.copy_unmuxed:
+                                copier.submit(image)
+                    if args.copy_unmuxed:
+                        for file in itertools.chain(matcher.unmatched(), others):
+                            copier.submit(file)
                         
             else: # match by exif
+                images, videos = [], []
+                for dir_images, dir_videos, others in profiler.iterate("scan", scan_directory(input_directory, args.recursive)):
+                    images += dir_images
+                    videos += dir_videos
+                    if args.copy_unmuxed:
+                        for file in others:
+                            copier.submit(file)
+                if args.resume:
+                    # Pairs done by the resumed run aren't even looked at (no metadata read)
+                    resumed = [img for img in images if journal.is_done(input_directory / img)]
+                    images = [img for img in images if not journal.is_done(input_directory / img)]
+                    videos = [vid for vid in videos if not journal.is_video_done(input_directory / vid)]
+                    for img in resumed:
+                        pool.skip(img, "resumed", f"Input {img} was muxed by the resumed run, skipping...")
                 image_paths = [input_directory / img for img in images]
                 video_paths = [input_directory / vid for vid in videos]
                 print("Running in EXIF matching mode.")
                 print("Getting metadata for images, please wait...")
-                image_metadatas = et.get_metadata([str(p) for p in image_paths])
+                with profiler.span("prefetch"):
+                    image_metadatas = prefetch_metadata(et, image_paths)
                 print("Getting metadata for videos, please wait...")
-                video_metadatas = et.get_metadata([str(p) for p in video_paths])
+                with profiler.span("prefetch"):
+                    video_metadatas = prefetch_metadata(et, video_paths)
+                video_metadata_by_path = dict(zip(videos, video_metadatas))
                 
                 # Map content identifiers to video relative paths
                 content_id_to_video = {}
-                for meta, vid in zip(video_metadatas, videos):
-                    content_id = meta.get('QuickTime:ContentIdentifier')
-                    if content_id:
-                        content_id_to_video.setdefault(content_id.strip(), []).append(vid)
-                        if args.verbose:
-                            print(f"[DEBUG] Mapped video {vid} to ContentIdentifier: {content_id}")
+                with profiler.span("match"):
+                    for meta, vid in zip(video_metadatas, videos):
+                        content_id = meta.get('QuickTime:ContentIdentifier')
+                        if content_id:
+                            content_id_to_video.setdefault(content_id.strip(), []).append(vid)
+                            if args.verbose:
+                                print(f"[DEBUG] Mapped video {vid} to ContentIdentifier: {content_id}")
                 
                 # Match images to videos
                 i = 0
@@ -403,17 +888,19 @@ def main():
                     i += 1
 
                     # Check if source image is already a motion photo
-                    if is_motion_photo(input_directory / img, et):
-                        print(f"Input {img} is already a motion photo, skipping muxing...")
+                    with profiler.span("detect", str(input_directory / img)):
+                        already_muxed = is_motion_photo(input_directory / img)
+                    if already_muxed:
+                        pool.skip(img, "motion_photo", f"Input {img} is already a motion photo, skipping muxing...")
                         if args.copy_unmuxed:
-                            unmatched_images.append(img)
+                            copier.submit(img)
                         continue
 
                     content_id = img_meta.get('MakerNotes:ContentIdentifier')
                     if args.verbose and content_id:
-                        print(f"[DEBUG] Image {img} has ContentIdentifier: {content_id}")
+                        pool.echo(f"[DEBUG] Image {img} has ContentIdentifier: {content_id}")
                     if content_id and content_id.strip() in content_id_to_video:
-                        print(f"=========================[{i}/{len(images)}]")
+                        header = f"=========================[{i}/{len(images)}]"
                         video = content_id_to_video[content_id.strip()][0]
 
                         if args.copy_unmuxed:
@@ -435,65 +922,84 @@ def main():
                                 output_subdirectory.mkdir(parents=True, exist_ok=True)
 
                         if args.incremental_mode:
-                            # Try matching using Content id
                             output_image_path = output_subdirectory / image_path.name
-                            if os.path.exists(output_image_path):
-                                output_metadata = et.get_metadata(output_image_path)[0]
-                                output_image_content_id = output_metadata.get('MakerNotes:ContentIdentifier')
-                                output_video_data_from_image = extract_video_from_image(output_image_path, et)
-
-                                # Check if content IDs match
-                                if all((output_video_data_from_image,
-                                        output_image_content_id,
-                                        output_video_data_from_image.find(output_image_content_id.strip().encode()) != -1,
-                                        output_video_data_from_image.find(content_id.strip().encode()) != -1)):
-                                        if args.verbose:
-                                            print(f"[DEBUG] ContentIdentifier '{content_id.strip()}' of the source {input_image} and {output_image_path} destination matches")
-                                        print(f"Destination {img} as it is already a motion photo, skipping...")
-                                        continue
-                                else:
-                                    # Do binary comparison to check input and output
+                            with profiler.span("incremental", str(input_image)):
+                                if index.lookup(input_image, input_video) is not None:
+                                    pool.echo(header)
+                                    pool.skip(img, "up_to_date", f"Destination {img} is already a motion photo, skipping...")
+                                    continue
+                                if os.path.exists(output_image_path):
+                                    # Compare the embedded video with the input first, it only reads a few KB
                                     if input_output_binary_compare(input_video,output_image_path):
-                                        print(f"Destination {img} is already a motion photo, skipping...")
+                                        index.record(input_image, input_video, output_image_path, content_id)
+                                        pool.echo(header)
+                                        pool.skip(img, "up_to_date", f"Destination {img} is already a motion photo, skipping...")
                                         continue
-                        
-                        Muxer(
+
+                                    # Try matching using Content id
+                                    output_metadata = et.get_metadata(output_image_path)[0]
+                                    output_image_content_id = output_metadata.get('MakerNotes:ContentIdentifier')
+                                    try:
+                                        output_video_data_from_image = extract_video_from_image(output_image_path, et)
+                                    except Exception as e:
+                                        # ExifTool hung or crashed on the destination, it is muxed again
+                                        pool.echo(f"[WARNING] Could not read the video of {output_image_path}: {e}")
+                                        output_video_data_from_image = None
+
+                                    # Check if content IDs match
+                                    if all((output_video_data_from_image,
+                                            output_image_content_id,
+                                            output_video_data_from_image.find(output_image_content_id.strip().encode()) != -1,
+                                            output_video_data_from_image.find(content_id.strip().encode()) != -1)):
+                                            index.record(input_image, input_video, output_image_path, content_id)
+                                            pool.echo(header)
+                                            if args.verbose:
+                                                pool.echo(f"[DEBUG] ContentIdentifier '{content_id.strip()}' of the source {input_image} and {output_image_path} destination matches")
+                                            pool.skip(img, "up_to_date", f"Destination {img} as it is already a motion photo, skipping...")
+                                            continue
+                        pool.submit(
+                            header,
                             image_fpath=str(input_image),
                             video_fpath=str(input_video),
-                            exiftool=et,
                             output_directory=str(output_subdirectory) if output_subdirectory else None,
                             delete_video=args.delete_video,
                             delete_temp=not args.keep_temp,
                             overwrite=args.overwrite,
                             no_xmp=args.no_xmp,
                             verbose=args.verbose,
-                        ).mux()
+                            stream_threshold=stream_threshold,
+                            image_metadata=img_meta,
+                            video_metadata=video_metadata_by_path[video],
+                        )
                     else:
-                        print(f"No matching video found for {img}")
+                        pool.skip(img, "unmatched", f"No matching video found for {img}")
                         if args.copy_unmuxed:
-                            unmatched_images.append(img)
+                            copier.submit(img)
+                if args.copy_unmuxed:
+                    for file in videos:
+                        copier.submit(file)
 
-            # Copy unmuxed images and videos while preserving the directory structure
-            if args.copy_unmuxed:
+            pool.close()
+            if journal is not None:
+                # Nothing left to resume after a clean run
+                journal.close(remove=pool.failed == 0)
+            if index is not None:
+                index.close()
+            print("=" * 25)
+            print(pool.summary())
+            if args.plan_only is None:
+                from MemoryBudget import memory_summary
+                print(memory_summary(budget))
+
+            # Wait for the unmuxed copies started during muxing
+            if copier is not None:
                 print("=" * 25)
                 print("Copying unmuxed files...")
-                for file in itertools.chain(unmatched_images, videos, unsupported):
-                    # Handle output directory structure
-                    output_subdirectory = args.output_directory
-                    if output_subdirectory is not None:
-                        file_path = Path(file)
-                        output_subdirectory = Path(output_subdirectory) / file_path.parent
-                        output_subdirectory = output_subdirectory.resolve()
-                        if not output_subdirectory.exists():
-                            output_subdirectory.mkdir(parents=True, exist_ok=True)
-                    print(f"Copying {file} to {output_subdirectory}")
-                    if os.path.exists(output_subdirectory / file_path.name) and filecmp.cmp(input_directory / file, output_subdirectory / file_path.name):
-                        if args.verbose:
-                            print(f"[DEBUG][WARNING] File {file} already exists in output directory, skipping..." )
-                        continue
-                    shutil.copy2(input_directory / file, output_subdirectory)
+                copier.close()
+                print(copier.summary())
             print("=" * 25)
         else:
+            from Muxer import Muxer
             Muxer(
                 image_fpath=args.input_image,
                 video_fpath=args.input_video,
@@ -505,9 +1011,20 @@ def main():
                 overwrite=args.overwrite,
                 no_xmp=args.no_xmp,
                 verbose=args.verbose,
+                profiler=profiler,
+                stream_threshold=stream_threshold,
             ).mux()
+    finally:
+        if et.running:
+            et.terminate()
+
+    if args.profile is not None:
+        report_fpath, prom_fpath = profiler.save(args.profile)
+        print(f"Profile report saved to {report_fpath} and {prom_fpath}")
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    GUI_RUN = '--ignore-gooey' in sys.argv
     if len(sys.argv) == 1:
         from gooey import Gooey
         main = Gooey(program_name='MotionPhoto2',
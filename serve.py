@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Local HTTP mux service, for tools that need motion photos on demand without starting
+# motionphoto2.py (and a new ExifTool) for every file.
+#
+#   python serve.py --port 8765 --workers 4 --root /photos
+#
+#   POST /mux      multipart/form-data with "image" and "video" files, returns the motion photo
+#   POST /mux      JSON {"image": path, "video": path, "output": path (optional)}, muxes files below --root
+#                  on the server (as `motionphoto2.py --input-image ...` does) and returns {"output": path}
+#   GET  /metrics  Prometheus metrics
+#   GET  /health
+#
+# Requests are muxed by a pool of worker processes started up front, each with its own running ExifTool.
+# At most --max-requests requests are served at once, the others are rejected with 503.
+
+import argparse
+import collections
+import email.parser
+import email.policy
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import MuxPool
+from BufferMuxer import BufferMuxer
+from Profiler import percentile
+from utils import file_type_extension
+
+ENDPOINTS = ("/mux", "/metrics", "/health")
+# Latencies kept per endpoint for the quantiles in /metrics
+LATENCY_WINDOW = 1024
+
+CONTENT_TYPES = {
+    "jpg": "image/jpeg",
+    "heic": "image/heic",
+    "avif": "image/avif",
+}
+
+
+def init_server_worker(verbose: bool):
+    # Uploads are muxed natively, so a worker without ExifTool can still serve them
+    try:
+        MuxPool.init_worker(verbose)
+    except OSError as e:
+        logging.getLogger("ExifTool").warning("Could not start ExifTool (%s), only uploads can be muxed", e)
+
+
+def warm_up() -> int:
+    return os.getpid()
+
+
+def mux_upload(image: bytes, video: bytes, image_name: str, video_name: str, no_xmp: bool) -> tuple:
+    # Returns (ok, motion photo or error message)
+    try:
+        segments = BufferMuxer(image, video, image_name=image_name, video_name=video_name, no_xmp=no_xmp).mux()
+        return True, b"".join(segments)
+    except (ValueError, TypeError) as e:
+        return False, str(e)
+
+
+class MuxService:
+
+    # State shared by the request handler threads: the worker pool, the concurrency limit and the metrics.
+
+    def __init__(self, workers: int, max_requests: int, max_upload_size: int, roots: list = None, verbose: bool = False):
+        self.workers = workers
+        self.max_upload_size = max_upload_size
+        self.roots = [Path(root).resolve() for root in roots or []]
+        self.verbose = verbose
+        self.slots = threading.BoundedSemaphore(max_requests)
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_server_worker,
+            initargs=(verbose,),
+        )
+        # Start every worker (and its ExifTool) now rather than on the first requests
+        for future in [self.executor.submit(warm_up) for _ in range(workers)]:
+            future.result()
+
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.in_flight = 0
+        self.requests = collections.Counter()  # (endpoint, status code) -> count
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=LATENCY_WINDOW))
+        self.seconds = collections.Counter()  # endpoint -> total seconds
+        self.bytes = collections.Counter()  # "received"/"sent" -> bytes
+
+    def allowed(self, fpath: str) -> bool:
+        path = Path(fpath).resolve()
+        return any(path == root or root in path.parents for root in self.roots)
+
+    def record(self, endpoint: str, code: int, seconds: float, received: int, sent: int):
+        with self.lock:
+            self.requests[(endpoint, code)] += 1
+            self.latencies[endpoint].append(seconds)
+            self.seconds[endpoint] += seconds
+            self.bytes["received"] += received
+            self.bytes["sent"] += sent
+
+    def metrics(self) -> str:
+        with self.lock:
+            requests = dict(self.requests)
+            latencies = {endpoint: sorted(values) for endpoint, values in self.latencies.items()}
+            seconds = dict(self.seconds)
+            nbytes = dict(self.bytes)
+            in_flight = self.in_flight
+        lines = [
+            "# HELP motionphoto2_server_requests_total Requests served, by endpoint and status code.",
+            "# TYPE motionphoto2_server_requests_total counter",
+        ]
+        for (endpoint, code), count in sorted(requests.items()):
+            lines.append(f'motionphoto2_server_requests_total{{endpoint="{endpoint}",code="{code}"}} {count}')
+        lines += [
+            "# HELP motionphoto2_server_request_seconds Request latency (quantiles of the recent requests).",
+            "# TYPE motionphoto2_server_request_seconds summary",
+        ]
+        for endpoint, values in sorted(latencies.items()):
+            for quantile in (50, 95, 99):
+                lines.append(
+                    f'motionphoto2_server_request_seconds{{endpoint="{endpoint}",quantile="0.{quantile}"}} '
+                    f"{round(percentile(values, quantile), 6)}"
+                )
+            lines.append(f'motionphoto2_server_request_seconds_sum{{endpoint="{endpoint}"}} {round(seconds[endpoint], 6)}')
+            lines.append(
+                f'motionphoto2_server_request_seconds_count{{endpoint="{endpoint}"}} '
+                f"{sum(count for (e, _), count in requests.items() if e == endpoint)}"
+            )
+        lines += [
+            "# HELP motionphoto2_server_bytes_total Bytes of request and response bodies.",
+            "# TYPE motionphoto2_server_bytes_total counter",
+        ]
+        for direction in ("received", "sent"):
+            lines.append(f'motionphoto2_server_bytes_total{{direction="{direction}"}} {nbytes.get(direction, 0)}')
+        lines += [
+            "# HELP motionphoto2_server_in_flight Requests being served.",
+            "# TYPE motionphoto2_server_in_flight gauge",
+            f"motionphoto2_server_in_flight {in_flight}",
+            "# HELP motionphoto2_server_workers Mux worker processes.",
+            "# TYPE motionphoto2_server_workers gauge",
+            f"motionphoto2_server_workers {self.workers}",
+            "# HELP motionphoto2_server_uptime_seconds Seconds since the service started.",
+            "# TYPE motionphoto2_server_uptime_seconds gauge",
+            f"motionphoto2_server_uptime_seconds {round(time.time() - self.started, 3)}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class MuxRequestHandler(BaseHTTPRequestHandler):
+
+    server_version = "MotionPhoto2"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.service.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        start = time.perf_counter()
+        path = self.path.split("?")[0]
+        if path == "/metrics":
+            sent = self.reply(200, self.server.service.metrics().encode(), "text/plain; version=0.0.4")
+        elif path == "/health":
+            sent = self.reply(200, b"ok\n", "text/plain")
+        else:
+            sent = self.error(404, "Not found")
+        endpoint = path if path in ENDPOINTS else "other"
+        self.server.service.record(endpoint, self.status, time.perf_counter() - start, 0, sent)
+
+    def do_POST(self):
+        start = time.perf_counter()
+        service = self.server.service
+        path = self.path.split("?")[0]
+        received = 0
+        if path != "/mux":
+            self.close_connection = True  # the body is not read
+            sent = self.error(404, "Not found")
+        elif not service.slots.acquire(blocking=False):
+            self.close_connection = True
+            sent = self.error(503, "Too many requests in progress", {"Retry-After": "1"})
+        else:
+            with service.lock:
+                service.in_flight += 1
+            try:
+                received, sent = self.mux()
+            finally:
+                with service.lock:
+                    service.in_flight -= 1
+                service.slots.release()
+        endpoint = path if path in ENDPOINTS else "other"
+        service.record(endpoint, self.status, time.perf_counter() - start, received, sent)
+
+    def mux(self) -> tuple:
+        # Returns (bytes received, bytes sent)
+        service = self.server.service
+        length = self.headers.get("Content-Length")
+        if length is None or not length.isdigit():
+            self.close_connection = True
+            return 0, self.error(411, "Content-Length required")
+        length = int(length)
+        if length > service.max_upload_size:
+            self.close_connection = True
+            return 0, self.error(413, f"Request body larger than {service.max_upload_size} bytes")
+        body = self.rfile.read(length)
+
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("multipart/form-data"):
+            return length, self.mux_upload(content_type, body)
+        if content_type.startswith("application/json"):
+            return length, self.mux_paths(body)
+        return length, self.error(415, "Expected multipart/form-data or application/json")
+
+    def mux_upload(self, content_type: str, body: bytes) -> int:
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body
+        )
+        files = {}
+        fields = {}
+        if message.is_multipart():
+            for part in message.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                if part.get_filename() is not None:
+                    files[name] = (part.get_filename(), part.get_payload(decode=True))
+                elif name is not None:
+                    fields[name] = part.get_content().strip()
+        if "image" not in files or "video" not in files:
+            return self.error(400, "Upload both an image and a video file")
+
+        (image_name, image), (video_name, video) = files["image"], files["video"]
+        ok, result = self.server.service.executor.submit(
+            mux_upload, image, video, os.path.basename(image_name), os.path.basename(video_name),
+            fields.get("no_xmp", "").lower() in ("1", "true", "yes"),
+        ).result()
+        if not ok:
+            return self.error(400, result)
+        extension = file_type_extension(result[:16])
+        return self.reply(
+            200,
+            result,
+            CONTENT_TYPES.get(extension, "application/octet-stream"),
+            {"Content-Disposition": f'attachment; filename="{os.path.basename(image_name)}"'},
+        )
+
+    def mux_paths(self, body: bytes) -> int:
+        service = self.server.service
+        try:
+            job = json.loads(body)
+        except ValueError:
+            return self.error(400, "Invalid JSON")
+        if not isinstance(job, dict) or not isinstance(job.get("image"), str) or not isinstance(job.get("video"), str):
+            return self.error(400, "JSON must have image and video paths")
+        fpaths = [job["image"], job["video"]] + ([job["output"]] if job.get("output") else [])
+        if not all(service.allowed(fpath) for fpath in fpaths):
+            return self.error(403, "Paths must be below a --root directory")
+
+        ok, output, output_fpath, _ = service.executor.submit(
+            MuxPool.mux_worker,
+            {
+                "image_fpath": job["image"],
+                "video_fpath": job["video"],
+                "output_fpath": job.get("output"),
+                "no_xmp": bool(job.get("no_xmp", False)),
+                "verbose": service.verbose,
+            },
+        ).result()
+        if not ok:
+            return self.error(400, output.strip().splitlines()[-1] if output.strip() else "Muxing failed")
+        return self.reply(200, json.dumps({"output": output_fpath}).encode(), "application/json")
+
+    def reply(self, code: int, body: bytes, content_type: str, headers: dict = None) -> int:
+        self.status = code
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+    def error(self, code: int, message: str, headers: dict = None) -> int:
+        return self.reply(code, json.dumps({"error": message}).encode(), "application/json", headers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve MotionPhoto2 muxing over HTTP on this machine")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("-p", "--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("-w", "--workers", type=int, default=0, help="Mux worker processes (0 = all CPU cores)")
+    parser.add_argument(
+        "-m", "--max-requests", type=int, help="Requests served at once, the rest get 503 (default: 2 per worker)"
+    )
+    parser.add_argument("--max-upload-size", type=float, default=200, help="Largest request body in MB")
+    parser.add_argument(
+        "-r", "--root", action="append", default=[],
+        help="Directory whose files may be muxed by path (repeatable), muxing by path is disabled without it"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args()
+
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    max_requests = args.max_requests if args.max_requests is not None else 2 * workers
+    if args.workers < 0 or max_requests < 1 or args.max_upload_size <= 0:
+        print("[ERROR] Workers, max requests and max upload size must be positive")
+        sys.exit(1)
+
+    logging.disable(logging.NOTSET if args.verbose else logging.INFO)  # the muxer logs every file
+
+    service = MuxService(workers, max_requests, int(args.max_upload_size * 1024 * 1024), args.root, args.verbose)
+    server = ThreadingHTTPServer((args.host, args.port), MuxRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    print(f"Serving on http://{args.host}:{server.server_address[1]} with {workers} worker(s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
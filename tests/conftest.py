@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository, next to motionphoto2.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    # One JPEG and one HEIC Live Photo pair, small enough to mux in milliseconds
+    return benchmark.generate_corpus(str(tmp_path / "input"), 2, "mixed", "mov", 16 * 1024, 32 * 1024, seed=1)
+
+
+@pytest.fixture
+def mux(tmp_path):
+    # Muxes a corpus pair with its metadata passed in as if prefetched, so no ExifTool is needed.
+    # Returns the output path.
+    from Muxer import Muxer
+
+    def mux_pair(pair, image_metadata: dict = None, output_directory: str = None, **kwargs) -> str:
+        output_directory = output_directory or str(tmp_path / "output")
+        os.makedirs(output_directory, exist_ok=True)
+        return Muxer(
+            pair.image,
+            pair.video,
+            exiftool=None,
+            output_directory=output_directory,
+            image_metadata=dict(image_metadata or pair.image_metadata),
+            video_metadata=dict(pair.video_metadata),
+            **kwargs,
+        ).mux()
+
+    return mux_pair
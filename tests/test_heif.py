@@ -0,0 +1,112 @@
+import struct
+
+from HeifFile import HeifFile, box, full_box
+from utils import find_embedded_video
+
+IMAGE = bytes(range(256)) * 40
+OLD_XMP = b"<old>" + b"o" * 900 + b"</old>"
+GAIN_MAP_XMP = b"<gainmap/>"
+
+
+def read(fpath: str) -> bytes:
+    with open(fpath, "rb") as f:
+        return f.read()
+
+
+def heic(xmp_described: int = 1) -> bytes:
+    # Primary image (item 1) and its XMP (item 2) in mdat, plus the XMP of a gain map (item 3 describes
+    # item 4). The XMP item describes item xmp_described.
+    def meta(offsets: list) -> bytes:
+        hdlr = full_box(b"hdlr", 0, 0, struct.pack(">I", 0) + b"pict" + bytes(12) + b"\x00")
+        pitm = full_box(b"pitm", 0, 0, struct.pack(">H", 1))
+        iinf = full_box(
+            b"iinf", 0, 0,
+            struct.pack(">H", 3)
+            + full_box(b"infe", 2, 0, struct.pack(">HH", 3, 0) + b"mime" + b"XMP\x00application/rdf+xml\x00")
+            + full_box(b"infe", 2, 0, struct.pack(">HH", 1, 0) + b"hvc1\x00")
+            + full_box(b"infe", 2, 0, struct.pack(">HH", 2, 0) + b"mime" + b"XMP\x00application/rdf+xml\x00")
+        )
+        iloc = full_box(
+            b"iloc", 0, 0,
+            b"\x44\x00" + struct.pack(">H", 3)
+            + b"".join(struct.pack(">HHHII", item_id, 0, 1, offset, length) for item_id, offset, length in offsets)
+        )
+        iref = full_box(
+            b"iref", 0, 0,
+            box(b"cdsc", struct.pack(">HHH", 3, 1, 4)) + box(b"cdsc", struct.pack(">HHH", 2, 1, xmp_described))
+        )
+        return full_box(b"meta", 0, 0, hdlr + pitm + iinf + iloc + iref)
+
+    ftyp = box(b"ftyp", b"heic" + struct.pack(">I", 0) + b"mif1heic")
+    mdat_payload = len(ftyp) + len(meta([(1, 0, 0)] * 3)) + 8
+    offsets = [
+        (1, mdat_payload, len(IMAGE)),
+        (2, mdat_payload + len(IMAGE), len(OLD_XMP)),
+        (3, mdat_payload + len(IMAGE) + len(OLD_XMP), len(GAIN_MAP_XMP)),
+    ]
+    return ftyp + meta(offsets) + box(b"mdat", IMAGE + OLD_XMP + GAIN_MAP_XMP)
+
+
+def test_mux_round_trip(corpus, mux):
+    pair = corpus[1]
+    assert pair.image_type == "heic"
+    output_fpath = mux(pair)
+    output = read(output_fpath)
+    embedded = find_embedded_video(output_fpath)
+    assert output[embedded.offset:embedded.offset + embedded.length] == read(pair.video)
+
+    source, result = HeifFile(read(pair.image)), HeifFile(output)
+    assert b'GCamera:MotionPhoto="1"' in result.read_xmp()
+    # Every item but the XMP still reads the same through the rewritten iloc
+    for item_id in source.locations:
+        if item_id != source.xmp_item():
+            assert result.read_item(item_id) == source.read_item(item_id)
+
+
+def test_remux_does_not_grow():
+    once = HeifFile(heic()).with_xmp(b"<new>" + b"n" * 2000 + b"</new>")
+    twice = HeifFile(once).with_xmp(b"<new>" + b"m" * 2000 + b"</new>")
+    assert len(twice) == len(once)
+    assert HeifFile(twice).read_xmp() == b"<new>" + b"m" * 2000 + b"</new>"
+    assert HeifFile(twice).read_item(1) == IMAGE
+
+
+def test_smaller_xmp_is_overwritten_in_mdat():
+    data = heic()
+    result = HeifFile(data).with_xmp(b"<new/>")
+    assert HeifFile(result).read_xmp() == b"<new/>"
+    assert HeifFile(result).read_item(1) == IMAGE
+    # In place: mdat keeps its size, only meta changes (iloc version 1 and an empty idat)
+    assert result.endswith(bytes(len(OLD_XMP) - len(b"<new/>")) + GAIN_MAP_XMP)
+    assert len(HeifFile(result).with_xmp(b"<new/>")) == len(result)
+    assert OLD_XMP not in result and b"ooo" not in result
+
+
+def test_bigger_xmp_zeroes_the_old_one_in_mdat():
+    xmp = b"<new>" + b"n" * 2000 + b"</new>"
+    result = HeifFile(heic()).with_xmp(xmp)
+    heif = HeifFile(result)
+    assert heif.read_xmp() == xmp
+    assert heif.read_item(1) == IMAGE
+    assert b"ooo" not in result
+
+
+def test_xmp_of_other_items_is_left_alone():
+    data = heic()
+    heif = HeifFile(data)
+    assert heif.xmp_item() == 2
+    result = HeifFile(heif.with_xmp(b"<new/>"))
+    assert result.read_item(3) == GAIN_MAP_XMP
+    assert result.read_xmp() == b"<new/>"
+
+
+def test_xmp_item_is_added_when_the_primary_image_has_none():
+    # The only XMP items describe other items: a new one is added with a cdsc reference to the primary
+    heif = HeifFile(heic(xmp_described=4))
+    assert heif.xmp_item() is None
+    result = HeifFile(heif.with_xmp(b"<new/>"))
+    assert result.xmp_item() not in (None, 2, 3)
+    assert result.read_xmp() == b"<new/>"
+    assert result.read_item(2) == OLD_XMP
+    assert result.read_item(3) == GAIN_MAP_XMP
+    assert result.read_item(1) == IMAGE
@@ -0,0 +1,95 @@
+import os
+import sqlite3
+
+import pytest
+
+from IncrementalIndex import IncrementalIndex, INDEX_FNAME
+
+
+def write(fpath, data: bytes, mtime_ns: int = None):
+    with open(fpath, "wb") as f:
+        f.write(data)
+    if mtime_ns is not None:
+        os.utime(fpath, ns=(mtime_ns, mtime_ns))
+    return str(fpath)
+
+
+@pytest.fixture
+def pair(tmp_path):
+    # (image, video, output) of a pair that was just muxed into tmp_path/out
+    (tmp_path / "out").mkdir()
+    image = write(tmp_path / "IMG_0001.JPG", b"image" * 100)
+    video = write(tmp_path / "IMG_0001.MOV", b"video" * 100)
+    output = write(tmp_path / "out" / "IMG_0001.JPG", b"output" * 100)
+    return image, video, output
+
+
+def replace(fpath: str, data: bytes):
+    # Writes a new file (another inode) over fpath, keeping its size and mtime
+    st = os.stat(fpath)
+    assert len(data) == st.st_size
+    write(fpath + ".new", data)
+    os.replace(fpath + ".new", fpath)
+    os.utime(fpath, ns=(st.st_mtime_ns, st.st_mtime_ns))
+    assert os.stat(fpath).st_ino != st.st_ino
+
+
+def test_recorded_pair_is_found(pair):
+    image, video, output = pair
+    with IncrementalIndex(os.path.dirname(output)) as index:
+        assert index.lookup(image, video) is None
+        index.record(image, video, output)
+        assert index.lookup(image, video) == output
+    # and it survives a restart
+    with IncrementalIndex(os.path.dirname(output)) as index:
+        assert index.lookup(image, video) == output
+
+
+@pytest.mark.parametrize("changed", [0, 1, 2])
+def test_changed_file_is_not_found(pair, changed):
+    image, video, output = pair
+    with IncrementalIndex(os.path.dirname(output)) as index:
+        index.record(image, video, output)
+        fpath = pair[changed]
+        write(fpath, b"x" + open(fpath, "rb").read())
+        assert index.lookup(image, video) is None
+
+
+def test_missing_output_is_not_found(pair):
+    image, video, output = pair
+    with IncrementalIndex(os.path.dirname(output)) as index:
+        index.record(image, video, output)
+        os.remove(output)
+        assert index.lookup(image, video) is None
+
+
+def test_replaced_output_is_verified_by_digest(pair):
+    image, video, output = pair
+    with IncrementalIndex(os.path.dirname(output)) as index:
+        index.record(image, video, output)
+        replace(output, b"output" * 100)  # restored from a backup: same content
+        assert index.lookup(image, video) == output
+        replace(output, b"OUTPUT" * 100)  # rewritten: same size and mtime, other content
+        assert index.lookup(image, video) is None
+
+
+def test_index_without_output_inode_is_migrated(pair):
+    image, video, output = pair
+    directory = os.path.dirname(output)
+    with IncrementalIndex(directory) as index:
+        index.record(image, video, output)
+    # Rebuild the table as an older version wrote it, without output_inode
+    db = sqlite3.connect(os.path.join(directory, INDEX_FNAME))
+    columns = [row[1] for row in db.execute("PRAGMA table_info(pairs)") if row[1] != "output_inode"]
+    db.execute(f"CREATE TABLE old AS SELECT {', '.join(columns)} FROM pairs")
+    db.execute("DROP TABLE pairs")
+    db.execute("ALTER TABLE old RENAME TO pairs")
+    db.commit()
+    db.close()
+
+    with IncrementalIndex(directory) as index:
+        # The row has no inode to compare with, the digest decides
+        assert index.lookup(image, video) == output
+    with IncrementalIndex(directory) as index:
+        replace(output, b"OUTPUT" * 100)
+        assert index.lookup(image, video) is None
@@ -0,0 +1,75 @@
+import json
+import os
+
+from Journal import Journal, JOURNAL_FNAME
+
+
+def records(directory) -> list:
+    with open(os.path.join(directory, JOURNAL_FNAME), "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f.read().split("\n") if line]
+
+
+def interrupted_run(directory):
+    # IMG_0001 and IMG_0002 done, IMG_0003 failed, IMG_0004 planned when the run was killed
+    journal = Journal(directory)
+    for i in range(1, 5):
+        journal.planned(f"IMG_000{i}.JPG", f"IMG_000{i}.MOV", str(directory))
+    journal.done("IMG_0001.JPG", "IMG_0001.MOV", "out/IMG_0001.JPG")
+    journal.done("IMG_0002.JPG", "IMG_0002.MOV", "out/IMG_0002.JPG")
+    journal.failed("IMG_0003.JPG", "IMG_0003.MOV")
+    journal.file.close()  # no end record, as after a kill
+
+
+def test_resume(tmp_path):
+    interrupted_run(tmp_path)
+    with Journal(tmp_path, resume=True) as journal:
+        assert journal.resumed
+        assert journal.is_done("IMG_0001.JPG") and journal.is_video_done("IMG_0002.MOV")
+        assert not journal.is_done("IMG_0003.JPG") and not journal.is_done("IMG_0004.JPG")
+        assert journal.done_images["IMG_0001.JPG"] == "out/IMG_0001.JPG"
+        assert journal.interrupted == 1
+        assert journal.summary() == "Resuming: 2 pair(s) done by the previous run, 1 interrupted"
+        journal.done("IMG_0004.JPG", "IMG_0004.MOV", "out/IMG_0004.JPG")
+    # The journal was continued, not replaced
+    assert [record["event"] for record in records(tmp_path)][:2] == ["start", "planned"]
+    assert records(tmp_path)[-1]["event"] == "end"
+
+
+def test_resume_after_torn_last_line(tmp_path):
+    interrupted_run(tmp_path)
+    with open(tmp_path / JOURNAL_FNAME, "a", encoding="utf-8") as f:
+        f.write('{"event": "done", "image": "IMG_0004.JPG", "vid')
+    with Journal(tmp_path, resume=True) as journal:
+        assert not journal.is_done("IMG_0004.JPG")
+        assert journal.interrupted == 1
+        journal.done("IMG_0004.JPG", "IMG_0004.MOV", "out/IMG_0004.JPG")
+    # The torn line is closed off so the records written after it stay readable
+    with open(tmp_path / JOURNAL_FNAME, "r", encoding="utf-8") as f:
+        lines = f.read().split("\n")
+    assert lines[-5] == '{"event": "done", "image": "IMG_0004.JPG", "vid'
+    with Journal(tmp_path, resume=True) as journal:
+        assert journal.is_done("IMG_0004.JPG")
+        assert journal.interrupted == 0
+
+
+def test_without_resume_a_new_journal_is_started(tmp_path):
+    interrupted_run(tmp_path)
+    with Journal(tmp_path) as journal:
+        assert not journal.resumed
+        assert not journal.is_done("IMG_0001.JPG")
+    assert [record["event"] for record in records(tmp_path)] == ["start", "end"]
+
+
+def test_resume_without_journal(tmp_path):
+    with Journal(tmp_path, resume=True) as journal:
+        assert not journal.resumed
+        assert journal.interrupted == 0
+
+
+def test_close_removes_a_finished_journal(tmp_path):
+    journal = Journal(tmp_path)
+    journal.planned("IMG_0001.JPG", "IMG_0001.MOV")
+    journal.done("IMG_0001.JPG", "IMG_0001.MOV", "out/IMG_0001.JPG")
+    journal.close(remove=True)
+    assert not os.path.exists(tmp_path / JOURNAL_FNAME)
+    journal.close(remove=True)  # closing twice is harmless
@@ -0,0 +1,98 @@
+import struct
+
+from lxml import etree
+
+import constants as const
+from JpegFile import JpegFile, XMP_EXTENSION_SIGNATURE, XMP_MAX_SIZE
+from utils import find_embedded_video
+
+GCAMERA_MOTION_PHOTO = "{" + const.NAMESPACES["GCamera"] + "}MotionPhoto"
+XMP_CREATOR_TOOL = "{http://ns.adobe.com/xap/1.0/}CreatorTool"
+
+
+def read(fpath: str) -> bytes:
+    with open(fpath, "rb") as f:
+        return f.read()
+
+
+def description(xmp: bytes):
+    return etree.fromstring(xmp).find(".//rdf:Description", const.NAMESPACES)
+
+
+def extended_xmp(jpeg: JpegFile) -> tuple:
+    # (GUID, ExtendedXMP reassembled from its APP1 chunks), (None, None) when there is none
+    guid, chunks = None, {}
+    for segment in jpeg.segments:
+        if jpeg.is_xmp_extension(segment):
+            payload = jpeg.payload(segment)[len(XMP_EXTENSION_SIGNATURE):]
+            guid = payload[:32].decode("ascii")
+            full_length, offset = struct.unpack(">II", payload[32:40])
+            chunks[offset] = payload[40:]
+    if guid is None:
+        return None, None
+    data = b"".join(chunks[offset] for offset in sorted(chunks))
+    assert len(data) == full_length
+    return guid, data
+
+
+def assert_video_embedded(output_fpath: str, video_fpath: str):
+    embedded = find_embedded_video(output_fpath)
+    assert embedded is not None
+    assert read(output_fpath)[embedded.offset:embedded.offset + embedded.length] == read(video_fpath)
+
+
+def test_mux_round_trip(corpus, mux):
+    pair = corpus[0]
+    output_fpath = mux(pair)
+    assert_video_embedded(output_fpath, pair.video)
+
+    jpeg = JpegFile(read(output_fpath))
+    assert sum(1 for segment in jpeg.segments if jpeg.is_xmp(segment)) == 1
+    xmp = description(jpeg.read_xmp())
+    assert xmp.get(GCAMERA_MOTION_PHOTO) == "1"
+    assert xmp.get(XMP_CREATOR_TOOL) == "IMG_0001"  # merged from the source XMP
+    # The entropy coded data is copied verbatim
+    source = JpegFile(read(pair.image))
+    assert jpeg.data[jpeg.tail_start:].startswith(source.data[source.tail_start:])
+
+
+def test_streamed_image_is_identical(corpus, mux, tmp_path):
+    pair = corpus[0]
+    in_memory = mux(pair, output_directory=str(tmp_path / "memory"))
+    streamed = mux(pair, output_directory=str(tmp_path / "streamed"), stream_threshold=0)
+    assert read(streamed) == read(in_memory)
+
+
+def test_extended_xmp(corpus, mux):
+    # A source XMP too big for one APP1 segment is split, its properties go to ExtendedXMP
+    pair = corpus[0]
+    text = "x" * (2 * XMP_MAX_SIZE)
+    source_xmp = (
+        '<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+        '<rdf:Description rdf:about="" xmlns:dc="http://purl.org/dc/elements/1.1/">'
+        f"<dc:source>{text}</dc:source>"
+        "</rdf:Description></rdf:RDF></x:xmpmeta>"
+    ).encode("utf-8")
+    output_fpath = mux(pair, image_metadata=dict(pair.image_metadata, **{"XMP:XMP": source_xmp}))
+    assert_video_embedded(output_fpath, pair.video)
+
+    jpeg = JpegFile(read(output_fpath))
+    standard = description(jpeg.read_xmp())
+    assert standard.get(GCAMERA_MOTION_PHOTO) == "1"
+    assert standard.find("{http://purl.org/dc/elements/1.1/}source") is None
+    guid, extended = extended_xmp(jpeg)
+    assert guid == standard.get(const.XMPNOTE_HAS_EXTENDED_XMP) == JpegFile.extended_xmp_guid(extended)
+    assert description(extended).find("{http://purl.org/dc/elements/1.1/}source").text == text
+
+
+def test_with_xmp_replaces_previous_segments(corpus):
+    source = JpegFile(read(corpus[0].image))
+    first = JpegFile(source.with_xmp(b"<first/>", b"<extended>" + b"e" * XMP_MAX_SIZE + b"</extended>"))
+    second = JpegFile(first.with_xmp(b"<second/>"))
+    assert second.read_xmp() == b"<second/>"
+    assert extended_xmp(second) == (None, None)
+    assert sum(1 for segment in second.segments if second.is_xmp(segment)) == 1
+    # Everything but the XMP is kept, in order
+    others = [source.data[s[1]:s[2]] for s in source.segments if not source.is_xmp(s)]
+    assert [second.data[s[1]:s[2]] for s in second.segments if not second.is_xmp(s)] == others
+    assert second.data[second.tail_start:] == source.data[source.tail_start:]
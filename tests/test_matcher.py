@@ -0,0 +1,77 @@
+import os
+
+from FilenameMatcher import FilenameMatcher
+
+
+def paths(*names, directory="photos") -> list:
+    return [os.path.join(directory, name) for name in names]
+
+
+def test_exact_stem_is_case_insensitive():
+    videos = paths("IMG_0001.MOV", "img_0002.mov")
+    matcher = FilenameMatcher(videos)
+    assert matcher.match(paths("img_0001.jpg")[0]) == videos[0]
+    assert matcher.match(paths("IMG_0002.HEIC")[0]) == videos[1]
+    assert matcher.match(paths("IMG_0003.JPG")[0]) is None
+
+
+def test_directories_are_kept_apart():
+    videos = paths("IMG_0001.MOV", directory="a")
+    matcher = FilenameMatcher(videos)
+    assert matcher.match(paths("IMG_0001.JPG", directory="b")[0]) is None
+    assert matcher.match(paths("IMG_0001.JPG", directory="a")[0]) == videos[0]
+
+
+def test_extension_priority():
+    # .mp4 is preferred over .mov, unknown extensions come last; the rest stays available
+    videos = paths("IMG_0001.avi", "IMG_0001.MOV", "IMG_0001.MP4")
+    matcher = FilenameMatcher(videos)
+    image = paths("IMG_0001.JPG")[0]
+    assert [matcher.match(image) for _ in videos] == [videos[2], videos[1], videos[0]]
+    assert matcher.match(image) is None
+
+
+def test_video_is_used_once():
+    videos = paths("IMG_0001.MOV")
+    matcher = FilenameMatcher(videos)
+    assert matcher.match(paths("IMG_0001.JPG")[0]) == videos[0]
+    assert matcher.match(paths("IMG_0001.HEIC")[0]) is None
+
+
+def test_rules_are_opt_in():
+    videos = paths("IMG_0001.MOV", "IMG_0002_HEVC.MOV")
+    images = paths("IMG_E0001.JPG", "IMG_0002.HEIC")
+    assert [FilenameMatcher(videos).match(image) for image in images] == [None, None]
+    matcher = FilenameMatcher(videos, ["apple-edit", "hevc-suffix"])
+    assert [matcher.match(image) for image in images] == videos
+
+
+def test_rule_applies_to_either_side():
+    # The edited name may be the image's or the video's
+    videos = paths("IMG_E0001.MOV")
+    matcher = FilenameMatcher(videos, ["apple-edit"])
+    assert matcher.match(paths("IMG_0001.JPG")[0]) == videos[0]
+
+
+def test_exact_match_wins_over_rule_match():
+    # IMG_E0001.JPG matches IMG_0001.MOV by rule, but IMG_0001.JPG matches it exactly: whichever is
+    # matched first, the video goes to the exact match
+    videos = paths("IMG_0001.MOV")
+    images = paths("IMG_E0001.JPG", "IMG_0001.JPG")
+    for order in (images, images[::-1]):
+        matcher = FilenameMatcher(videos, ["apple-edit"], images)
+        assert {image: matcher.match(image) for image in order} == {images[0]: None, images[1]: videos[0]}
+
+
+def test_rule_match_is_used_without_exact_competitor():
+    videos = paths("IMG_0001.MOV")
+    images = paths("IMG_E0001.JPG", "IMG_0002.JPG")
+    matcher = FilenameMatcher(videos, ["apple-edit"], images)
+    assert matcher.match(images[0]) == videos[0]
+
+
+def test_unmatched():
+    videos = paths("IMG_0001.MOV", "IMG_0002.MOV", "IMG_0003.MP4")
+    matcher = FilenameMatcher(videos)
+    matcher.match(paths("IMG_0002.JPG")[0])
+    assert matcher.unmatched() == [videos[0], videos[2]]
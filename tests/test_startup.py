@@ -0,0 +1,27 @@
+import subprocess
+import sys
+import time
+
+import benchmark
+from utils import find_embedded_video
+
+
+def test_single_file_run_within_budget(corpus, tmp_path):
+    # Best of a few runs, like the benchmark stages, so one slow process start doesn't fail it
+    pair = corpus[0]
+    seconds = []
+    for i in range(3):
+        output_fpath = str(tmp_path / f"{i}_{pair.image_type}.jpg")
+        start = time.perf_counter()
+        benchmark.single_file_run(pair, output_fpath)
+        seconds.append(time.perf_counter() - start)
+        assert find_embedded_video(output_fpath).length == pair.video_size
+    assert min(seconds) < benchmark.STARTUP_BUDGET, f"single file run takes {min(seconds):.3f}s"
+
+
+def test_command_line_does_not_import_gui():
+    code = "import sys, motionphoto2, Muxer; print(sorted({'gooey', 'wx'} & set(sys.modules)))"
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=benchmark.SCRIPT_DIRECTORY, capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == "[]"
@@ -1,27 +1,166 @@
-import exiftool
+import base64
+import hashlib
 import json
 import logging
+import mmap
 import os
-import re
+import shutil
 import struct
 
 from pathlib import Path
-from typing import Dict, Any
+from typing import TYPE_CHECKING, Dict, Any, NamedTuple
 
 import constants as const
+import JpegFile
+from HeifFile import HeifFile
 
+# exiftool and lxml are imported where used, so the command line starts without them
+if TYPE_CHECKING:
+    from ExifToolPool import ExifToolPool
 
-def extract_track_number(metadata: str) -> str:
-    find = re.search(r"\s*<Track(\d+):StillImageTime>-1<", metadata)
-    return find.group(1)
 
+def read_box_headers(f, start: int, end: int) -> list:
+    # Returns (type, start, payload start, end) of every ISOBMFF/QuickTime box in f[start:end],
+    # reading only the box headers
+    boxes = []
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(16)
+        if len(header) < 8:
+            break
+        size, box_type = struct.unpack(">I4s", header[:8])
+        header_size = 8
+        if size == 1:
+            if len(header) < 16:
+                break
+            (size,) = struct.unpack(">Q", header[8:16])
+            header_size = 16
+        elif size == 0:
+            size = end - pos
+        if size < header_size or pos + size > end:
+            raise ValueError(f"Invalid size of box {box_type} at offset {pos}")
+        boxes.append((box_type, pos, pos + header_size, pos + size))
+        pos += size
+    return boxes
 
-def extract_track_duration(track_number: str, metadata: str) -> str:
-    find = re.search(rf"\s*<Track{track_number}:TrackDuration>(\d+\.?\d*)<", metadata)
-    track_duration = find.group(1)
-    if track_duration is None:
-        return -1
-    return str(round(float(track_duration) * 1000000))
+
+def find_box(f, parent: tuple, path: list) -> tuple:
+    # Follows path (list of box types) from parent, returns None when any box is missing
+    for box_type in path:
+        for child in read_box_headers(f, parent[2], parent[3]):
+            if child[0] == box_type:
+                parent = child
+                break
+        else:
+            return None
+    return parent
+
+
+def read_payload(f, box: tuple, size: int = None) -> bytes:
+    f.seek(box[2])
+    return f.read(box[3] - box[2] if size is None else size)
+
+
+def read_mebx_key_id(f, mebx: tuple, key: bytes) -> bytes:
+    # mebx sample entry: 8 bytes of SampleEntry header, then 'keys' with one box per key,
+    # named by the local key id and holding a 'keyd' box with the key namespace and value
+    keys = find_box(f, (b"mebx", mebx[1], mebx[2] + 8, mebx[3]), [b"keys"])
+    if keys is None:
+        return None
+    for local_key in read_box_headers(f, keys[2], keys[3]):
+        keyd = find_box(f, local_key, [b"keyd"])
+        if keyd is not None and read_payload(f, keyd)[4:] == key:
+            return local_key[0]
+    return None
+
+
+def read_first_sample(f, stbl: tuple) -> bytes:
+    stsz = find_box(f, stbl, [b"stsz"])
+    chunks = find_box(f, stbl, [b"stco"]) or find_box(f, stbl, [b"co64"])
+    if stsz is None or chunks is None:
+        return None
+    sample_size, sample_count = struct.unpack(">II", read_payload(f, stsz, 12)[4:12])
+    if sample_count == 0:
+        return None
+    if sample_size == 0:
+        (sample_size,) = struct.unpack(">I", read_payload(f, stsz, 16)[12:16])
+    chunk_table = read_payload(f, chunks, 16)
+    if chunks[0] == b"stco":
+        (chunk_offset,) = struct.unpack(">I", chunk_table[8:12])
+    else:
+        (chunk_offset,) = struct.unpack(">Q", chunk_table[8:16])
+    f.seek(chunk_offset)
+    return f.read(sample_size)
+
+
+def read_still_image_time(fpath: str) -> tuple:
+    with open(fpath, "rb") as f:
+        return read_still_image_time_from_file(f)
+
+
+def read_still_image_time_from_file(f) -> tuple:
+    # Finds the Live Photo still-image-time metadata track and returns its track number and
+    # duration in microseconds (the keyframe timestamp), the same as ExifTool's
+    # Track<N>:StillImageTime=-1 and Track<N>:TrackDuration. Only box headers and
+    # the first metadata sample are read.
+    f.seek(0, os.SEEK_END)
+    moov = find_box(f, (None, 0, 0, f.tell()), [b"moov"])
+    if moov is None:
+        raise ValueError("No moov box found")
+
+    mvhd = find_box(f, moov, [b"mvhd"])
+    if mvhd is None:
+        raise ValueError("No mvhd box found")
+    header = read_payload(f, mvhd, 32)
+    (timescale,) = struct.unpack(">I", header[20:24] if header[0] == 1 else header[12:16])
+    if timescale == 0:
+        raise ValueError("Invalid movie timescale")
+
+    track_number = 0
+    for trak in read_box_headers(f, moov[2], moov[3]):
+        if trak[0] != b"trak":
+            continue
+        track_number += 1
+        hdlr = find_box(f, trak, [b"mdia", b"hdlr"])
+        if hdlr is None or read_payload(f, hdlr, 12)[8:12] != b"meta":
+            continue
+        stbl = find_box(f, trak, [b"mdia", b"minf", b"stbl"])
+        stsd = find_box(f, stbl, [b"stsd"]) if stbl is not None else None
+        if stsd is None:
+            continue
+        mebx = next((e for e in read_box_headers(f, stsd[2] + 8, stsd[3]) if e[0] == b"mebx"), None)
+        if mebx is None:
+            continue
+        key_id = read_mebx_key_id(f, mebx, const.STILL_IMAGE_TIME_KEY)
+        if key_id is None:
+            continue
+
+        sample = read_first_sample(f, stbl) or b""
+        still_image_time = None
+        pos = 0
+        while pos + 8 <= len(sample):
+            size, item_id = struct.unpack(">I4s", sample[pos:pos + 8])
+            if size < 8:
+                break
+            if item_id == key_id:
+                still_image_time = int.from_bytes(sample[pos + 8:pos + size], "big", signed=True)
+                break
+            pos += size
+        if still_image_time != -1:
+            continue
+
+        tkhd = find_box(f, trak, [b"tkhd"])
+        if tkhd is None:
+            continue
+        header = read_payload(f, tkhd, 36)
+        if header[0] == 1:
+            (duration,) = struct.unpack(">Q", header[28:36])
+        else:
+            (duration,) = struct.unpack(">I", header[20:24])
+        return track_number, round(duration * 1000000 / timescale)
+
+    raise ValueError("No still image time track found")
 
 
 def read_file(fpath: str) -> bytes:
@@ -29,18 +168,400 @@ def read_file(fpath: str) -> bytes:
         return f.read()
 
 
+class FileRange(NamedTuple):
+    # A byte range of a file on disk, copied to the output without loading it to memory
+    fpath: str
+    offset: int
+    length: int
+
+
+def segment_size(segment) -> int:
+    return segment.length if isinstance(segment, FileRange) else len(segment)
+
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def copy_range(source: FileRange, dst):
+    # Copy the range with copy_file_range/sendfile (in kernel, reflink capable) where possible,
+    # otherwise fall back to a chunked copy. dst must be a file object opened for binary writing.
+    dst.flush()
+    dst_offset = dst.tell()
+    copied = 0
+    with open(source.fpath, "rb") as src:
+        for zero_copy in ("copy_file_range", "sendfile"):
+            if not hasattr(os, zero_copy):
+                continue
+            try:
+                while copied < source.length:
+                    if zero_copy == "copy_file_range":
+                        n = os.copy_file_range(
+                            src.fileno(), dst.fileno(), source.length - copied,
+                            source.offset + copied, dst_offset + copied
+                        )
+                    else:
+                        os.lseek(dst.fileno(), dst_offset + copied, os.SEEK_SET)
+                        n = os.sendfile(dst.fileno(), src.fileno(), source.offset + copied, source.length - copied)
+                    if n == 0:
+                        break
+                    copied += n
+                break
+            except OSError:
+                # Not supported for this file system / platform combination, try the next method
+                continue
+        src.seek(source.offset + copied)
+        dst.seek(dst_offset + copied)
+        while copied < source.length:
+            chunk = src.read(min(COPY_CHUNK_SIZE, source.length - copied))
+            if not chunk:
+                raise IOError(f"Unexpected end of file {source.fpath}")
+            dst.write(chunk)
+            copied += len(chunk)
+    dst.seek(dst_offset + copied)
+
+
+def write_segments(dst, segments: list):
+    for segment in segments:
+        if isinstance(segment, FileRange):
+            copy_range(segment, dst)
+        else:
+            dst.write(segment)
+
+
+# ioctl of Linux (btrfs, xfs, ...) cloning a whole file into another one, sharing the extents
+FICLONE = 0x40049409
+
+
+def reflink_file(source: str, dst: str) -> bool:
+    # Returns False when cloning isn't supported (platform, file system, different devices)
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(source, "rb") as src, open(dst, "wb") as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError:
+            return False
+
+
+def copy_file(source: str, dst: str, mode: str = "reflink") -> str:
+    # Copies source to dst (a file path) with metadata like shutil.copy2.
+    #   hardlink - link dst to source, falls back to reflink (e.g. on a different device)
+    #   reflink  - clone with FICLONE, then copy_file_range/sendfile (see copy_range), then plain copy
+    #   copy     - plain shutil.copy2
+    # Returns the method actually used.
+    if mode == "hardlink":
+        try:
+            if os.path.lexists(dst):
+                os.remove(dst)
+            os.link(source, dst)
+            return "hardlink"
+        except OSError:
+            pass
+    if mode in ("reflink", "hardlink"):
+        method = "reflink"
+        if not reflink_file(source, dst):
+            method = "copy"
+            with open(dst, "wb") as dst_file:
+                copy_range(FileRange(source, 0, os.path.getsize(source)), dst_file)
+        shutil.copystat(source, dst)
+        return method
+    shutil.copy2(source, dst)
+    return "copy"
+
+
+def same_file_stat(source: str, dst: str) -> bool:
+    # Cheap up-to-date check of a copy: the same file (hardlink), or the same size and modification time.
+    # Copies keep the modification time of the source, 2s tolerance covers FAT/exFAT timestamps.
+    try:
+        src_stat, dst_stat = os.stat(source), os.stat(dst)
+    except OSError:
+        return False
+    if (src_stat.st_dev, src_stat.st_ino) == (dst_stat.st_dev, dst_stat.st_ino):
+        return True
+    return src_stat.st_size == dst_stat.st_size and abs(src_stat.st_mtime - dst_stat.st_mtime) < 2
+
+
 def enrich_fname(fpath: str, enrich: str) -> str:
     p = Path(fpath)
     fname = f"{p.stem}.{enrich}{p.suffix}"
     return os.path.join(p.parent, fname)
 
-def is_motion_photo(fpath: str, et: exiftool.ExifToolHelper) -> bool:
-    video_in_image = extract_video_from_image(fpath, et)
+def partial_fname(fpath: str) -> str:
+    # Hidden temporary name in the same directory (so renaming it over fpath is atomic)
+    p = Path(fpath)
+    return os.path.join(p.parent, f".{p.name}.partial")
 
-    # Check if the data received is actually a video file
-    if video_in_image and  verify_video_in_image(video_in_image):
-                return True
-    return False
+def fsync_file(fpath: str):
+    # Opened for writing, Windows can't flush a read-only handle
+    with open(fpath, "r+b") as f:
+        os.fsync(f.fileno())
+
+
+def fsync_directory(dpath: str):
+    # Makes a rename into the directory durable. Not possible (nor needed) on Windows.
+    if os.name == "nt":
+        return
+    fd = os.open(dpath, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def lookahead(iterable):
+    # Yields (item, is_last), fetching one item ahead
+    iterator = iter(iterable)
+    try:
+        item = next(iterator)
+    except StopIteration:
+        return
+    for following in iterator:
+        yield item, False
+        item = following
+    yield item, True
+
+def scan_directory(input_directory: str, recursive: bool = False):
+    # Yields (images, videos, others) relative paths of each directory as soon as it is listed,
+    # so the caller can start matching while the rest of the tree is still being scanned.
+    # Files are classified using the DirEntry, without extra stat calls or Path objects.
+    pending = [""]
+    while pending:
+        rel_dir = pending.pop()
+        images, videos, others, subdirectories = [], [], [], []
+        with os.scandir(os.path.join(input_directory, rel_dir)) as entries:
+            for entry in entries:
+                rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                if entry.is_dir():
+                    if recursive and not entry.is_symlink():
+                        subdirectories.append(rel_path)
+                    continue
+                if not entry.is_file():
+                    continue
+                extension = os.path.splitext(entry.name)[1].lower()
+                if extension in const.IMAGE_EXTENSIONS:
+                    images.append(rel_path)
+                elif extension in const.VIDEO_EXTENSIONS:
+                    videos.append(rel_path)
+                else:
+                    others.append(rel_path)
+        yield images, videos, others
+        pending.extend(reversed(subdirectories))
+
+
+def is_motion_photo(fpath: str) -> bool:
+    return find_embedded_video(fpath) is not None
+
+
+def read_heif_meta(f) -> HeifFile:
+    # Parses a HEIF file up to the end of its meta box, None for other files
+    try:
+        f.seek(0, os.SEEK_END)
+        boxes = read_box_headers(f, 0, f.tell())
+        if not boxes or boxes[0][0] != b"ftyp":
+            return None
+        meta = next((box for box in boxes if box[0] == b"meta"), None)
+        if meta is None:
+            return None
+        f.seek(0)
+        return HeifFile(f.read(meta[3]))
+    except ValueError:
+        return None
+
+
+def read_image_xmp(f) -> bytes:
+    xmp = JpegFile.read_xmp_from_file(f)
+    if xmp is not None:
+        return xmp
+    heif = read_heif_meta(f)
+    return heif.read_xmp(f) if heif is not None else None
+
+
+# Major brands of the ISOBMFF ftyp box, mapped to ExifTool's File:FileTypeExtension
+FTYP_BRAND_EXTENSIONS = {
+    b"heic": "heic", b"heix": "heic", b"heim": "heic", b"heis": "heic",
+    b"hevc": "heic", b"hevx": "heic", b"mif1": "heic", b"msf1": "heic",
+    b"avif": "avif", b"avis": "avif",
+    b"qt  ": "mov",
+}
+
+
+def file_type_extension(header: bytes) -> str:
+    # File type from the first bytes of a file, as ExifTool's File:FileTypeExtension
+    # for the formats handled here (JPEG, HEIF/AVIF, MOV and MP4), None for anything else
+    if header[:3] == b"\xff\xd8\xff":
+        return "jpg"
+    if header[4:8] == b"ftyp":
+        return FTYP_BRAND_EXTENSIONS.get(bytes(header[8:12]), "mp4")
+    if header[4:8] in (b"wide", b"free", b"mdat", b"moov"):
+        return "mov"  # QuickTime files without ftyp
+    return None
+
+
+def image_xmp_range(f) -> tuple:
+    # (offset, length) of the XMP packet of a JPEG or HEIF file, None when missing or fragmented
+    xmp_range = JpegFile.find_xmp_in_file(f)
+    if xmp_range is not None:
+        return xmp_range
+    heif = read_heif_meta(f)
+    if heif is None or heif.xmp_item() is None:
+        return None
+    return heif.item_range(heif.xmp_item())
+
+
+def xmp_attribute(element, name: str) -> str:
+    # XMP properties may be serialized either as attributes or as child elements
+    if name in element.attrib:
+        return element.attrib[name]
+    child = element.find(name)
+    return child.text if child is not None else None
+
+
+def xmp_video_offsets(xmp: bytes) -> list:
+    # Offsets of the video from the end of the file, from the Container directory (Motion Photo v1+)
+    # and from the legacy GCamera:MicroVideoOffset (Motion Photo v0)
+    from lxml import etree
+
+    offsets = []
+    try:
+        root = etree.fromstring(xmp.strip(b"\x00 \t\r\n"))
+    except etree.XMLSyntaxError:
+        return offsets
+    for description in root.iterfind(".//rdf:Description", const.NAMESPACES):
+        items = description.findall(".//Container:Directory/rdf:Seq/rdf:li", const.NAMESPACES)
+        items = [
+            li.find("Container:Item", const.NAMESPACES) if li.find("Container:Item", const.NAMESPACES) is not None else li
+            for li in items
+        ]
+        semantics = [xmp_attribute(item, const.ITEM_SEMANTIC) for item in items]
+        if "MotionPhoto" in semantics:
+            try:
+                offset = 0
+                for item in items[semantics.index("MotionPhoto"):]:
+                    offset += int(xmp_attribute(item, const.ITEM_LENGTH) or 0)
+                    offset += int(xmp_attribute(item, const.ITEM_PADDING) or 0)
+                offsets.append(offset)
+            except ValueError:
+                pass
+        micro_video_offset = xmp_attribute(description, const.GCAMERA_MICRO_VIDEO_OFFSET)
+        if micro_video_offset is not None and micro_video_offset.isdigit():
+            offsets.append(int(micro_video_offset))
+    return offsets
+
+
+def read_sefh(f, file_size: int) -> tuple:
+    # Reads the SEFH table referenced by the SEFT trailer.
+    # Returns (SEFH start, [(tag id, offset, length)]) or None.
+    if file_size < 8:
+        return None
+    f.seek(file_size - 8)
+    sefh_size, seft = struct.unpack("<i4s", f.read(8))
+    if seft != b"SEFT" or sefh_size < 12 or sefh_size > file_size - 8:
+        return None
+    sefh_start = file_size - 8 - sefh_size
+    f.seek(sefh_start)
+    sefh = f.read(sefh_size)
+    if sefh[:4] != b"SEFH":
+        return None
+    (count,) = struct.unpack("<i", sefh[8:12])
+    entries = []
+    for i in range(count):
+        entry = sefh[12 + i * 12:24 + i * 12]
+        if len(entry) < 12:
+            return None
+        tag_offset, tag_length = struct.unpack("<ii", entry[4:12])
+        entries.append((entry[:4], tag_offset, tag_length))
+    return sefh_start, entries
+
+
+def samsung_video_range(f, file_size: int) -> tuple:
+    # Locates MotionPhoto_Data through the SEFH table.
+    # Returns (start, length) of the video or None.
+    sefh = read_sefh(f, file_size)
+    if sefh is None:
+        return None
+    sefh_start, entries = sefh
+    for tag_id, tag_offset, tag_length in entries:
+        if tag_id != const.SAMSUNG_TAG_IDS["MotionPhoto_Data"] or not 0 < tag_offset <= sefh_start:
+            continue
+        tag_start = sefh_start - tag_offset
+        f.seek(tag_start + 4)
+        (name_length,) = struct.unpack("<i", f.read(4))
+        data_start = tag_start + 8 + name_length
+        data_length = tag_length - 8 - name_length
+        f.seek(data_start)
+        data = f.read(12)
+        if data[:4] == b"mpv2" and data_length == 12:
+            # HEIC variant - the tag only points to the video stored in the mpvd box
+            video_start, video_length = struct.unpack(">ii", data[4:12])
+            return video_start, video_length
+        return data_start, data_length
+    return None
+
+
+def find_mpvd_box(f, file_size: int) -> tuple:
+    # HEIC motion photos store the video in a top level mpvd box, followed by the sefd box
+    try:
+        boxes = read_box_headers(f, 0, file_size)
+    except ValueError:
+        return None
+    if not boxes or boxes[0][0] != b"ftyp":
+        return None
+    return next((box for box in boxes if box[0] == b"mpvd"), None)
+
+
+def mpvd_video_range(f, file_size: int) -> tuple:
+    mpvd = find_mpvd_box(f, file_size)
+    if mpvd is None:
+        return None
+    return mpvd[2], mpvd[3] - mpvd[2]
+
+
+def still_image_end(f, file_size: int, video: FileRange) -> int:
+    # The still image ends where the first appended structure begins: the video itself,
+    # the first Samsung tag in front of SEFH, or the HEIC mpvd box
+    end = video.offset
+    sefh = read_sefh(f, file_size)
+    if sefh is not None:
+        sefh_start, entries = sefh
+        offsets = [tag_offset for tag_id, tag_offset, tag_length in entries if 0 < tag_offset <= sefh_start]
+        end = min(end, sefh_start - max(offsets) if offsets else sefh_start)
+    mpvd = find_mpvd_box(f, file_size)
+    if mpvd is not None:
+        end = min(end, mpvd[1])
+    return end
+
+
+def find_embedded_video(fpath: str) -> FileRange:
+    # Native replacement of extracting -MotionPhotoVideo/-EmbeddedVideoFile with ExifTool:
+    # only the XMP, the trailer and the first bytes of the claimed video are read
+    with open(fpath, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+
+        # SEFH gives the exact video range, the XMP Item:Length and mpvd may include the trailer behind it
+        candidates = []
+        video_range = samsung_video_range(f, file_size)
+        if video_range is not None:
+            candidates.append(video_range)
+        xmp = read_image_xmp(f)
+        if xmp is not None:
+            for offset in xmp_video_offsets(xmp):
+                if 0 < offset <= file_size:
+                    candidates.append((file_size - offset, offset))
+        video_range = mpvd_video_range(f, file_size)
+        if video_range is not None:
+            candidates.append(video_range)
+
+        for start, length in candidates:
+            if start < 0 or length <= 0 or start + length > file_size:
+                continue
+            f.seek(start)
+            if verify_video_in_image(f.read(15)):
+                return FileRange(fpath, start, length)
+    return None
 
 def verify_video_in_image(video_in_image: bytes) -> bool :
     if video_in_image and any([video_in_image.find(sig, 0, 15) != -1 for sig in const.VIDEO_SIGNATURE["VIDEO"]]):
@@ -51,7 +572,7 @@ def verify_video_in_image(video_in_image: bytes) -> bool :
     return False
 
 
-def extract_video_from_image(fpath: str, et: exiftool.ExifToolHelper) -> bytes:
+def extract_video_from_image(fpath: str, et: "ExifToolPool") -> bytes:
     # Check using GCamera headers
     video_in_image = et.execute("-b",
                                 "-MotionPhotoVideo",
@@ -67,41 +588,115 @@ def extract_video_from_image(fpath: str, et: exiftool.ExifToolHelper) -> bytes:
 
     return video_in_image
 
+PREFETCH_TAGS = ["File:FileTypeExtension", "ContentIdentifier", "XMP"]
+
+
+def prefetch_metadata(et: "ExifToolPool", fpaths: list, batch_size: int = 256) -> list:
+    # Reads everything Muxer and the matching need (file type, ContentIdentifier and the XMP packet)
+    # for a batch of files at once: one command per file, pipelined over the ExifTool pool.
+    # XMP:XMP is returned as bytes. A file ExifTool couldn't read gets an empty dict (see get_tags).
+    result = []
+    for i in range(0, len(fpaths), batch_size):
+        batch = [str(fpath) for fpath in fpaths[i:i + batch_size]]
+        for metadata in et.get_tags(batch, tags=PREFETCH_TAGS, params=["-b"]):
+            xmp = metadata.get("XMP:XMP")
+            if isinstance(xmp, str):
+                if xmp.startswith("base64:"):
+                    metadata["XMP:XMP"] = base64.b64decode(xmp[len("base64:"):])
+                else:
+                    metadata["XMP:XMP"] = xmp.encode("utf-8")
+            result.append(metadata)
+    return result
+
+
+SAMPLE_CHUNK_SIZE = 64 * 1024
+
+
+def sample_digest(fpath: str, offset: int = 0, length: int = None) -> str:
+    # Hash of the size and a few sampled chunks (start, middle, end) of a file range.
+    # Cheap to compute on huge files, but still catches truncated or rewritten outputs.
+    with open(fpath, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+        if length is None:
+            length = file_size - offset
+        digest = hashlib.blake2b(str(length).encode("ascii"), digest_size=16)
+        samples = sorted({0, max(0, length // 2 - SAMPLE_CHUNK_SIZE // 2), max(0, length - SAMPLE_CHUNK_SIZE)})
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            data = None  # empty file or mmap not supported
+        try:
+            for start in samples:
+                end = offset + min(start + SAMPLE_CHUNK_SIZE, length)
+                if data is not None:
+                    digest.update(data[offset + start:end])
+                else:
+                    f.seek(offset + start)
+                    digest.update(f.read(end - offset - start))
+        finally:
+            if data is not None:
+                data.close()
+    return digest.hexdigest()
+
+
 def input_output_binary_compare(input_video: str, output_image: str) -> bool:
+    # Locates the embedded video through the muxed layout (XMP Item:Length, SEFH or mpvd)
+    # and compares size and sampled chunks with the input, reading only kilobytes of both files
     if all((os.path.exists(input_video), os.path.exists(output_image))):
         try:
-            with open(input_video, "rb") as i_vid:
-                input_video_data = i_vid.read()
-                with open(output_image, "rb") as o_img:
-                    output_image_data = o_img.read()
-                    if output_image_data.find(input_video_data) != -1:
-                        return True
+            video_size = os.path.getsize(input_video)
+            embedded = find_embedded_video(str(output_image))
+            if embedded is None or video_size == 0:
+                return False
+            if embedded.offset + video_size > os.path.getsize(output_image) or embedded.length < video_size:
+                return False
+            return sample_digest(input_video) == sample_digest(output_image, embedded.offset, video_size)
         except:
             pass
     return False
 
 def load_defaults() -> Dict[str, Any]:
+    defaults = {
+        'input_directory' : '',
+        'recursive' : True,
+        'exif_match' : True,
+        'pairing_rules' : [],
+        'incremental_mode' : False,
+        'resume' : False,
+        'plan_only' : None,
+        'execute' : None,
+        'plan_shard' : None,
+        'watch' : False,
+        'pair_timeout' : 60.0,
+        'demux' : False,
+        'copy_unmuxed' : False,
+        'copy_mode' : 'reflink',
+        'output_directory' : '',
+        'delete_video' : False,
+        'overwrite' : False,
+        'keep_temp' : False,
+        'jobs' : 1,
+        'exiftool_processes' : 2,
+        'exiftool_timeout' : 30.0,
+        'max_memory' : None,
+        'stream_threshold' : 64.0,
+        'pipeline' : 'pool',
+        'profile' : None,
+        'verbose' : False,
+        'input_image' : '',
+        'input_video' : '',
+        'output_file' : '',
+        'no_xmp' : False
+    }
     try:
         scriptdir = Path(__file__).resolve().parent
         with open(scriptdir / 'motionphoto2.json', 'r' , encoding='utf-8') as f:
-            return json.load(f)
+            # Settings saved by older versions may miss newer options
+            defaults.update(json.load(f))
     except:
-        return {
-            'input_directory' : '',
-            'recursive' : True,
-            'exif_match' : True,
-            'incremental_mode' : False,
-            'copy_unmuxed' : False,
-            'output_directory' : '',
-            'delete_video' : False,
-            'overwrite' : False,
-            'keep_temp' : False,
-            'verbose' : False,
-            'input_image' : '',
-            'input_video' : '',
-            'output_file' : '',
-            'no_xmp' : False
-        }
+        pass
+    return defaults
         
 def save_defaults(defaults: Dict[str, Any]):
     try: